@@ -12,30 +12,9 @@ import os
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from utils import S3ObjectMonitor
-from utils.raster_pipeline import AddData, DeleteData
+import coloredlogs
 import logging
-
-# Set the AWS profile environment variable
-
-os.environ["AWS_PROFILE"] = "LWI"
-
-
-# Configure logging to output messages to the console at the INFO level
-
-logging.basicConfig(level=logging.INFO)
-# Define the log file name
-
-log_file = "logs.log"
-# Create a file handler to log messages to a file
-
-file_handler = logging.FileHandler(log_file)
-
-# Create a formatter to specify the log message format
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-file_handler.setFormatter(formatter)
-
-# Add the FileHandler to the root logger
-logging.getLogger("").addHandler(file_handler)
+import yaml
 
 # Define the mode of operation (development or production)
 
@@ -54,11 +33,73 @@ _DEFAULT_PATHS = {
 }
 _BUCKETS = _DEFAULT_BUCKETS[_MODE]
 _PATH = _DEFAULT_PATHS[_MODE]
+_CONFIG_FILE = "credentials.yaml"
 _STATE_FILE = "lwi_buckets_state_tif.json"
 _LAST_RUN = "lwi_last_run_tif.json"
 _FILE_TYPE = ("tif", "tiff")
-###Temp path to store raster data
+###Temp path to store raster data, every raster works in its own folder inside it
 _TEMP_PATH = "temp/"
+###A raster starts when input size x expansion fits the free disk left above the reserve
+_DISK_EXPANSION = 4
+_DISK_RESERVE = 20 * 1024**3
+###Persistent cache of the downloaded rasters and its disk budget
+_CACHE_PATH = "raster_cache/"
+_CACHE_SIZE = 200 * 1024**3
+###Convert the rasters to COG with overviews matching the cache scales
+_CONVERT_TO_COG = True
+###Encode the depths as integer codes ("uint16", "uint8") or keep them as delivered (None)
+_QUANTIZE = None
+###Window checksums of the published rasters, updates only rebuild the changed tiles
+_SIGNATURES_PATH = "raster_signatures/"
+# Workers of each publishing stage, network bound stages run several items at a time.
+# The arcpy stages (prepare, publish) share one thread, arcpy is not thread safe
+_STAGE_WORKERS = {
+    "download": 4,
+    "reproject": 1,
+    "optimize": 2,
+    "prepare": 1,
+    "publish": 1,
+    "footprint": 1,
+    "statistics": 1,
+    "webmap": 1,
+}
+
+
+def setup():
+    """Set the AWS profile and the logging of the run, done when the script runs so
+    importing the module (e.g. in the tests) has no side effect"""
+    # Set the AWS profile environment variable
+    os.environ["AWS_PROFILE"] = "LWI"
+
+    # Configure logging to output messages to the console at the INFO level
+    logging.basicConfig(level=logging.INFO)
+    coloredlogs.install(level="INFO")
+    # Create a file handler to log messages to a file
+    file_handler = logging.FileHandler("logs.log")
+
+    # Create a formatter to specify the log message format
+    formatter = logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    file_handler.setFormatter(formatter)
+
+    # Add the FileHandler to the root logger
+    logging.getLogger("").addHandler(file_handler)
+
+
+def load_stores(config_file: str = _CONFIG_FILE) -> tuple:
+    """Return the footprint index, the statistics store and the region table of the
+    run, created once and shared by every raster (None when not configured)"""
+    from utils.raster_pipeline import load_footprint_index, load_statistics_store
+
+    try:
+        with open(config_file, "r") as f:
+            config_data = yaml.safe_load(f)
+    except FileNotFoundError:
+        logging.info("Credentials file not found")
+        return None, None, None
+    statistics, region_table = load_statistics_store(config_data)
+    return load_footprint_index(config_data), statistics, region_table
 
 
 def main():
@@ -75,20 +116,91 @@ def main():
     logging.info("New elements: %s", new_elements)
     logging.info("Old elements: %s", old_elements)
     if new_elements or old_elements:
-        # Deleting old elements
-        for removed in old_elements:
-            item_deleted = DeleteData(path=removed, s3=monitor.get_s3_client())
+        # The publishing stack (arcpy, arcgis, rasterio) is only imported when there is work
+        from utils.raster_pipeline import (
+            AddData,
+            DeleteData,
+            DiskAdmission,
+            RasterCache,
+            SignatureStore,
+            WebmapChanges,
+            publishing_pipeline,
+        )
+
+        signatures = SignatureStore(_SIGNATURES_PATH)
+        footprints, statistics, region_table = load_stores()
+        # A modified raster is listed as removed and added: its service is updated in place
+        added_keys = {(added["Bucket"], added["Key"]) for added in new_elements}
+        updated_keys = {
+            (removed["Bucket"], removed["Key"])
+            for removed in old_elements
+            if (removed["Bucket"], removed["Key"]) in added_keys
+        }
+        # Webmap layers are added and removed once for the whole run
+        webmap_changes = WebmapChanges()
+        # Deleting old elements, their layers leave the webmap before the services are deleted
+        items_deleted = [
+            DeleteData(
+                path=removed,
+                s3=monitor.get_s3_client(),
+                signatures=signatures,
+                webmap_changes=webmap_changes,
+                footprints=footprints,
+                statistics=statistics,
+            )
+            for removed in old_elements
+            if (removed["Bucket"], removed["Key"]) not in updated_keys
+        ]
+        for item_deleted in items_deleted:
+            item_deleted.queue_webmap_removal()
+        webmap_changes.apply()
+        for item_deleted in items_deleted:
             item_deleted.execute()
-        # Processing new elements
-        for added in new_elements:
-            item_to_add = AddData(
-                path=added, temp_path=_TEMP_PATH, s3=monitor.get_s3_client()
+        # Processing new elements, each stage works on a different raster at a time
+        cache = RasterCache(_CACHE_PATH, _CACHE_SIZE)
+        items_to_add = [
+            AddData(
+                path=added,
+                temp_path=_TEMP_PATH,
+                s3=monitor.get_s3_client(),
+                cache=cache,
+                cog=_CONVERT_TO_COG,
+                quantize=_QUANTIZE,
+                update=(added["Bucket"], added["Key"]) in updated_keys,
+                signatures=signatures,
+                webmap_changes=webmap_changes,
+                footprints=footprints,
+                statistics=statistics,
+                region_table=region_table,
+            )
+            for added in new_elements
+        ]
+        os.makedirs(_TEMP_PATH, exist_ok=True)
+        admission = DiskAdmission(
+            _TEMP_PATH, expansion=_DISK_EXPANSION, reserve_bytes=_DISK_RESERVE
+        )
+        results = publishing_pipeline(_STAGE_WORKERS, admission=admission).run(
+            items_to_add
+        )
+        if webmap_changes.apply()["error"] is not None:
+            logging.error(
+                "Webmap changes not applied, added: %s, removed: %s",
+                sorted(webmap_changes.adds),
+                sorted(webmap_changes.removes),
             )
-            item_to_add.execute()
+        for result in results:
+            if not result["ok"]:
+                logging.error(
+                    "Error publishing %s in stage %s: %s",
+                    result["item"].s3_path,
+                    result["failed_stage"],
+                    result["error"],
+                )
 
     else:
         logging.info("No new elements to process")
 
 
 if __name__ == "__main__":
+    setup()
     main()
@@ -9,35 +9,14 @@ processed data into a database.
 # Add the root directory to the Python path
 import sys
 import os
+from collections import defaultdict
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from utils import S3ObjectMonitor, Report
-from utils.vector_pipeline import AddData, DeleteData
+from utils import S3ObjectMonitor
 
 import logging
 
-# Set the AWS profile environment variable
-
-os.environ["AWS_PROFILE"] = "LWI"
-
-
-# Configure logging to output messages to the console at the INFO level
-
-logging.basicConfig(level=logging.INFO)
-# Define the log file name
-log_file = "logs.log"
-
-# Create a file handler to log messages to a file
-file_handler = logging.FileHandler(log_file)
-
-# Create a formatter to specify the log message format
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-file_handler.setFormatter(formatter)
-
-# Add the FileHandler to the root logger
-logging.getLogger("").addHandler(file_handler)
-
 # Define the mode of operation (development or production)
 _MODE = "PROD"
 _PROJECT = "LWI"
@@ -57,6 +36,36 @@ _PATH = _DEFAULT_PATHS[_MODE]
 _STATE_FILE = "lwi_buckets_state.json"
 _LAST_RUN = "lwi_last_run.json"
 _FILE_TYPE = "shp"
+# Report upload options: gzip encoded csv reports and optional parquet copies
+_REPORT_OPTIONS = {"compress": True, "parquet": False}
+# Memory each file may use, larger files are processed in chunks
+_MEMORY_BUDGET = 2 * 1024**3
+# "append" the rows of each file or "merge" them on (storm_id, fd_id), merge needs the
+# unique index of the key created by src/migrate_database.py
+_LOAD_MODE = "append"
+# Deliveries rejected by the preflight checks of their headers
+_QUARANTINE_FILE = "lwi_quarantine.json"
+
+
+def setup():
+    """Set the AWS profile and the logging of the run, done when the script runs so
+    importing the module (e.g. in the tests) has no side effect"""
+    # Set the AWS profile environment variable
+    os.environ["AWS_PROFILE"] = "LWI"
+
+    # Configure logging to output messages to the console at the INFO level
+    logging.basicConfig(level=logging.INFO)
+    # Create a file handler to log messages to a file
+    file_handler = logging.FileHandler("logs.log")
+
+    # Create a formatter to specify the log message format
+    formatter = logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    file_handler.setFormatter(formatter)
+
+    # Add the FileHandler to the root logger
+    logging.getLogger("").addHandler(file_handler)
 
 
 def main():
@@ -74,29 +83,82 @@ def main():
     logging.info("New elements: %s", new_elements)
     logging.info("Old elements: %s", old_elements)
     if new_elements or old_elements:
+        # The geo and database stack is only imported when there is work
+        from utils import ReportBatch
+        from utils.vector_pipeline import AddData, DeleteData, StormRegistry
+        from utils.vector_pipeline.preflight import (
+            parse_storm_name,
+            preflight,
+            quarantine,
+        )
+
+        # Bad deliveries are set aside from their headers, before any download
+        checks = [preflight(monitor.get_s3_client(), added) for added in new_elements]
+        rejected = [check for check in checks if check["errors"]]
+        if rejected:
+            quarantine(rejected, _QUARANTINE_FILE)
+            logging.warning("Quarantined elements: %s", [r["Key"] for r in rejected])
+        new_elements = [
+            added for added, check in zip(new_elements, checks) if not check["errors"]
+        ]
+
+        # Regions touched per storm, reports are built once per storm for all its regions
+        reports_to_delete = defaultdict(set)
+        reports_to_generate = defaultdict(set)
         # Deleting old elements
         for removed in old_elements:
             item_deleted = DeleteData(path=removed)
-            item_deleted.execute()
+            if not item_deleted.execute():
+                continue
             regions = item_deleted.get_regions()
             storm_id = item_deleted.get_storm_id()
-            for r in regions:
-                report = Report(r, storm_id)
-                report.delete()
+            reports_to_delete[storm_id].update(regions)
+
+        # The storms of the new elements are resolved at once, the missing ones are
+        # created in one batch
+        storms = None
+        if new_elements:
+            try:
+                storms = StormRegistry.from_config()
+                storms.load()
+                storms.resolve(parse_storm_name(added["Key"]) for added in new_elements)
+            except FileNotFoundError:
+                logging.info("Credentials file not found")
+                storms = None
+            except Exception as e:
+                # Each element then resolves its own storm
+                logging.error(f"Storms could not be resolved: {e}")
+                storms = None
 
         # Processing new elements
         for added in new_elements:
-            item_to_add = AddData(path=added)
-            item_to_add.execute()
+            item_to_add = AddData(
+                path=added,
+                memory_budget=_MEMORY_BUDGET,
+                load_mode=_LOAD_MODE,
+                storms=storms,
+            )
+            if not item_to_add.execute():
+                continue
             regions = item_to_add.get_regions()
             storm_id = item_to_add.get_storm_id()
-            for r in regions:
-                report = Report(r, storm_id)
-                report.generate()
+            reports_to_generate[storm_id].update(regions)
+        if storms is not None:
+            # Storms of the elements that failed
+            try:
+                storms.clean()
+            except Exception as e:
+                logging.error(f"Storms could not be cleaned: {e}")
+
+        for storm_id, regions in reports_to_delete.items():
+            ReportBatch(regions, storm_id, **_REPORT_OPTIONS).delete()
+        for storm_id, regions in reports_to_generate.items():
+            ReportBatch(regions, storm_id, **_REPORT_OPTIONS).generate()
 
     else:
         logging.info("No new elements to process")
 
 
 if __name__ == "__main__":
+    setup()
     main()
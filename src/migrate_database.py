@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""
+This script creates the unique indexes the loads rely on (ON CONFLICT needs them), it is
+run once on a new database and after a schema change, not by the pipelines.
+usage: migrate_database.py
+"""
+
+# Add the root directory to the Python path
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from utils import ensure_unique_index
+from utils.report import REPORT_KEY
+from utils.vector_pipeline.aggregate import GROUP_COLS
+from utils.vector_pipeline.load import KEY as RESULT_KEY
+import logging
+import yaml
+
+# Configure logging to output messages to the console at the INFO level
+logging.basicConfig(level=logging.INFO)
+
+_CONFIG_FILE = "credentials.yaml"
+
+
+def unique_indexes(db: dict) -> list:
+    """Return the (table, key) unique indexes of the database of the configuration"""
+    report_tables = {table["type"]: table["name"] for table in db["report"]}
+    return [
+        (db["tables"][0]["name"], RESULT_KEY),
+        # The report registry, database.report[2] as in Report
+        (db["report"][2]["name"], REPORT_KEY),
+        # The block summary of BlockAggregation
+        (report_tables["results_data"], GROUP_COLS),
+    ]
+
+
+def main():
+    """Create the missing unique indexes, a table with duplicated keys fails the run"""
+    with open(_CONFIG_FILE, "r") as f:
+        config_data = yaml.safe_load(f)
+    db = config_data["database"]
+    engine = create_engine(
+        f"postgresql://{db['user']}:{db['password']}@{db['host']}:{db['port']}/{db['database']}"
+    )
+    failed = []
+    for table, key in unique_indexes(db):
+        # One transaction per index, the indexes that can be created are kept
+        with engine.begin() as conn:
+            if not ensure_unique_index(conn, table, key):
+                failed.append(table)
+    if failed:
+        logging.error(
+            f"Remove the duplicated keys of {', '.join(failed)} and run the migration again"
+        )
+        sys.exit(1)
+    logging.info("Unique indexes created")
+
+
+if __name__ == "__main__":
+    main()
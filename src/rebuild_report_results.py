@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"""
+This script rebuilds the block level summary used by the reports (us_blocks_report_results)
+from the whole results table, or checks that the incrementally maintained summary matches
+a full rebuild.
+usage: rebuild_report_results.py [--storm-id ID] [--verify]
+"""
+
+# Add the root directory to the Python path
+import sys
+import os
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from utils import ensure_unique_index
+from utils.vector_pipeline.aggregate import GROUP_COLS, BlockAggregation
+import logging
+import yaml
+
+# Configure logging to output messages to the console at the INFO level
+logging.basicConfig(level=logging.INFO)
+
+_CONFIG_FILE = "credentials.yaml"
+
+
+def main():
+    """Rebuild or verify the block summary"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--storm-id", type=int, help="Only rebuild/verify this storm")
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Compare the summary with a full rebuild without modifying it",
+    )
+    args = parser.parse_args()
+
+    with open(_CONFIG_FILE, "r") as f:
+        config_data = yaml.safe_load(f)
+    db = config_data["database"]
+    engine = create_engine(
+        f"postgresql://{db['user']}:{db['password']}@{db['host']}:{db['port']}/{db['database']}"
+    )
+    report_tables = {table["type"]: table["name"] for table in db["report"]}
+    aggregation = BlockAggregation(
+        db["tables"][0]["name"],
+        report_tables["results_data"],
+        report_tables["boundaries"],
+    )
+    with engine.begin() as conn:
+        if args.verify:
+            mismatches = aggregation.verify(conn, args.storm_id)
+            sys.exit(1 if mismatches else 0)
+        aggregation.rebuild(conn, args.storm_id)
+        # A rebuilt summary has no duplicates left, it gets the index of the migration
+        ensure_unique_index(conn, aggregation.summary_table, GROUP_COLS)
+    logging.info("Block summary rebuilt")
+
+
+if __name__ == "__main__":
+    main()
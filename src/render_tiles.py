@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+"""
+This script renders the XYZ tiles of a depth raster (EPSG:3857) with the raster.lyrx color ramp,
+only the tiles holding flooded pixels are written. It runs without ArcGIS Server.
+usage: render_tiles.py RASTER OUTPUT [--scales S1;S2;...] [--processes N]
+OUTPUT is a folder ({z}/{x}/{y}.png) or a .mbtiles archive
+"""
+
+# Add the root directory to the Python path
+import sys
+import os
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.raster_pipeline.tiles import render_tiles
+import logging
+
+# Configure logging to output messages to the console at the INFO level
+logging.basicConfig(level=logging.INFO)
+
+# Same scales as the map service cache
+_SCALES = "9244648.868618;4622324.434309;2311162.217155;1155581.108577;577790.554289;288895.277144;"
+_SCALES += "144447.638572;72223.819286;36111.909643;18055.954822;9027.977411"
+_LYRX = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "static/arcgis_resources/raster.lyrx",
+)
+
+
+def main():
+    """Render the tiles of a raster"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("raster", help="Depth raster in EPSG:3857")
+    parser.add_argument("output", help="Tiles folder or .mbtiles archive")
+    parser.add_argument("--scales", default=_SCALES, help="Cache scales separated by ;")
+    parser.add_argument("--processes", type=int, help="Rendering processes")
+    args = parser.parse_args()
+
+    render_tiles(
+        args.raster, args.output, args.scales.split(";"), _LYRX, args.processes
+    )
+
+
+if __name__ == "__main__":
+    main()
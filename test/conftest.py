@@ -0,0 +1,7 @@
+import sys
+from unittest.mock import MagicMock
+
+# ArcGIS is not available on the test workers, a stand-in is enough to import the raster
+# pipeline and to build its items. An installed arcpy is used when there is one.
+for module in ("arcpy", "arcgis", "arcgis.gis", "arcgis.mapping"):
+    sys.modules.setdefault(module, MagicMock())
@@ -0,0 +1,29 @@
+"""Disposable PostgreSQL server for the tests that run their SQL on a real database
+The server (pgserver) is started on first use and removed when the tests end, each call
+of create_database returns an engine on a new empty database."""
+
+import itertools
+import tempfile
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+
+try:
+    import pgserver
+except ImportError:
+    pgserver = None
+
+_SERVER = None
+_DATABASES = itertools.count()
+
+
+def create_database():
+    """Return an engine on a new database of the test server"""
+    global _SERVER
+    if _SERVER is None:
+        _SERVER = pgserver.get_server(tempfile.mkdtemp(), cleanup_mode="delete")
+    name = f"test_{next(_DATABASES)}"
+    _SERVER.psql(f"CREATE DATABASE {name};")
+    url = make_url(_SERVER.get_uri()).set(
+        drivername="postgresql+psycopg2", database=name
+    )
+    return create_engine(url)
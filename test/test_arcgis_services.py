@@ -0,0 +1,116 @@
+import unittest
+import os
+import shutil
+import tempfile
+import xml.dom.minidom as DOM
+import xml.etree.ElementTree as ET
+
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from utils.arcgis_services import (  # noqa: E402
+    SddraftDocument,
+    activate_cache,
+    change_cache_dir,
+    configure_mapserver_capabilities,
+    edit_scales,
+    share_options,
+)
+
+# Layout of a map image layer draft written by ArcGIS Pro (arcpy.mp), without the
+# whitespace between elements
+_SAMPLE = os.path.join(os.path.dirname(__file__), "data", "sample.sddraft")
+
+
+def _capabilities(path: str) -> dict:
+    """Return the WebCapabilities of the service and of each extension of a draft"""
+    configuration = ET.parse(path).getroot().find(".//SVCConfiguration")
+    sections = {configuration.findtext("TypeName"): configuration.find("Definition")}
+    for extension in configuration.iter("SVCExtension"):
+        sections[extension.findtext("TypeName")] = extension
+    return {
+        name: next(
+            p.findtext("Value")
+            for p in section.find("Info/PropertyArray")
+            if p.findtext("Key") == "WebCapabilities"
+        )
+        for name, section in sections.items()
+    }
+
+
+class TestSddraftDocument(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "depth_grid.sddraft")
+        shutil.copy(_SAMPLE, self.path)
+
+    def _edit_all(self, doc):
+        doc.configure_capabilities("Map")
+        doc.activate_cache()
+        doc.set_cache_dir("/cloudStores/cache")
+        doc.share("false", "true", "false", "")
+        doc.set_scales("9244648.868618", "9027.977411")
+
+    def test_single_pass(self):
+        doc = SddraftDocument(self.path)
+        self._edit_all(doc)
+        doc.save()
+
+        saved = SddraftDocument(self.path)
+        # The capabilities of the service are set, the extensions keep their own
+        self.assertEqual(
+            _capabilities(self.path),
+            {
+                "MapServer": "Map",
+                "KmlServer": "SingleImage,SeparateImages,Vectors",
+                "WMSServer": "GetCapabilities,GetMap,GetFeatureInfo,GetStyles,"
+                "GetLegendGraphic,GetSchemaExtension",
+            },
+        )
+        self.assertEqual(saved.get("isCached"), "true")
+        self.assertEqual(saved.get("cacheDir"), "/cloudStores/cache")
+        self.assertEqual(saved.get("minScale"), "9244648.868618")
+        self.assertEqual(saved.item_info.findtext("MaxScale"), "9027.977411")
+        self.assertEqual(
+            [v.text for v in saved.properties["PackageIsPublic"]], ["true"]
+        )
+        self.assertEqual(
+            [v.text for v in saved.properties["PackageUnderMyOrg"]], ["false"]
+        )
+
+    def test_missing_capabilities(self):
+        doc = SddraftDocument(self.path)
+        info = doc.root.find(".//SVCConfiguration/Definition")
+        info.remove(info.find("Info"))
+        doc.save()
+        with self.assertRaises(ValueError):
+            SddraftDocument(self.path).configure_capabilities("Map")
+
+    def test_namespaces_are_preserved(self):
+        doc = SddraftDocument(self.path)
+        doc.save()
+        root = DOM.parse(self.path).documentElement
+        self.assertEqual(root.tagName, "SVCManifest")
+        for prefix in ("xsi", "xs", "typens"):
+            self.assertTrue(root.hasAttribute(f"xmlns:{prefix}"))
+        self.assertEqual(root.getAttribute("xsi:type"), "typens:SVCManifest")
+
+    def test_wrappers_match_document(self):
+        configure_mapserver_capabilities(self.path, "Map")
+        activate_cache(self.path)
+        change_cache_dir("/cloudStores/cache", self.path)
+        share_options("false", "true", "false", self.path, "")
+        edit_scales(self.path, "9244648.868618", "9027.977411")
+        self.assertEqual(_capabilities(self.path)["MapServer"], "Map")
+
+        other = os.path.join(os.path.dirname(self.path), "single.sddraft")
+        shutil.copy(_SAMPLE, other)
+        doc = SddraftDocument(other)
+        self._edit_all(doc)
+        doc.save()
+        with open(self.path, "rb") as a, open(other, "rb") as b:
+            self.assertEqual(a.read(), b.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
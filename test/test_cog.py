@@ -0,0 +1,58 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+try:
+    import rasterio
+    from rasterio.transform import from_origin
+    from utils.raster_pipeline.cog import convert_to_cog, overview_factors
+except ImportError:
+    rasterio = None
+
+_SCALES = "9244648.868618;4622324.434309;2311162.217155;1155581.108577;577790.554289;288895.277144;144447.638572;72223.819286;36111.909643;18055.954822;9027.977411".split(
+    ";"
+)
+
+
+@unittest.skipUnless(rasterio, "rasterio is not installed")
+class TestCog(unittest.TestCase):
+    def test_overview_factors(self):
+        # 2.39 m/px is the largest cache scale, a 2.4 m raster needs no overview there
+        self.assertEqual(
+            overview_factors(2.4, _SCALES, (100000, 100000)),
+            [2, 4, 8, 16, 32, 64, 128, 256],
+        )
+        self.assertEqual(overview_factors(10, _SCALES, (4096, 4096)), [2, 4, 8, 16])
+
+    def test_convert(self):
+        folder = tempfile.mkdtemp()
+        src_path = os.path.join(folder, "depth.tif")
+        data = np.random.default_rng(0).uniform(0, 20, (2048, 2048)).astype("float32")
+        with rasterio.open(
+            src_path,
+            "w",
+            driver="GTiff",
+            width=2048,
+            height=2048,
+            count=1,
+            dtype="float32",
+            crs="EPSG:3857",
+            transform=from_origin(-10000000, 3500000, 10, 10),
+            nodata=-9999,
+        ) as dst:
+            dst.write(data, 1)
+        dst_path = os.path.join(folder, "depth_cog.tif")
+        convert_to_cog(src_path, dst_path, _SCALES, block_size=256)
+        with rasterio.open(dst_path) as cog:
+            self.assertEqual(cog.overviews(1), [2, 4, 8])
+            self.assertEqual(cog.block_shapes[0], (256, 256))
+            np.testing.assert_array_equal(cog.read(1), data)
+
+
+if __name__ == "__main__":
+    unittest.main()
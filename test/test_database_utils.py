@@ -0,0 +1,38 @@
+import unittest
+from unittest.mock import patch
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import StaticPool
+
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from utils import database_utils
+from utils.database_utils import get_table, clear_table_cache
+
+
+class TestGetTable(unittest.TestCase):
+    def setUp(self):
+        clear_table_cache()
+        self.engine = create_engine("sqlite://", poolclass=StaticPool)
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    "CREATE TABLE reports (region_id int, storm_id int, boundary_type text, aws_path text)"
+                )
+            )
+
+    def test_table_is_reflected_once(self):
+        with patch.object(
+            database_utils, "Table", wraps=database_utils.Table
+        ) as mock_table:
+            first = get_table(self.engine, "reports")
+            second = get_table(self.engine, "reports")
+        self.assertIs(first, second)
+        self.assertEqual(mock_table.call_count, 1)
+        self.assertIn("aws_path", first.c)
+
+
+if __name__ == "__main__":
+    unittest.main()
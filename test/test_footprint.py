@@ -0,0 +1,75 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from utils.raster_pipeline.footprint import (  # noqa: E402
+    compute_footprint,
+    load_footprint_index,
+)
+
+try:
+    import rasterio
+    from rasterio.transform import from_origin
+    from shapely.geometry import Point
+except ImportError:
+    rasterio = None
+
+
+@unittest.skipUnless(rasterio, "rasterio is not installed")
+class TestComputeFootprint(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "depth.tif")
+        data = np.full((1000, 1000), -9999, dtype="float32")
+        # Two flooded areas, one of them crossing the windows of the test
+        data[100:300, 100:300] = 1.0
+        data[600:900, 452:700] = 2.0
+        # A single flooded pixel is kept by the cell reduction
+        data[990, 10] = 0.5
+        with rasterio.open(
+            self.path,
+            "w",
+            driver="GTiff",
+            width=1000,
+            height=1000,
+            count=1,
+            dtype="float32",
+            crs="EPSG:3857",
+            transform=from_origin(0, 10000, 10, 10),
+            nodata=-9999,
+        ) as ds:
+            ds.write(data, 1)
+
+    def test_footprint(self):
+        footprint = compute_footprint(self.path, factor=4, window_size=512)
+        geometry = footprint["geometry"]
+        self.assertEqual(footprint["epsg"], 3857)
+        self.assertEqual(footprint["bounds"], (0.0, 0.0, 10000.0, 10000.0))
+        self.assertEqual(footprint["valid_pixels"], 200 * 200 + 300 * 248 + 1)
+        self.assertEqual(geometry.geom_type, "MultiPolygon")
+        self.assertEqual(len(geometry.geoms), 3)
+        # Cells are aligned with the areas, the footprint matches them
+        self.assertAlmostEqual(geometry.area, (200 * 200 + 300 * 248 + 16) * 100)
+        self.assertTrue(geometry.contains(Point(5750, 2500)))
+        self.assertFalse(geometry.contains(Point(5000, 5000)))
+
+    def test_empty_raster(self):
+        with rasterio.open(self.path, "r+") as ds:
+            ds.write(np.full((1000, 1000), -9999, dtype="float32"), 1)
+        footprint = compute_footprint(self.path)
+        self.assertTrue(footprint["geometry"].is_empty)
+        self.assertEqual(footprint["valid_pixels"], 0)
+
+
+class TestLoadFootprintIndex(unittest.TestCase):
+    def test_not_configured(self):
+        self.assertIsNone(load_footprint_index({}))
+        self.assertIsNone(load_footprint_index({"database": {"tables": []}}))
+
+
+if __name__ == "__main__":
+    unittest.main()
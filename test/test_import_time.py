@@ -0,0 +1,79 @@
+import unittest
+import os
+import subprocess
+import sys
+import tempfile
+
+_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+# Modules the entry points must not import before they know there is work to do
+_HEAVY = (
+    "arcpy",
+    "arcgis",
+    "geopandas",
+    "pandas",
+    "sqlalchemy",
+    "psycopg2",
+    "rasterio",
+    "shapely",
+)
+# Cumulative import time of the packages in microseconds
+_BUDGET_US = 200000
+
+
+def _import_times(statement: str) -> tuple:
+    """Run an import statement with -X importtime in a clean interpreter
+    returns: tuple - cumulative time of the modules imported by import statements and
+                     names of all the loaded modules (importlib imports are not timed)"""
+    with tempfile.TemporaryDirectory() as tmp:
+        # The entry points write their log file in the working directory
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                "-c",
+                f"{statement}\nimport sys\nprint(*sys.modules)",
+            ],
+            cwd=tmp,
+            env={**os.environ, "PYTHONPATH": os.pathsep.join([_ROOT, f"{_ROOT}/src"])},
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative)
+    return times, set(result.stdout.split())
+
+
+class TestImportTime(unittest.TestCase):
+    def assertLight(self, modules):
+        heavy = sorted(name for name in modules if name.split(".")[0] in _HEAVY)
+        self.assertEqual(heavy, [])
+
+    def test_packages(self):
+        times, modules = _import_times(
+            "import utils, utils.raster_pipeline, utils.vector_pipeline"
+        )
+        self.assertLight(modules)
+        total = sum(
+            times[name]
+            for name in ("utils", "utils.raster_pipeline", "utils.vector_pipeline")
+        )
+        self.assertLess(total, _BUDGET_US)
+
+    def test_entry_points(self):
+        self.assertLight(_import_times("import main_raster, main_vector")[1])
+
+    def test_names_resolve_on_first_use(self):
+        _, modules = _import_times("from utils.raster_pipeline import StagedPipeline")
+        self.assertIn("utils.raster_pipeline.pipeline", modules)
+        self.assertNotIn("utils.raster_pipeline.add", modules)
+        self.assertLight(modules)
+
+
+if __name__ == "__main__":
+    unittest.main()
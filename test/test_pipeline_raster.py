@@ -1,7 +1,8 @@
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 from moto import mock_s3
 import boto3
+import tempfile
 import logging
 
 import sys
@@ -9,12 +10,24 @@ import os
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
 
+import main_raster
 from main_raster import main
 
 
 class TestMainRaster(unittest.TestCase):
     @mock_s3
     def setUp(self):
+        # The files written by the run go to a temporary folder
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        paths = patch.multiple(
+            main_raster,
+            _TEMP_PATH=os.path.join(folder.name, "temp", ""),
+            _CACHE_PATH=os.path.join(folder.name, "raster_cache", ""),
+            _SIGNATURES_PATH=os.path.join(folder.name, "raster_signatures", ""),
+        )
+        paths.start()
+        self.addCleanup(paths.stop)
         # Set up the mock S3 environment
         self.s3 = boto3.client("s3", region_name="us-east-1")
         self.bucket_name = "lwi-common"
@@ -56,5 +69,44 @@ class TestMainRaster(unittest.TestCase):
             self.assertIn("INFO:root:Removed elements: []", log.output)
 
 
+class TestLoadStores(unittest.TestCase):
+    def test_stores_of_the_configuration(self):
+        config = os.path.join(tempfile.mkdtemp(), "credentials.yaml")
+        with open(config, "w") as f:
+            f.write(
+                "database: {host: h, port: 5432, user: u, password: p, database: d, "
+                "tables: [{name: result}, {name: storm}, {name: si_source}, "
+                "{name: regions}], raster: [{name: fp, type: footprints}, "
+                "{name: st, type: statistics}]}\n"
+            )
+        with patch("utils.raster_pipeline.footprint.create_engine"), patch(
+            "utils.raster_pipeline.stats.create_engine"
+        ):
+            footprints, statistics, region_table = main_raster.load_stores(config)
+        self.assertEqual((footprints.table, statistics.table), ("fp", "st"))
+        self.assertEqual(region_table, "regions")
+        with self.assertLogs(level="INFO"):
+            self.assertEqual(main_raster.load_stores("missing.yaml"), (None,) * 3)
+
+    @patch("main_raster.S3ObjectMonitor")
+    def test_rasters_share_the_stores(self, MockS3ObjectMonitor):
+        MockS3ObjectMonitor.return_value.monitor_objects.return_value = {
+            "added": [{"Bucket": "lwi-common", "Key": f"d{i}.tif"} for i in range(2)],
+            "removed": [],
+        }
+        stores = (MagicMock(), MagicMock(), "regions")
+        with patch("main_raster.load_stores", return_value=stores) as load, patch(
+            "utils.raster_pipeline.AddData"
+        ) as add, patch("utils.raster_pipeline.publishing_pipeline"), patch(
+            "utils.raster_pipeline.WebmapChanges"
+        ):
+            main()
+        load.assert_called_once_with()
+        for call in add.call_args_list:
+            self.assertIs(call.kwargs["footprints"], stores[0])
+            self.assertIs(call.kwargs["statistics"], stores[1])
+        self.assertEqual(add.call_count, 2)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -2,6 +2,7 @@ import unittest
 from unittest.mock import patch, MagicMock
 from moto import mock_s3
 import boto3
+import tempfile
 
 # Import the script to be tested
 import sys
@@ -9,12 +10,23 @@ import os
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
 
+import main_vector
 from main_vector import main
 
 
 class TestMainVector(unittest.TestCase):
     @mock_s3
     def setUp(self):
+        # The files written by the run go to a temporary folder
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        quarantine = patch.object(
+            main_vector,
+            "_QUARANTINE_FILE",
+            os.path.join(folder.name, "lwi_quarantine.json"),
+        )
+        quarantine.start()
+        self.addCleanup(quarantine.stop)
         # Set up the mock S3 environment
         self.s3 = boto3.client("s3", region_name="us-east-1")
         self.bucket_name = "lwi-common"
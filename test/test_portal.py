@@ -0,0 +1,135 @@
+import unittest
+from unittest.mock import MagicMock, patch
+import tempfile
+import threading
+import yaml
+
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from utils.raster_pipeline import AddData, DeleteData  # noqa: E402
+from utils.raster_pipeline import portal  # noqa: E402
+from utils.raster_pipeline.portal import (  # noqa: E402
+    PortalSession,
+    clear_sessions,
+    get_session,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestPortalSession(unittest.TestCase):
+    def setUp(self):
+        clear_sessions()
+        self.sign_in = MagicMock(side_effect=lambda *args: {"token": "t"})
+        self.gis_factory = MagicMock()
+
+    def tearDown(self):
+        clear_sessions()
+
+    def test_token_is_renewed_before_expiry(self):
+        clock = FakeClock()
+        session = PortalSession(
+            "https://portal",
+            "user",
+            "pass",
+            sign_in=self.sign_in,
+            token_lifetime=3600,
+            refresh_margin=300,
+            clock=clock,
+        )
+        session.connection()
+        clock.now += 3000
+        session.connection()
+        self.assertEqual(self.sign_in.call_count, 1)
+        clock.now += 400
+        session.connection()
+        self.assertEqual(self.sign_in.call_count, 2)
+
+    def test_portal_expiration_in_milliseconds(self):
+        clock = FakeClock()
+        sign_in = MagicMock(return_value={"token": "t", "expires": 2_000_000})
+        session = PortalSession(
+            "https://portal", "user", "pass", sign_in=sign_in, clock=clock
+        )
+        self.assertEqual(session._expiration({"expires": 2_000_000_000_000}), 2e9)
+        session.connection()
+        clock.now = 2_000_000 - 200
+        session.connection()
+        self.assertEqual(sign_in.call_count, 2)
+
+    def test_one_session_per_process(self):
+        sessions = []
+
+        def worker():
+            session = get_session(
+                "https://portal",
+                "user",
+                "pass",
+                sign_in=self.sign_in,
+                gis_factory=self.gis_factory,
+            )
+            session.connection()
+            session.get_gis()
+            sessions.append(session)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len({id(s) for s in sessions}), 1)
+        self.assertEqual(self.sign_in.call_count, 1)
+        self.assertEqual(self.gis_factory.call_count, 1)
+
+    def test_items_share_the_sign_in(self):
+        config = os.path.join(tempfile.mkdtemp(), "credentials.yaml")
+        with open(config, "w") as f:
+            yaml.safe_dump(
+                {
+                    "portal": {
+                        "portalUrl": "https://portal",
+                        "serverUrl": "https://server",
+                        "serverFolder": "LWI",
+                        "username": "user",
+                        "password": "pass",
+                        "webmap": "GoConsequence",
+                    }
+                },
+                f,
+            )
+        with patch.object(portal, "_arcpy_sign_in", self.sign_in), patch.object(
+            portal, "_arcgis_gis", self.gis_factory
+        ):
+            items = [
+                AddData(
+                    path={"Bucket": "lwi-region1", "Key": f"depth_{i}.tif"},
+                    temp_path=tempfile.mkdtemp() + "/",
+                    s3=MagicMock(),
+                    config_file=config,
+                )
+                for i in range(20)
+            ] + [
+                DeleteData(
+                    path={"Bucket": "lwi-region1", "Key": f"old_{i}.tif"},
+                    s3=MagicMock(),
+                    config_file=config,
+                )
+                for i in range(20)
+            ]
+            for item in items:
+                item.portal.get_gis()
+        self.assertEqual(self.sign_in.call_count, 1)
+        self.assertEqual(self.gis_factory.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+import unittest
+import json
+import os
+import tempfile
+import numpy as np
+
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from utils.raster_pipeline.quantize import (  # noqa: E402
+    _classes,
+    decode,
+    encode,
+    quantization_plan,
+    write_symbology,
+)
+from utils.raster_pipeline.tiles import load_colormap  # noqa: E402
+
+try:
+    import rasterio
+    from rasterio.transform import from_origin
+    from utils.raster_pipeline.quantize import quantize_raster
+    from utils.raster_pipeline.stats import compute_statistics
+except ImportError:
+    rasterio = None
+
+_LYRX = os.path.join(
+    os.path.dirname(__file__), "..", "static", "arcgis_resources", "raster.lyrx"
+)
+_BOUNDS = [1, 2, 3, 4, 5, 7, 10, 13, 16, 21, 500]
+_MINIMUM = 0.000999
+
+
+def _depths():
+    rng = np.random.default_rng(3)
+    values = np.concatenate(
+        [
+            rng.uniform(0, 30, 20000),
+            rng.uniform(20, 600, 2000),
+            np.array(_BOUNDS, dtype=float),
+            np.nextafter(np.array(_BOUNDS, dtype=float), np.inf),
+            [0.0, _MINIMUM, np.nextafter(_MINIMUM, 0), -1.0],
+        ]
+    )
+    return values.astype(np.float32)
+
+
+class TestQuantizationPlan(unittest.TestCase):
+    def test_uint16_encodes_every_break(self):
+        plan = quantization_plan(_BOUNDS, _MINIMUM, "uint16")
+        self.assertTrue(plan["exact"])
+        self.assertEqual(plan["factor"], 131)
+        self.assertEqual(plan["code_bounds"], [b * 131 for b in _BOUNDS])
+        self.assertEqual(plan["nodata"], 65535)
+
+    def test_uint8_keeps_the_last_class(self):
+        plan = quantization_plan(_BOUNDS, _MINIMUM, "uint8")
+        self.assertFalse(plan["exact"])
+        self.assertEqual(plan["factor"], 12)
+        self.assertEqual(plan["code_bounds"][-2:], [252, 253])
+
+    def test_classes_do_not_change(self):
+        depths = _depths().astype(np.float64)
+        for dtype in ("uint16", "uint8"):
+            plan = quantization_plan(_BOUNDS, _MINIMUM, dtype)
+            codes = encode(depths, plan)
+            np.testing.assert_array_equal(
+                _classes(depths, _BOUNDS, _MINIMUM),
+                _classes(codes.astype(float), plan["code_bounds"], 1),
+            )
+
+    def test_error_is_below_the_scale(self):
+        plan = quantization_plan(_BOUNDS, _MINIMUM, "uint16")
+        depths = np.linspace(_MINIMUM, 500, 10000)
+        error = decode(encode(depths, plan), plan) - depths
+        self.assertGreaterEqual(error.min(), 0)
+        self.assertLess(error.max(), plan["scale"])
+
+    def test_masked_values_are_nodata(self):
+        plan = quantization_plan(_BOUNDS, _MINIMUM, "uint16")
+        values = np.ma.masked_array([1.0, 2.0], mask=[False, True])
+        self.assertEqual(encode(values, plan).tolist(), [131, 65535])
+
+    def test_rescaled_symbology(self):
+        plan = quantization_plan(_BOUNDS, _MINIMUM, "uint16")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = write_symbology(_LYRX, os.path.join(tmp, "q.lyrx"), plan)
+            original, rescaled = load_colormap(_LYRX), load_colormap(path)
+            self.assertEqual(rescaled["upper_bounds"].tolist(), plan["code_bounds"])
+            np.testing.assert_array_equal(rescaled["colors"], original["colors"])
+            with open(path) as f:
+                self.assertIn("layerDefinitions", json.load(f))
+
+
+@unittest.skipUnless(rasterio, "rasterio is not installed")
+class TestQuantizeRaster(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, "depth.tif")
+        data = _depths()[:22000].reshape(110, 200)
+        data[:10, :10] = -9999
+        with rasterio.open(
+            self.src,
+            "w",
+            driver="GTiff",
+            height=110,
+            width=200,
+            count=1,
+            dtype="float32",
+            crs="EPSG:3857",
+            transform=from_origin(-10000000, 3500000, 10, 10),
+            nodata=-9999,
+        ) as ds:
+            ds.write(data, 1)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_report_and_statistics(self):
+        plan = quantization_plan(_BOUNDS, _MINIMUM, "uint16")
+        dst = os.path.join(self.tmp.name, "depth_q.tif")
+        report = quantize_raster(self.src, dst, plan, window_size=64)
+        self.assertEqual(report["class_mismatches"], 0)
+        self.assertEqual(report["pixels"], 22000 - 100)
+        self.assertLess(report["max_error"], plan["scale"])
+        self.assertLess(os.path.getsize(dst), os.path.getsize(self.src))
+        with rasterio.open(dst) as ds:
+            self.assertEqual(ds.dtypes[0], "uint16")
+            self.assertAlmostEqual(ds.scales[0], plan["scale"])
+        # The statistics of the encoded raster keep the class histogram
+        before = compute_statistics(self.src, _BOUNDS, _MINIMUM)["all"]
+        after = compute_statistics(dst, _BOUNDS, _MINIMUM)["all"]
+        self.assertEqual(before["histogram"], after["histogram"])
+        self.assertEqual(before["flooded_pixels"], after["flooded_pixels"])
+
+
+if __name__ == "__main__":
+    unittest.main()
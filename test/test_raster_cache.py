@@ -0,0 +1,103 @@
+import unittest
+import os
+import tempfile
+from moto import mock_s3
+import boto3
+
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from utils.raster_pipeline import RasterCache  # noqa: E402
+
+
+class TestRasterCache(unittest.TestCase):
+    def setUp(self):
+        self.mock = mock_s3()
+        self.mock.start()
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.bucket_name = "lwi-region1"
+        self.s3.create_bucket(Bucket=self.bucket_name)
+        self.cache_path = tempfile.mkdtemp()
+        self.downloads = []
+        download_file = self.s3.download_file
+
+        def counting_download(*args, **kwargs):
+            self.downloads.append(args[1])
+            return download_file(*args, **kwargs)
+
+        self.s3.download_file = counting_download
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def put(self, key, size):
+        self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=os.urandom(size))
+
+    def test_hits_do_not_download(self):
+        self.put("depth/a.tif", 100)
+        cache = RasterCache(self.cache_path, max_bytes=1000)
+        first = cache.fetch(self.s3, self.bucket_name, "depth/a.tif")
+        second = cache.fetch(self.s3, self.bucket_name, "depth/a.tif")
+        self.assertEqual(first, second)
+        self.assertEqual(self.downloads, ["depth/a.tif"])
+
+    def test_new_etag_is_downloaded(self):
+        self.put("depth/a.tif", 100)
+        cache = RasterCache(self.cache_path, max_bytes=1000)
+        first = cache.fetch(self.s3, self.bucket_name, "depth/a.tif")
+        self.put("depth/a.tif", 100)
+        second = cache.fetch(self.s3, self.bucket_name, "depth/a.tif")
+        self.assertNotEqual(first, second)
+        self.assertEqual(len(self.downloads), 2)
+
+    def test_least_recently_used_is_evicted(self):
+        for name in ("a", "b", "c"):
+            self.put(f"depth/{name}.tif", 400)
+        cache = RasterCache(self.cache_path, max_bytes=1000)
+        a = cache.fetch(self.s3, self.bucket_name, "depth/a.tif")
+        b = cache.fetch(self.s3, self.bucket_name, "depth/b.tif")
+        os.utime(a, (1, 1))
+        os.utime(b, (2, 2))
+        cache.fetch(self.s3, self.bucket_name, "depth/a.tif")
+        c = cache.fetch(self.s3, self.bucket_name, "depth/c.tif")
+        self.assertTrue(os.path.exists(a))
+        self.assertFalse(os.path.exists(b))
+        self.assertTrue(os.path.exists(c))
+
+    def test_link_to_working_folder(self):
+        self.put("depth/a.tif", 100)
+        cache = RasterCache(self.cache_path, max_bytes=1000)
+        entry = cache.fetch(self.s3, self.bucket_name, "depth/a.tif")
+        destination = os.path.join(tempfile.mkdtemp(), "a.tif")
+        cache.link(entry, destination)
+        with open(entry, "rb") as f1, open(destination, "rb") as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_entry_is_pinned_until_linked(self):
+        for name in ("a", "b", "c"):
+            self.put(f"depth/{name}.tif", 400)
+        cache = RasterCache(self.cache_path, max_bytes=1000)
+        a = cache.fetch(self.s3, self.bucket_name, "depth/a.tif")
+        b = cache.fetch(self.s3, self.bucket_name, "depth/b.tif")
+        os.utime(a, (1, 1))
+        os.utime(b, (2, 2))
+        link = cache.link
+
+        def concurrent_fetch(entry, destination):
+            # Another item misses between the fetch and the link of a
+            cache.fetch(self.s3, self.bucket_name, "depth/c.tif")
+            self.assertTrue(os.path.exists(entry))
+            return link(entry, destination)
+
+        cache.link = concurrent_fetch
+        destination = os.path.join(tempfile.mkdtemp(), "a.tif")
+        cache.fetch(self.s3, self.bucket_name, "depth/a.tif", destination)
+        self.assertTrue(os.path.exists(destination))
+        # The least recently used entry that is not pinned is evicted instead
+        self.assertFalse(os.path.exists(b))
+        self.assertEqual(cache._pinned, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from utils.raster_pipeline.diff import (  # noqa: E402
+    SignatureStore,
+    changed_extents,
+    cluster_windows,
+    window_signatures,
+)
+
+try:
+    import rasterio
+    from rasterio.transform import from_origin
+except ImportError:
+    rasterio = None
+
+
+def _signatures(windows, transform=(10, 0, 1000, 0, -10, 5000)):
+    return {
+        "crs": "EPSG:3857",
+        "transform": list(transform),
+        "shape": [1200, 1200],
+        "block_size": 512,
+        "windows": windows,
+    }
+
+
+class TestChangedExtents(unittest.TestCase):
+    def test_cluster_windows(self):
+        windows = {(0, 0), (0, 1), (1, 2), (5, 5)}
+        self.assertEqual(cluster_windows(windows), [(0, 0, 1, 2), (5, 5, 5, 5)])
+
+    def test_changed_extents(self):
+        previous = _signatures({"0_0": "a", "0_1": "b", "2_2": "c"})
+        current = _signatures({"0_0": "a", "0_1": "b", "2_2": "x"})
+        self.assertEqual(changed_extents(previous, previous), [])
+        # The last window is clipped to the 1200 pixels of the raster
+        self.assertEqual(
+            changed_extents(previous, current), [(11240.0, -7000.0, 13000.0, -5240.0)]
+        )
+
+    def test_grid_mismatch_needs_full_cache(self):
+        previous = _signatures({"0_0": "a"})
+        moved = _signatures({"0_0": "a"}, transform=(10, 0, 1010, 0, -10, 5000))
+        self.assertIsNone(changed_extents(None, previous))
+        self.assertIsNone(changed_extents(previous, moved))
+
+    def test_store(self):
+        store = SignatureStore(tempfile.mkdtemp())
+        self.assertIsNone(store.load("depth"))
+        store.save("depth", _signatures({"0_0": "a"}))
+        self.assertEqual(store.load("depth")["windows"], {"0_0": "a"})
+        store.remove("depth")
+        self.assertIsNone(store.load("depth"))
+
+
+@unittest.skipUnless(rasterio, "rasterio is not installed")
+class TestWindowSignatures(unittest.TestCase):
+    def _write(self, path, data):
+        with rasterio.open(
+            path,
+            "w",
+            driver="GTiff",
+            width=data.shape[1],
+            height=data.shape[0],
+            count=1,
+            dtype="float32",
+            crs="EPSG:3857",
+            transform=from_origin(0, 10240, 10, 10),
+            nodata=-9999,
+        ) as ds:
+            ds.write(data, 1)
+
+    def test_only_corrected_area_changes(self):
+        folder = tempfile.mkdtemp()
+        data = np.random.default_rng(0).uniform(0, 5, (1024, 1024)).astype("float32")
+        self._write(os.path.join(folder, "old.tif"), data)
+        data[600:620, 700:710] += 1
+        self._write(os.path.join(folder, "new.tif"), data)
+        old = window_signatures(os.path.join(folder, "old.tif"), block_size=256)
+        new = window_signatures(os.path.join(folder, "new.tif"), block_size=256)
+        self.assertEqual(len(new["windows"]), 16)
+        self.assertEqual(changed_extents(old, new), [(5120.0, 2560.0, 7680.0, 5120.0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,245 @@
+import gc
+import unittest
+from unittest.mock import MagicMock, patch
+import tempfile
+import threading
+import time
+
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from utils.raster_pipeline import (  # noqa: E402
+    AddData,
+    DiskAdmission,
+    Stage,
+    StagedPipeline,
+    publishing_pipeline,
+)
+
+_LATENCY = 0.05
+
+
+class ConcurrencyProbe:
+    """Records the maximum number of items inside each stage"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = {}
+        self.maximum = {}
+
+    def stage(self, name, fail_for=None):
+        def func(item):
+            with self.lock:
+                self.current[name] = self.current.get(name, 0) + 1
+                self.maximum[name] = max(self.maximum.get(name, 0), self.current[name])
+            time.sleep(_LATENCY)
+            with self.lock:
+                self.current[name] -= 1
+            if fail_for is not None and item == fail_for:
+                raise RuntimeError(f"{name} failed")
+
+        return func
+
+
+class TestStagedPipeline(unittest.TestCase):
+    def test_stages_overlap(self):
+        probe = ConcurrencyProbe()
+        pipeline = StagedPipeline(
+            [Stage(name, probe.stage(name)) for name in ("a", "b", "c")]
+        )
+        start = time.perf_counter()
+        results = pipeline.run(range(6))
+        elapsed = time.perf_counter() - start
+        self.assertTrue(all(r["ok"] for r in results))
+        # 18 stage runs take 0.9 s in sequence, pipelined they take ~8 latencies
+        self.assertLess(elapsed, 12 * _LATENCY)
+        self.assertEqual(probe.maximum, {"a": 1, "b": 1, "c": 1})
+
+    def test_workers_bound_each_stage(self):
+        probe = ConcurrencyProbe()
+        pipeline = StagedPipeline(
+            [Stage("download", probe.stage("download"), workers=3)], queue_size=10
+        )
+        pipeline.run(range(9))
+        self.assertEqual(probe.maximum["download"], 3)
+
+    def test_failures_are_isolated(self):
+        probe = ConcurrencyProbe()
+        cleaned = []
+        pipeline = StagedPipeline(
+            [
+                Stage("a", probe.stage("a")),
+                Stage("b", probe.stage("b", fail_for=2)),
+                Stage("c", probe.stage("c")),
+            ],
+            cleanup=cleaned.append,
+        )
+        results = pipeline.run(range(4))
+        self.assertEqual([r["ok"] for r in results], [True, True, False, True])
+        self.assertEqual(results[2]["failed_stage"], "b")
+        self.assertNotIn("c", results[2]["times"])
+        self.assertEqual(sorted(cleaned), [0, 1, 2, 3])
+
+
+class TestPublishingPipeline(unittest.TestCase):
+    def test_add_data_items(self):
+        temp_path = tempfile.mkdtemp() + "/"
+        probe = ConcurrencyProbe()
+        stages = {
+            "_download_raster": probe.stage("download"),
+            "_project_raster": probe.stage("reproject"),
+            "create_project": probe.stage("project"),
+            "create_draft": probe.stage("draft"),
+            "publish_raster": probe.stage("publish"),
+            "add_to_webmap": probe.stage("webmap"),
+        }
+        mocks = {
+            name: MagicMock(side_effect=lambda *args, func=func: func(None) or "r.tif")
+            for name, func in stages.items()
+        }
+        with patch.multiple(AddData, **mocks):
+            items = [
+                AddData(
+                    path={"Bucket": "lwi-region1", "Key": f"depth_{i}.tif"},
+                    temp_path=temp_path,
+                    s3=MagicMock(),
+                    config_file="missing.yaml",
+                )
+                for i in range(4)
+            ]
+            # The heap left by the other tests is collected before the clock starts
+            gc.collect()
+            start = time.perf_counter()
+            results = publishing_pipeline({"download": 2}).run(items)
+            elapsed = time.perf_counter() - start
+        self.assertTrue(all(r["ok"] for r in results))
+        self.assertEqual(mocks["add_to_webmap"].call_count, 4)
+        # 24 stage runs take 1.2 s in sequence, the 12 of the arcpy stages share one
+        # thread
+        self.assertLess(elapsed, 18 * _LATENCY)
+
+    def test_arcpy_stages_share_one_thread(self):
+        probe = ConcurrencyProbe()
+        threads = set()
+
+        def stage(name):
+            func = probe.stage("arcpy")
+
+            def run(item):
+                threads.add(threading.current_thread().name)
+                func(item)
+
+            return Stage(name, run, workers=2, arcpy=True)
+
+        with self.assertLogs("utils.raster_pipeline.pipeline", level="WARNING"):
+            stages = [stage("prepare"), stage("publish")]
+        self.assertEqual([s.workers for s in stages], [1, 1])
+        results = StagedPipeline(stages).run(range(4))
+        self.assertTrue(all(r["ok"] for r in results))
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads.pop().startswith("arcpy"))
+        # prepare and publish never run at the same time
+        self.assertEqual(probe.maximum["arcpy"], 1)
+
+
+class TestDiskAdmission(unittest.TestCase):
+    def test_budget_from_free_space(self):
+        usage = MagicMock(return_value=MagicMock(free=100))
+        admission = DiskAdmission("temp/", reserve_bytes=20, disk_usage=usage)
+        self.assertEqual(admission.budget_bytes, 80)
+        self.assertEqual(admission.acquire(10), 40)
+        self.assertEqual(admission.reserved, 40)
+
+    def test_items_wait_for_disk(self):
+        probe = ConcurrencyProbe()
+        admission = DiskAdmission("temp/", expansion=4, budget_bytes=100)
+        pipeline = StagedPipeline(
+            [Stage("download", probe.stage("download"), workers=4)],
+            queue_size=4,
+            admission=admission,
+            footprint=lambda item: 20,
+        )
+        results = pipeline.run(range(6))
+        self.assertTrue(all(r["ok"] for r in results))
+        # 80 bytes per item, only one fits the 100 bytes budget at a time
+        self.assertEqual(probe.maximum["download"], 1)
+        self.assertEqual(admission.reserved, 0)
+
+    def test_oversized_item_runs_alone(self):
+        admission = DiskAdmission("temp/", budget_bytes=10)
+        reserved = admission.acquire(100)
+        self.assertEqual(admission.active, 1)
+        admission.release(reserved)
+        self.assertEqual((admission.reserved, admission.active), (0, 0))
+
+
+class TestScratchFolders(unittest.TestCase):
+    def test_items_use_their_own_folder(self):
+        temp_path = tempfile.mkdtemp() + "/"
+        items = [
+            AddData(
+                path={"Bucket": "lwi-region1", "Key": "depth/depth.tif"},
+                temp_path=temp_path,
+                s3=MagicMock(),
+                config_file="missing.yaml",
+            )
+            for _ in range(2)
+        ]
+        paths = []
+        for item in items:
+            item.s3.download_file.side_effect = lambda b, k, path, Config: open(
+                path, "w"
+            ).close()
+            item.download()
+            paths.append(item.raster_path)
+        self.assertNotEqual(os.path.dirname(paths[0]), os.path.dirname(paths[1]))
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+        items[0].clean_local()
+        self.assertFalse(os.path.exists(os.path.dirname(paths[0])))
+        self.assertTrue(os.path.exists(paths[1]))
+
+
+class TestPublishFailures(unittest.TestCase):
+    def setUp(self):
+        self.item = AddData(
+            path={"Bucket": "lwi-region1", "Key": "depth/depth.tif"},
+            temp_path=tempfile.mkdtemp() + "/",
+            s3=MagicMock(),
+            config_file="missing.yaml",
+            signatures=MagicMock(),
+        )
+        self.item.serverUrl = "https://server/server"
+        self.item.serverFolder = "LWI"
+        self.item.service_name = "depth"
+        self.item.sddraftPath = "depth.sddraft"
+        self.item._changed_extents = MagicMock(return_value=None)
+        self.item.new_signatures = {"0_0": "abc"}
+
+    def test_failed_upload_is_not_cached(self):
+        with patch(
+            "arcpy.server.UploadServiceDefinition", side_effect=RuntimeError
+        ), patch("arcpy.server.ManageMapServerCacheTiles") as cache:
+            with self.assertLogs(level="ERROR"):
+                with self.assertRaises(RuntimeError):
+                    self.item.publish()
+        cache.assert_not_called()
+        self.item.signatures.save.assert_not_called()
+
+    def test_signatures_are_saved_after_the_cache(self):
+        with patch("arcpy.server.UploadServiceDefinition"), patch(
+            "arcpy.server.ManageMapServerCacheTiles", side_effect=RuntimeError
+        ):
+            with self.assertLogs(level="ERROR"):
+                self.assertFalse(self.item.publish_raster())
+        self.item.signatures.save.assert_not_called()
+        with patch("arcpy.server.UploadServiceDefinition"), patch(
+            "arcpy.server.ManageMapServerCacheTiles"
+        ):
+            self.assertTrue(self.item.publish_raster())
+        self.item.signatures.save.assert_called_once_with("depth", {"0_0": "abc"})
+
+
+if __name__ == "__main__":
+    unittest.main()
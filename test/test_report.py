@@ -0,0 +1,181 @@
+import unittest
+from unittest.mock import MagicMock, patch
+import pandas as pd
+from sqlalchemy import text
+
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from postgres_server import create_database, pgserver
+from utils import clear_index_cache, ensure_unique_index
+from utils.report import REPORT_KEY, Report, build_region_reports
+
+
+class TestBuildRegionReports(unittest.TestCase):
+    def setUp(self):
+        self.results = pd.DataFrame(
+            {
+                "name20": ["Block 2", "Block 1", "Block 2", "Block 9"],
+                "geoid20": ["g2", "g1", "g2", "g9"],
+                "boundary_type": ["tract", "tract", "tract", "tract"],
+                "boundary_name": ["T2", "T1", "T2", "T9"],
+                "damage_cat_str": [
+                    "Residential",
+                    "Residential",
+                    "Commercial",
+                    "Residential",
+                ],
+                "si_affected": [2, 1, 3, 4],
+                "total_damage": [200.0, 100.0, 300.0, 400.0],
+                "content_damage": [20.0, 10.0, 30.0, 40.0],
+                "structure_damage": [180.0, 90.0, 270.0, 360.0],
+                "region_id": [1, 1, 1, 1],
+            }
+        )
+        self.at_risk = pd.DataFrame(
+            {
+                "us_block_name": ["Block 1", "Block 2", "Block 2"],
+                "block_code": ["g1", "g2", "g2"],
+                "boundary_type": ["tract", "tract", "tract"],
+                "boundary_name": ["T1", "T2", "T2"],
+                "category": ["Res", "Res", "Com"],
+                "si_at_risk": [10, 20, 30],
+                "total_value_at_risk": [1000.0, 2000.0, 3000.0],
+                "content_value_at_risk": [100.0, 200.0, 300.0],
+                "structure_value_at_risk": [900.0, 1800.0, 2700.0],
+                "region_id": [1, 1, 1],
+            }
+        )
+
+    def test_blocks_followed_by_totals(self):
+        reports = build_region_reports(self.results, self.at_risk)
+        self.assertEqual(list(reports), ["tract"])
+        report = reports["tract"]
+        self.assertEqual(report.columns[2], "tract")
+        self.assertEqual(
+            list(report["Category"]),
+            ["Residential", "Commercial", "Total", "Residential", "Total"],
+        )
+        self.assertEqual(list(report["Block code"]), ["g2", "g2", "g2", "g1", "g1"])
+        self.assertEqual(list(report["Affected structures"]), [2, 3, 5, 1, 1])
+        self.assertEqual(report["Structures at risk"].iloc[2], 50)
+
+    def test_blocks_without_at_risk_data_are_skipped(self):
+        reports = build_region_reports(self.results, self.at_risk)
+        self.assertNotIn("g9", set(reports["tract"]["Block code"]))
+
+
+@unittest.skipUnless(pgserver, "pgserver is not installed")
+class TestReportRegistry(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = create_database()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.dispose()
+
+    def setUp(self):
+        with self.engine.begin() as conn:
+            conn.execute(text("DROP TABLE IF EXISTS reports"))
+            conn.execute(
+                text(
+                    "CREATE TABLE reports (id serial PRIMARY KEY, region_id integer, "
+                    "storm_id integer, boundary_type text, aws_path text)"
+                )
+            )
+        # The registry only needs the database and the bucket of the report
+        self.report = Report.__new__(Report)
+        self.report.engine = self.engine
+        self.report.tables = [{}, {}, {"name": "reports"}]
+        self.report.storm_id = 7
+        self.report.bucket_name = "public"
+        self.report.bucket_region = "us-east-1"
+        clear_index_cache()
+
+    def _migrate(self):
+        with self.engine.begin() as conn:
+            return ensure_unique_index(conn, "reports", REPORT_KEY)
+
+    def _rows(self):
+        with self.engine.connect() as conn:
+            return conn.execute(
+                text(
+                    "SELECT region_id, storm_id, boundary_type FROM reports "
+                    "ORDER BY region_id, boundary_type"
+                )
+            ).all()
+
+    def test_upsert_on_the_index(self):
+        self.assertTrue(self._migrate())
+        self.report._Report__upsert_to_table([(1, "block"), (1, "tract")])
+        self.report._Report__upsert_to_table([(1, "tract"), (2, "tract")])
+        self.assertEqual(
+            self._rows(),
+            [(1, 7, "block"), (1, 7, "tract"), (2, 7, "tract")],
+        )
+
+    def test_duplicated_reports(self):
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    "INSERT INTO reports (region_id, storm_id, boundary_type) "
+                    "VALUES (1, 7, 'tract'), (1, 7, 'tract')"
+                )
+            )
+        # Without the index of the migration, the reports of the batch are replaced
+        self.report._Report__upsert_to_table([(1, "tract"), (2, "tract")])
+        self.assertEqual(self._rows(), [(1, 7, "tract"), (2, 7, "tract")])
+        with self.engine.connect() as conn:
+            indexes = conn.execute(
+                text("SELECT count(*) FROM pg_indexes WHERE tablename = 'reports'")
+            ).scalar()
+        # Only the primary key, the upsert runs no DDL
+        self.assertEqual(indexes, 1)
+
+
+class TestManifest(unittest.TestCase):
+    def test_built_on_first_use(self):
+        report = Report.__new__(Report)
+        report.manifest = None
+        report.s3_client = MagicMock()
+        report.bucket_name = "public"
+        manifest = report.get_manifest()
+        self.assertIs(report.get_manifest(), manifest)
+        self.assertEqual(manifest.bucket, "public")
+
+
+class TestGenerateRegions(unittest.TestCase):
+    def test_failed_upload_does_not_stop_the_others(self):
+        report = Report.__new__(Report)
+        report.storm_id = 7
+        report.max_workers = 2
+        report.manifest = MagicMock()
+        report._Report__upsert_to_table = MagicMock()
+        report._read_at_risk = MagicMock(return_value={1: None, 2: None})
+        report._read_results = MagicMock(
+            return_value=pd.DataFrame({"region_id": [1, 2]})
+        )
+
+        def upload(region_id, boundary_type, df):
+            if region_id == 2 and boundary_type == "tract":
+                raise OSError("connection reset")
+            return {"region_id": region_id, "boundary_type": boundary_type}
+
+        report._upload_report = MagicMock(side_effect=upload)
+        reports = {"block": pd.DataFrame(), "tract": pd.DataFrame()}
+        with patch("utils.report.build_region_reports", return_value=reports):
+            with self.assertLogs("utils.report", level="ERROR"):
+                self.assertFalse(report._generate_regions([1, 2]))
+        registered = [(1, "block"), (1, "tract"), (2, "block")]
+        report._Report__upsert_to_table.assert_called_once_with(registered)
+        entries = report.manifest.update.call_args[0][1]
+        self.assertEqual(
+            [(e["region_id"], e["boundary_type"]) for e in entries], registered
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import json
+from moto import mock_s3
+import boto3
+
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from utils.report_manifest import ReportManifest
+
+
+def entry(region_id, boundary_type, size=10):
+    return {
+        "region_id": region_id,
+        "boundary_type": boundary_type,
+        "key": f"consequence_reports/Storm_7/Region_{region_id}/S7_R{region_id}_B_{boundary_type}.csv",
+        "size": size,
+        "rows": 3,
+        "etag": "abc",
+        "generated": "2024-01-01T00:00:00+00:00",
+    }
+
+
+class TestReportManifest(unittest.TestCase):
+    def setUp(self):
+        self.mock = mock_s3()
+        self.mock.start()
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.bucket_name = "lwi-public"
+        self.s3.create_bucket(Bucket=self.bucket_name)
+        self.manifest = ReportManifest(self.s3, self.bucket_name)
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def read(self, key):
+        body = self.s3.get_object(Bucket=self.bucket_name, Key=key)["Body"]
+        return json.loads(body.read())
+
+    def test_update_merges_entries(self):
+        self.manifest.update(7, [entry(1, "tract"), entry(2, "tract")])
+        self.manifest.update(7, [entry(1, "tract", size=99), entry(1, "block")])
+        manifest = self.read("consequence_reports/Storm_7/manifest.json")
+        keys = [(r["region_id"], r["boundary_type"]) for r in manifest["reports"]]
+        self.assertEqual(keys, [(1, "block"), (1, "tract"), (2, "tract")])
+        self.assertEqual(manifest["reports"][1]["size"], 99)
+        index = self.read("consequence_reports/index.json")
+        self.assertEqual(index["storms"]["7"]["regions"], [1, 2])
+        self.assertEqual(index["storms"]["7"]["reports"], 3)
+
+    def test_remove_regions(self):
+        self.manifest.update(7, [entry(1, "tract"), entry(2, "tract")])
+        self.manifest.remove_regions(7, [1])
+        manifest = self.read("consequence_reports/Storm_7/manifest.json")
+        self.assertEqual([r["region_id"] for r in manifest["reports"]], [2])
+        self.manifest.remove_regions(7, [2])
+        objects = self.s3.list_objects_v2(Bucket=self.bucket_name)["Contents"]
+        self.assertEqual(
+            [o["Key"] for o in objects], ["consequence_reports/index.json"]
+        )
+        self.assertEqual(self.read("consequence_reports/index.json")["storms"], {})
+
+
+if __name__ == "__main__":
+    unittest.main()
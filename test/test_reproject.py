@@ -0,0 +1,108 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+try:
+    import rasterio
+    from rasterio.transform import from_origin
+    from rasterio.warp import reproject, Resampling
+    from utils.raster_pipeline.reproject import (
+        _window_shape,
+        get_epsg,
+        reproject_raster,
+    )
+except ImportError:
+    rasterio = None
+
+
+@unittest.skipUnless(rasterio, "rasterio is not installed")
+class TestReprojectRaster(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.src_path = os.path.join(self.folder, "depth.tif")
+        rng = np.random.default_rng(0)
+        data = rng.uniform(0, 20, (300, 400)).astype("float32")
+        data[:, :120] = -9999
+        with rasterio.open(
+            self.src_path,
+            "w",
+            driver="GTiff",
+            width=400,
+            height=300,
+            count=1,
+            dtype="float32",
+            crs="EPSG:4326",
+            transform=from_origin(-91.5, 30.5, 0.001, 0.001),
+            nodata=-9999,
+        ) as dst:
+            dst.write(data, 1)
+
+    def test_matches_full_warp(self):
+        dst_path = os.path.join(self.folder, "depth_3857.tif")
+        # A tiny budget forces many windows across the threads
+        reproject_raster(
+            self.src_path, dst_path, memory_budget=64 * 1024, block_size=64
+        )
+        self.assertEqual(get_epsg(dst_path), 3857)
+        with rasterio.open(dst_path) as out, rasterio.open(self.src_path) as src:
+            self.assertEqual(out.block_shapes[0], (64, 64))
+            self.assertEqual(out.nodata, -9999)
+            result = out.read(1)
+            expected = np.full(result.shape, -9999, dtype="float32")
+            reproject(
+                src.read(1),
+                expected,
+                src_transform=src.transform,
+                src_crs=src.crs,
+                src_nodata=-9999,
+                dst_transform=out.transform,
+                dst_crs=out.crs,
+                dst_nodata=-9999,
+                resampling=Resampling.nearest,
+            )
+        self.assertGreater(np.mean(result == expected), 0.999)
+
+    def test_source_without_nodata(self):
+        src_path = os.path.join(self.folder, "utm.tif")
+        # A UTM raster is rotated in 3857, the corners of the output are outside of it
+        with rasterio.open(
+            src_path,
+            "w",
+            driver="GTiff",
+            width=200,
+            height=200,
+            count=1,
+            dtype="float32",
+            crs="EPSG:26915",
+            transform=from_origin(600000, 3400000, 100, 100),
+        ) as dst:
+            dst.write(np.ones((200, 200), dtype="float32"), 1)
+        dst_path = os.path.join(self.folder, "utm_3857.tif")
+        with self.assertLogs("utils.raster_pipeline.reproject", level="INFO"):
+            reproject_raster(src_path, dst_path)
+        with rasterio.open(dst_path) as out:
+            self.assertTrue(np.isnan(out.nodata))
+            result = out.read(1)
+        self.assertTrue(np.isnan(result[0, 0]) and np.isnan(result[-1, -1]))
+        self.assertFalse(np.any(result == 0))
+
+    def test_window_shape_fits_the_budget(self):
+        budget = 256 * 1024**2
+        # Full width windows while a row of blocks fits
+        self.assertEqual(
+            _window_shape(4000, 1, "float32", 512, budget, 4), (2048, 4000)
+        )
+        # A row of 512 blocks of a wide raster is over the budget: tile shaped windows
+        rows, cols = _window_shape(200000, 1, "float32", 512, budget, 4)
+        self.assertEqual(rows, 512)
+        self.assertEqual(cols % 512, 0)
+        self.assertLessEqual(2 * 4 * rows * cols * 4, budget)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import gzip
+import io
+from moto import mock_s3
+import boto3
+from botocore.config import Config
+import pandas as pd
+
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from utils.s3_utils import S3MultipartWriter, upload_csv
+
+
+class TestS3Utils(unittest.TestCase):
+    def setUp(self):
+        self.mock = mock_s3()
+        self.mock.start()
+        self.s3 = boto3.client(
+            "s3",
+            region_name="us-east-1",
+            config=Config(request_checksum_calculation="when_required"),
+        )
+        self.bucket_name = "lwi-common"
+        self.s3.create_bucket(Bucket=self.bucket_name)
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def test_multipart_upload(self):
+        data = b"0123456789" * (1024 * 1024)
+        with S3MultipartWriter(
+            self.s3, self.bucket_name, "big.bin", part_size=5 * 1024 * 1024
+        ) as writer:
+            for i in range(0, len(data), 1000):
+                writer.write(data[i : i + 1000])
+        self.assertEqual(writer.size, len(data))
+        body = self.s3.get_object(Bucket=self.bucket_name, Key="big.bin")["Body"]
+        self.assertEqual(body.read(), data)
+
+    def test_failed_upload_is_aborted(self):
+        with self.assertRaises(RuntimeError):
+            with S3MultipartWriter(
+                self.s3, self.bucket_name, "failed.bin", part_size=5 * 1024 * 1024
+            ) as writer:
+                writer.write(b"0" * 6 * 1024 * 1024)
+                raise RuntimeError("rendering failed")
+        uploads = self.s3.list_multipart_uploads(Bucket=self.bucket_name)
+        self.assertNotIn("Uploads", uploads)
+
+    def test_compressed_csv(self):
+        df = pd.DataFrame({"Block code": ["g1", "g2"], "Total damage cost": [1.5, 2]})
+        upload_csv(
+            self.s3,
+            df,
+            self.bucket_name,
+            "report.csv",
+            compress=True,
+            cache_control="max-age=60",
+        )
+        response = self.s3.get_object(Bucket=self.bucket_name, Key="report.csv")
+        self.assertEqual(response["ContentEncoding"], "gzip")
+        self.assertEqual(response["CacheControl"], "max-age=60")
+        self.assertTrue(response["ContentType"].startswith("text/csv"))
+        csv = gzip.decompress(response["Body"].read()).decode()
+        pd.testing.assert_frame_equal(pd.read_csv(io.StringIO(csv)), df)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from utils.raster_pipeline.stats import DepthStatistics  # noqa: E402
+
+try:
+    import rasterio
+    from rasterio.crs import CRS
+    from rasterio.transform import from_origin
+    from shapely.geometry import box
+    from utils.raster_pipeline.stats import compute_statistics, row_pixel_area
+except ImportError:
+    rasterio = None
+
+_BOUNDS = [1, 2, 3, 4, 5, 7, 10, 13, 16, 21, 500]
+_MINIMUM = 0.000999
+
+
+class TestDepthStatistics(unittest.TestCase):
+    def test_matches_direct_computation(self):
+        rng = np.random.default_rng(1)
+        values = rng.uniform(0, 25, 10000)
+        values[:100] = 0
+        zones = rng.integers(0, 3, 10000)
+        stats = DepthStatistics(_BOUNDS, _MINIMUM, zones=3)
+        # Several windows give the same result as one
+        for chunk in np.array_split(np.arange(10000), 7):
+            stats.update(values[chunk], zones[chunk], pixel_area=4.0)
+        for zone in range(3):
+            wet = values[(zones == zone) & (values >= _MINIMUM)]
+            result = stats.result(zone)
+            self.assertEqual(result["valid_pixels"], int((zones == zone).sum()))
+            self.assertEqual(result["flooded_pixels"], wet.size)
+            self.assertAlmostEqual(result["mean_depth"], wet.mean())
+            self.assertEqual(result["max_depth"], wet.max())
+            self.assertAlmostEqual(result["flooded_area"], wet.size * 4.0)
+            expected = np.bincount(
+                np.searchsorted(_BOUNDS, wet, side="left"), minlength=len(_BOUNDS) + 1
+            )
+            self.assertEqual(result["histogram"], expected.tolist())
+
+    def test_dry_zone(self):
+        stats = DepthStatistics(_BOUNDS, _MINIMUM, zones=2)
+        stats.update(np.array([0.0, 1.5]), np.array([0, 1]))
+        self.assertIsNone(stats.result(0)["max_depth"])
+        self.assertEqual(stats.result(1)["histogram"][1], 1)
+
+
+@unittest.skipUnless(rasterio, "rasterio is not installed")
+class TestComputeStatistics(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "depth.tif")
+        self.data = np.full((300, 400), -9999, dtype="float32")
+        self.data[50:150, 0:200] = 2.5
+        self.data[200:250, 300:400] = 12.0
+        with rasterio.open(
+            self.path,
+            "w",
+            driver="GTiff",
+            width=400,
+            height=300,
+            count=1,
+            dtype="float32",
+            crs="EPSG:26915",
+            transform=from_origin(600000, 3400000, 10, 10),
+            nodata=-9999,
+        ) as ds:
+            ds.write(self.data, 1)
+
+    def test_whole_raster_and_zones(self):
+        # The west half of the raster is one region, the east half another
+        zones = [
+            (1, box(600000, 3397000, 602000, 3400000)),
+            (2, box(602000, 3397000, 604000, 3400000)),
+        ]
+        results = compute_statistics(
+            self.path, _BOUNDS, _MINIMUM, zones, window_size=64
+        )
+        self.assertEqual(results["all"]["flooded_pixels"], 100 * 200 + 50 * 100)
+        self.assertEqual(results["all"]["max_depth"], 12.0)
+        self.assertAlmostEqual(results["all"]["flooded_area"], 25000 * 100)
+        self.assertEqual(results["1"]["flooded_pixels"], 100 * 200)
+        self.assertEqual(results["1"]["histogram"][2], 100 * 200)
+        self.assertEqual(results["2"]["max_depth"], 12.0)
+        self.assertEqual(results["2"]["histogram"][7], 50 * 100)
+        self.assertEqual(
+            compute_statistics(self.path, _BOUNDS, _MINIMUM, window_size=4096)["all"],
+            results["all"],
+        )
+
+    def test_mercator_pixel_area(self):
+        transform = from_origin(-10000000, 3503549.84, 10, 10)
+        area = row_pixel_area(transform, CRS.from_epsg(3857), [0])
+        # 3503549.84 m is 30 degrees north, Mercator pixels are 1 / cos(30)^2 too big
+        self.assertAlmostEqual(area[0], 100 * 0.75, places=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
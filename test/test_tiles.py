@@ -0,0 +1,164 @@
+import unittest
+from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sqlite3
+import tempfile
+import numpy as np
+
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+try:
+    import rasterio
+    from rasterio.transform import from_origin
+    from utils.raster_pipeline import tiles
+    from utils.raster_pipeline.tiles import (
+        apply_colormap,
+        load_colormap,
+        ORIGIN,
+        render_tiles,
+        scale_to_zoom,
+        valid_tiles,
+    )
+except ImportError:
+    rasterio = None
+
+_LYRX = os.path.join(
+    os.path.dirname(__file__), "..", "static", "arcgis_resources", "raster.lyrx"
+)
+
+
+@unittest.skipUnless(rasterio, "rasterio is not installed")
+class TestTiles(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.raster = os.path.join(self.folder, "depth.tif")
+        # 10 m pixels near Baton Rouge, only a small patch of the raster is flooded
+        data = np.full((1024, 1024), -9999, dtype="float32")
+        data[100:140, 200:260] = 0.5
+        data[120:140, 230:260] = 12.0
+        with rasterio.open(
+            self.raster,
+            "w",
+            driver="GTiff",
+            width=1024,
+            height=1024,
+            count=1,
+            dtype="float32",
+            crs="EPSG:3857",
+            transform=from_origin(-10150000, 3570000, 10, 10),
+            nodata=-9999,
+            tiled=True,
+            blockxsize=256,
+            blockysize=256,
+        ) as ds:
+            ds.write(data, 1)
+
+    def test_colormap(self):
+        colormap = load_colormap(_LYRX)
+        self.assertEqual(len(colormap["upper_bounds"]), len(colormap["colors"]))
+        self.assertEqual(colormap["colors"][0].tolist(), [115, 141, 151, 255])
+        data = np.ma.masked_values(np.array([[0.0, 0.5, 12.0, -9999.0]]), -9999.0)
+        rgba = apply_colormap(data, colormap)
+        # Below the minimum break and nodata are transparent
+        self.assertEqual(rgba[0, :, 3].tolist(), [0, 255, 255, 0])
+        self.assertEqual(rgba[0, 1].tolist(), colormap["colors"][0].tolist())
+        self.assertEqual(rgba[0, 2].tolist(), colormap["colors"][7].tolist())
+
+    def test_scale_to_zoom(self):
+        self.assertEqual(scale_to_zoom(9244648.868618), 6)
+        self.assertEqual(scale_to_zoom(9027.977411), 16)
+
+    def test_valid_tiles(self):
+        with rasterio.open(self.raster) as ds:
+            rows, cols = np.nonzero(ds.read_masks(1))
+            xs, ys = rasterio.transform.xy(ds.transform, rows, cols)
+        for zoom in (13, 16, 18):
+            size = 2 * ORIGIN / 2**zoom
+            expected = set(
+                zip(
+                    ((np.asarray(xs) + ORIGIN) // size).astype(int).tolist(),
+                    ((ORIGIN - np.asarray(ys)) // size).astype(int).tolist(),
+                )
+            )
+            self.assertEqual(valid_tiles(self.raster, zoom), expected)
+
+    def test_sparse_directory(self):
+        output = os.path.join(self.folder, "tiles")
+        written = render_tiles(
+            self.raster, output, [72223.819286, 9027.977411], _LYRX, processes=2
+        )
+        files = [
+            os.path.join(root, f) for root, _, names in os.walk(output) for f in names
+        ]
+        self.assertEqual(written, len(files))
+        # The 10 km raster covers about 300 tiles at zoom 16, the patch only a few
+        self.assertLess(written, 10)
+        self.assertTrue(any(f"{os.sep}13{os.sep}" in f for f in files))
+        for path in files:
+            with rasterio.open(path) as png:
+                self.assertEqual(png.count, 4)
+                self.assertTrue(png.read(4).any())
+
+    def test_mbtiles(self):
+        output = os.path.join(self.folder, "depth.mbtiles")
+        written = render_tiles(self.raster, output, [9027.977411], _LYRX, processes=1)
+        connection = sqlite3.connect(output)
+        rows = connection.execute(
+            "SELECT zoom_level, tile_column, tile_row FROM tiles"
+        ).fetchall()
+        metadata = dict(connection.execute("SELECT name, value FROM metadata"))
+        connection.close()
+        self.assertEqual(len(rows), written)
+        self.assertEqual(metadata["format"], "png")
+        self.assertTrue(all(z == 16 for z, _, _ in rows))
+
+    def test_mbtiles_reopened(self):
+        output = os.path.join(self.folder, "depth.mbtiles")
+        # An archive written before the metadata had a unique name
+        connection = sqlite3.connect(output)
+        connection.execute("CREATE TABLE metadata (name text, value text)")
+        connection.executemany(
+            "INSERT INTO metadata VALUES (?, ?)", [("format", "jpg"), ("format", "png")]
+        )
+        connection.commit()
+        connection.close()
+        render_tiles(self.raster, output, [9027.977411], _LYRX, processes=1)
+        render_tiles(self.raster, output, [72223.819286], _LYRX, processes=1)
+        connection = sqlite3.connect(output)
+        metadata = connection.execute("SELECT name, value FROM metadata").fetchall()
+        connection.close()
+        self.assertEqual(len(metadata), 4)
+        self.assertEqual(dict(metadata)["minzoom"], "13")
+
+    def test_bounded_submission(self):
+        pending, largest = [0], [0]
+
+        class Executor(ThreadPoolExecutor):
+            def submit(self, *args):
+                pending[0] += 1
+                largest[0] = max(largest[0], pending[0])
+                future = super().submit(*args)
+                result = future.result
+
+                def collect():
+                    pending[0] -= 1
+                    return result()
+
+                future.result = collect
+                return future
+
+        output = os.path.join(self.folder, "tiles")
+        with patch.object(tiles, "ProcessPoolExecutor", Executor):
+            written = render_tiles(
+                self.raster, output, [9027.977411], _LYRX, processes=1, batch_size=1
+            )
+        self.assertGreater(written, 2)
+        # Two batches per process are in flight at most
+        self.assertEqual(largest[0], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
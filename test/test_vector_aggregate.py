@@ -0,0 +1,157 @@
+import unittest
+from sqlalchemy import text
+
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from postgres_server import create_database, pgserver
+from utils import clear_index_cache, ensure_unique_index
+from utils.vector_pipeline.aggregate import GROUP_COLS, BlockAggregation
+
+# PostGIS is not installed on the test server: the shapes are native points and boxes
+# and ST_Intersects is the box containment (edges included)
+_SCHEMA = """
+CREATE FUNCTION st_intersects(box, point) RETURNS boolean
+    AS 'SELECT $1 @> $2' LANGUAGE sql IMMUTABLE;
+CREATE TABLE result (
+    storm_id integer, path_aws text, damage_cat_str text, total_damage float8,
+    content_da float8, structure float8, shape point
+);
+CREATE TABLE boundaries (
+    region_id integer, boundary_type text, geoid20 text, name20 text,
+    boundary_name text, shape box
+);
+CREATE TABLE summary (
+    storm_id integer, region_id integer, boundary_type text, geoid20 text,
+    name20 text, boundary_name text, damage_cat_str text, si_affected integer,
+    total_damage float8, content_damage float8, structure_damage float8
+);
+INSERT INTO boundaries VALUES
+    (1, 'block', '220010001001', 'Block 1001', 'Block', box '((0,0),(1,1))'),
+    (1, 'block', '220010002001', 'Block 2001', 'Block', box '((1,0),(2,1))'),
+    (1, 'tract', '22001000100', 'Tract 100', 'Tract', box '((0,0),(1,1))'),
+    (1, 'tract', '22001000200', 'Tract 200', 'Tract', box '((1,0),(2,1))');
+"""
+
+
+def _insert(conn, path_aws, points, storm_id=7, damage=1000.0):
+    for x, y in points:
+        conn.execute(
+            text(
+                "INSERT INTO result VALUES (:storm_id, :path_aws, 'Residential', "
+                ":total, :content, :structure, point(:x, :y))"
+            ),
+            {
+                "storm_id": storm_id,
+                "path_aws": path_aws,
+                "total": damage,
+                "content": damage / 4,
+                "structure": damage * 3 / 4,
+                "x": x,
+                "y": y,
+            },
+        )
+
+
+@unittest.skipUnless(pgserver, "pgserver is not installed")
+class TestBlockAggregation(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = create_database()
+        cls.aggregation = BlockAggregation("result", "summary", "boundaries")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.dispose()
+
+    def setUp(self):
+        with self.engine.begin() as conn:
+            conn.execute(
+                text("DROP TABLE IF EXISTS result, boundaries, summary CASCADE")
+            )
+            conn.execute(text("DROP FUNCTION IF EXISTS st_intersects(box, point)"))
+            conn.execute(text(_SCHEMA))
+            ensure_unique_index(conn, "summary", GROUP_COLS)
+        clear_index_cache()
+
+    def _summary(self, conn):
+        columns = ", ".join(GROUP_COLS + ["si_affected", "total_damage"])
+        return conn.execute(
+            text(f"SELECT {columns} FROM summary ORDER BY {columns}")
+        ).all()
+
+    def test_edge_point_is_counted_once(self):
+        with self.engine.begin() as conn:
+            # The second point is on the edge of the two blocks and of the two tracts
+            _insert(conn, "a.shp", [(0.5, 0.5), (1, 0.5), (1.5, 0.5)])
+            self.aggregation.add_file(conn, "a.shp")
+            counts = dict(
+                conn.execute(
+                    text("SELECT geoid20, si_affected FROM summary ORDER BY geoid20")
+                ).all()
+            )
+        self.assertEqual(
+            counts,
+            {
+                "22001000100": 2,
+                "220010001001": 2,
+                "22001000200": 1,
+                "220010002001": 1,
+            },
+        )
+
+    def test_add_then_remove_restores_the_summary(self):
+        with self.engine.begin() as conn:
+            _insert(conn, "a.shp", [(0.5, 0.5), (1.5, 0.5)])
+            self.aggregation.add_file(conn, "a.shp")
+            before = self._summary(conn)
+            # b.shp adds rows to an existing block and creates a new category
+            _insert(conn, "b.shp", [(0.2, 0.2)])
+            _insert(conn, "b.shp", [(1.2, 0.2)], storm_id=8)
+            self.aggregation.add_file(conn, "b.shp")
+            self.assertNotEqual(self._summary(conn), before)
+            self.aggregation.remove_file(conn, "b.shp")
+            conn.execute(text("DELETE FROM result WHERE path_aws = 'b.shp'"))
+            self.assertEqual(self._summary(conn), before)
+            self.assertEqual(self.aggregation.verify(conn), 0)
+
+    def test_summary_without_index_is_refused(self):
+        aggregation = BlockAggregation("result", "unkeyed", "boundaries")
+        with self.engine.begin() as conn:
+            # A summary table the migration did not run on
+            conn.execute(text("CREATE TEMP TABLE unkeyed (LIKE summary)"))
+            _insert(conn, "a.shp", [(0.5, 0.5)])
+            with self.assertRaisesRegex(ValueError, "migrate_database"):
+                aggregation.add_file(conn, "a.shp")
+
+    def test_reload_is_counted_once(self):
+        with self.engine.begin() as conn:
+            _insert(conn, "a.shp", [(0.5, 0.5)])
+            self.aggregation.add_file(conn, "a.shp")
+            # A file appended again, as AddData.save_data does it
+            self.aggregation.remove_file(conn, "a.shp")
+            _insert(conn, "a.shp", [(0.5, 0.5)])
+            self.aggregation.add_file(conn, "a.shp")
+            self.assertEqual(self.aggregation.verify(conn), 0)
+
+    def test_rebuild_matches_verify(self):
+        with self.engine.begin() as conn:
+            _insert(conn, "a.shp", [(0.5, 0.5), (1, 0.5)])
+            _insert(conn, "b.shp", [(1.5, 0.5)], storm_id=8)
+            conn.execute(
+                text(
+                    "INSERT INTO summary VALUES (7, 1, 'block', 'x', 'x', 'x', "
+                    "'Residential', 5, 1, 1, 1)"
+                )
+            )
+            self.assertGreater(self.aggregation.verify(conn), 0)
+            self.aggregation.rebuild(conn, 7)
+            self.assertEqual(self.aggregation.verify(conn, 7), 0)
+            self.aggregation.rebuild(conn)
+            self.assertEqual(self.aggregation.verify(conn), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
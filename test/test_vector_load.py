@@ -0,0 +1,193 @@
+import unittest
+from unittest.mock import MagicMock
+import geopandas as gpd
+import shapely
+from sqlalchemy import text
+from shapely.geometry import Point
+
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from postgres_server import create_database, pgserver
+from utils import clear_index_cache, ensure_unique_index
+from utils.vector_pipeline.load import KEY, MergeLoader, copy_buffer
+
+
+def _frame():
+    return gpd.GeoDataFrame(
+        {
+            "shape": [Point(1, 2), Point(3, 4)],
+            "storm_id": [7, 7],
+            "fd_id": [1, 2],
+            "depth": [1.5, None],
+        },
+        geometry="shape",
+        crs=3857,
+    )
+
+
+class FakeConnection:
+    """Records the statements, answers the counts of the merge"""
+
+    def __init__(self, staged=2, inserted=1, updated=1):
+        self.statements = []
+        self.copies = []
+        self.staged, self.inserted, self.updated = staged, inserted, updated
+        self.connection = MagicMock()
+        self.engine = MagicMock()
+        self.connection.cursor.return_value.copy_expert.side_effect = (
+            lambda sql, buffer: self.copies.append((sql, buffer.read()))
+        )
+
+    def execute(self, statement, params=None):
+        sql = str(statement)
+        self.statements.append(sql)
+        result = MagicMock()
+        result.scalar.return_value = self.staged
+        result.one.return_value = (self.inserted, self.updated)
+        return result
+
+
+class TestCopyBuffer(unittest.TestCase):
+    def test_rows_as_csv(self):
+        lines = copy_buffer(_frame()).read().splitlines()
+        self.assertEqual(len(lines), 2)
+        ewkb, storm_id, fd_id, depth = lines[1].split(",")
+        point = shapely.from_wkb(ewkb)
+        self.assertEqual((point.x, point.y), (3, 4))
+        self.assertEqual(shapely.get_srid(point), 3857)
+        self.assertEqual((storm_id, fd_id), ("7", "2"))
+        # Missing values are NULL
+        self.assertEqual(depth, "")
+
+
+class TestMergeLoader(unittest.TestCase):
+    def test_counts(self):
+        conn = FakeConnection(staged=5, inserted=2, updated=1)
+        counts = MergeLoader("result").load(conn, [_frame(), _frame()])
+        self.assertEqual(
+            counts, {"staged": 5, "inserted": 2, "updated": 1, "unchanged": 2}
+        )
+        # One staging table for all the chunks
+        self.assertEqual(
+            sum("CREATE TEMP TABLE result_staging" in s for s in conn.statements), 1
+        )
+        self.assertEqual(len(conn.copies), 2)
+
+    def test_merge_statement(self):
+        conn = FakeConnection()
+        MergeLoader("result").load(conn, [_frame()])
+        merge = next(s for s in conn.statements if "ON CONFLICT" in s)
+        self.assertIn("ON CONFLICT (storm_id, fd_id) DO UPDATE SET", merge)
+        self.assertIn("shape = EXCLUDED.shape, depth = EXCLUDED.depth", merge)
+        self.assertIn(
+            "WHERE (r.shape, r.depth) IS DISTINCT FROM (EXCLUDED.shape, EXCLUDED.depth)",
+            merge,
+        )
+        self.assertIn("r.xmax = 0", merge)
+
+    def test_summary_follows_the_changed_rows(self):
+        conn = FakeConnection()
+        aggregation = MagicMock()
+        MergeLoader("result", aggregation=aggregation).load(conn, [_frame()])
+        removed = aggregation.remove_rows.call_args[0][1]
+        added = aggregation.add_rows.call_args[0][1]
+        self.assertIn("FROM result_staging s", removed)
+        self.assertIn("IS DISTINCT FROM", removed)
+        self.assertIn("FROM result_merged m", added)
+
+    def test_nothing_to_load(self):
+        conn = FakeConnection()
+        self.assertEqual(MergeLoader("result").load(conn, [])["staged"], 0)
+        self.assertFalse([s for s in conn.statements if "staging" in s])
+
+
+@unittest.skipUnless(pgserver, "pgserver is not installed")
+class TestMergeOnDatabase(unittest.TestCase):
+    """The merge on PostgreSQL, shapes are stored as text (PostGIS is not installed)"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = create_database()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.dispose()
+
+    def setUp(self):
+        with self.engine.begin() as conn:
+            conn.execute(text("DROP TABLE IF EXISTS result"))
+            conn.execute(
+                text(
+                    "CREATE TABLE result (shape text, storm_id integer, "
+                    "fd_id integer, depth float8)"
+                )
+            )
+        clear_index_cache()
+
+    def _migrate(self):
+        with self.engine.begin() as conn:
+            return ensure_unique_index(conn, "result", KEY)
+
+    def _load(self, frame):
+        with self.engine.begin() as conn:
+            return MergeLoader("result").load(conn, [frame])
+
+    def _rows(self):
+        with self.engine.connect() as conn:
+            return conn.execute(
+                text("SELECT storm_id, fd_id, depth FROM result ORDER BY fd_id")
+            ).all()
+
+    def test_load_twice(self):
+        self.assertTrue(self._migrate())
+        self.assertEqual(
+            self._load(_frame()),
+            {"staged": 2, "inserted": 2, "updated": 0, "unchanged": 0},
+        )
+        self.assertEqual(
+            self._load(_frame()),
+            {"staged": 2, "inserted": 0, "updated": 0, "unchanged": 2},
+        )
+        changed = _frame()
+        changed.loc[1, "depth"] = 2.5
+        self.assertEqual(
+            self._load(changed),
+            {"staged": 2, "inserted": 0, "updated": 1, "unchanged": 1},
+        )
+        self.assertEqual(self._rows(), [(7, 1, 1.5), (7, 2, 2.5)])
+
+    def test_table_without_index_is_refused(self):
+        with self.engine.begin() as conn:
+            conn.execute(text("INSERT INTO result VALUES ('', 7, 1, 1), ('', 7, 1, 1)"))
+        # The migration can not create the index, the merge does not create it either
+        with self.assertLogs("utils.database_utils", level="WARNING"):
+            self.assertFalse(self._migrate())
+        with self.assertRaises(ValueError):
+            self._load(_frame())
+
+    def test_repeated_key_keeps_the_last_row(self):
+        self._migrate()
+        frame = _frame()
+        frame.loc[1, "fd_id"] = 1
+        self.assertEqual(self._load(frame)["inserted"], 1)
+        self.assertEqual(self._rows(), [(7, 1, None)])
+
+    def test_append_to_a_keyed_table(self):
+        self._migrate()
+        loader = MergeLoader("result")
+        with self.engine.begin() as conn:
+            self.assertTrue(loader.is_keyed(conn))
+            self.assertEqual(loader.append(conn, [_frame()]), 2)
+        changed = _frame()
+        changed.loc[0, "depth"] = 9.0
+        # Loading the file again does not fail, the rows already loaded are kept
+        with self.engine.begin() as conn:
+            self.assertEqual(loader.append(conn, [changed]), 0)
+        self.assertEqual(self._rows(), [(7, 1, 1.5), (7, 2, None)])
+
+
+if __name__ == "__main__":
+    unittest.main()
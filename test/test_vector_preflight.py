@@ -0,0 +1,138 @@
+import unittest
+import json
+import tempfile
+import boto3
+import geopandas as gpd
+import numpy as np
+from moto import mock_s3
+from shapely.geometry import Point
+
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from utils.vector_pipeline.preflight import (
+    REQUIRED_FIELDS,
+    parse_storm_name,
+    preflight,
+    quarantine,
+)
+
+_BUCKET = "lwi-region1"
+_KEY = "results/1_Atlas14_100yr_Upper90_Partial_ PD1Day _V9A1_TD24hr _ARFTP40_maxdepth_si_1.shp"
+
+
+def _results(rows: int, crs=4326) -> gpd.GeoDataFrame:
+    data = {field: np.arange(rows, dtype=np.float64) for field in REQUIRED_FIELDS}
+    data["damage cat"] = ["Res"] * rows
+    data["occupancy"] = ["RES1-1SNB"] * rows
+    return gpd.GeoDataFrame(
+        data, geometry=[Point(-91 + i * 1e-3, 30) for i in range(rows)], crs=4326
+    ).to_crs(crs)
+
+
+class TestParseStormName(unittest.TestCase):
+    def test_names(self):
+        self.assertEqual(
+            parse_storm_name(_KEY), {"storm_name": "100yr", "event_type": 1}
+        )
+        self.assertEqual(
+            parse_storm_name("a/1_CMB_x_Ida_si.shp"),
+            {"storm_name": "Ida", "event_type": 3},
+        )
+        self.assertIsNone(parse_storm_name("a/1_TC_storm_si.shp"))
+        self.assertIsNone(parse_storm_name("a/results.shp"))
+
+
+@mock_s3
+class TestPreflight(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.s3.create_bucket(Bucket=_BUCKET)
+        self.requests = []
+        self.s3.meta.events.register(
+            "provide-client-params.s3.GetObject",
+            lambda params, **kwargs: self.requests.append(params),
+        )
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _deliver(self, gdf, key=_KEY, skip=()):
+        """Upload the files of the shapefile under key"""
+        local = os.path.join(self.tmp.name, "results.shp")
+        gdf.to_file(local)
+        for ext in ("shp", "shx", "dbf", "prj"):
+            if ext not in skip:
+                self.s3.upload_file(local[:-3] + ext, _BUCKET, key[:-3] + ext)
+        return {"Bucket": _BUCKET, "Key": key}
+
+    def test_valid_delivery_reads_headers_only(self):
+        report = preflight(self.s3, self._deliver(_results(500)))
+        self.assertEqual(report["errors"], [])
+        self.assertEqual(report["rows"], 500)
+        ranges = {r["Key"][-3:]: r.get("Range") for r in self.requests}
+        self.assertEqual(ranges["shp"], "bytes=0-99")
+        self.assertEqual(ranges["shx"], "bytes=0-99")
+        self.assertEqual(ranges["dbf"], "bytes=0-4095")
+        self.assertEqual(len(self.requests), 4)
+
+    def test_null_records_and_point_z(self):
+        gdf = _results(10)
+        gdf.loc[[2, 5], "geometry"] = None
+        report = preflight(self.s3, self._deliver(gdf))
+        self.assertEqual(report["errors"], [])
+        gdf = _results(10)
+        gdf["geometry"] = [Point(p.x, p.y, 1.5) for p in gdf.geometry]
+        report = preflight(self.s3, self._deliver(gdf))
+        self.assertEqual(report["errors"], [])
+
+    def test_record_count_mismatch(self):
+        delivery = self._deliver(_results(10))
+        # The index of another delivery
+        local = os.path.join(self.tmp.name, "other.shp")
+        _results(12).to_file(local)
+        self.s3.upload_file(local[:-3] + "shx", _BUCKET, _KEY[:-3] + "shx")
+        report = preflight(self.s3, delivery)
+        self.assertEqual(
+            report["errors"],
+            ["The .shx and the .dbf do not have the same record count (12 and 10)"],
+        )
+
+    def test_wrong_crs(self):
+        report = preflight(self.s3, self._deliver(_results(10, crs=3857)))
+        self.assertIn("CRS is EPSG:3857, expected EPSG:4326", report["errors"])
+        self.assertIn("is not in degrees", report["errors"][-1])
+
+    def test_missing_fields(self):
+        delivery = self._deliver(_results(10).drop(columns=["depth", "c_dam_per"]))
+        report = preflight(self.s3, delivery)
+        self.assertEqual(report["errors"], ["Missing fields: depth, c_dam_per"])
+
+    def test_missing_prj(self):
+        report = preflight(self.s3, self._deliver(_results(10), skip=("prj",)))
+        self.assertIn("Missing or unreadable file", report["errors"][0])
+
+    def test_unsupported_storm(self):
+        delivery = self._deliver(_results(10), key="results/1_TC_storm_si.shp")
+        report = preflight(self.s3, delivery)
+        self.assertEqual(
+            report["errors"], ["File name does not encode a supported storm"]
+        )
+
+    def test_quarantine(self):
+        report = preflight(self.s3, self._deliver(_results(10, crs=3857)))
+        quarantine_file = os.path.join(self.tmp.name, "quarantine.json")
+        quarantine([report], quarantine_file)
+        quarantine([report], quarantine_file)
+        with open(quarantine_file) as f:
+            entries = json.load(f)
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0]["Key"], _KEY)
+        self.assertIn("datetime", entries[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
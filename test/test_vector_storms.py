@@ -0,0 +1,151 @@
+import unittest
+from unittest.mock import MagicMock, patch
+import pickle
+from sqlalchemy import event, text
+
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from postgres_server import create_database, pgserver
+from utils.vector_pipeline import AddData, StormRegistry
+from utils.vector_pipeline.preflight import parse_storm_name
+
+_KEYS = [
+    "a/1_Atlas14_100yr_Upper90_Partial_ PD1Day _V9A1_TD24hr _ARFTP40_maxdepth_si_1.shp",
+    "a/2_Atlas14_100yr_Upper90_Partial_ PD1Day _V9A1_TD24hr _ARFTP40_maxdepth_si_1.shp",
+    "a/1_CMB_x_Ida_si.shp",
+    "a/1_x_Laura_si.shp",
+]
+
+
+@unittest.skipUnless(pgserver, "pgserver is not installed")
+class TestStormRegistry(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = create_database()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.dispose()
+
+    def setUp(self):
+        with self.engine.begin() as conn:
+            conn.execute(text("DROP TABLE IF EXISTS storm, result"))
+            conn.execute(
+                text(
+                    "CREATE TABLE storm (storm_id serial PRIMARY KEY, storm text, "
+                    "event_type integer)"
+                )
+            )
+            conn.execute(text("CREATE TABLE result (storm_id integer)"))
+            conn.execute(
+                text("INSERT INTO storm (storm, event_type) VALUES ('Ida', 3)")
+            )
+        self.statements = []
+        event.listen(self.engine, "before_cursor_execute", self._record)
+        self.addCleanup(
+            event.remove, self.engine, "before_cursor_execute", self._record
+        )
+        self.registry = StormRegistry("storm", "result", self.engine)
+
+    def _record(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def _count(self):
+        with self.engine.connect() as conn:
+            return conn.execute(text("SELECT count(*) FROM storm")).scalar()
+
+    def test_resolve_in_one_batch(self):
+        self.assertEqual(self.registry.load(), 1)
+        self.assertTrue(self.registry.keyed)
+        self.statements.clear()
+        ids = self.registry.resolve(parse_storm_name(key) for key in _KEYS)
+        self.assertEqual(list(ids), [("100yr", 1), ("Ida", 3), ("Laura", 2)])
+        self.assertEqual(ids[("Ida", 3)], 1)
+        inserts = [s for s in self.statements if s.startswith("INSERT")]
+        self.assertEqual(len(inserts), 1)
+        self.assertIn("ON CONFLICT", inserts[0])
+        # Known storms need no query
+        self.statements.clear()
+        self.registry.resolve([parse_storm_name(_KEYS[3])])
+        self.assertEqual(self.statements, [])
+
+    def test_index_is_created_once(self):
+        self.registry.load()
+        self.statements.clear()
+        StormRegistry("storm", "result", self.engine).load()
+        self.assertFalse([s for s in self.statements if s.startswith("CREATE")])
+
+    def test_storms_created_meanwhile(self):
+        self.registry.load()
+        other = StormRegistry("storm", "result", self.engine)
+        laura = other.resolve([{"storm_name": "Laura", "event_type": 2}])
+        # The registry loaded before does not know the storm, it gets the same id
+        ids = self.registry.resolve([{"storm_name": "Laura", "event_type": 2}])
+        self.assertEqual(ids, laura)
+        self.assertEqual(self._count(), 2)
+
+    def test_duplicated_storms(self):
+        with self.engine.begin() as conn:
+            conn.execute(
+                text("INSERT INTO storm (storm, event_type) VALUES ('Ida', 3)")
+            )
+        with self.assertLogs("utils.database_utils", level="WARNING"):
+            self.registry.load()
+        self.assertFalse(self.registry.keyed)
+        ids = self.registry.resolve(
+            [
+                {"storm_name": "Ida", "event_type": 3},
+                {"storm_name": "Laura", "event_type": 2},
+            ]
+        )
+        self.assertEqual(ids[("Ida", 3)], 1)
+        # A registry that was not loaded finds the same storms
+        other = StormRegistry("storm", "result", self.engine)
+        self.assertEqual(
+            other.resolve([{"storm_name": "Laura", "event_type": 2}]),
+            {("Laura", 2): ids[("Laura", 2)]},
+        )
+        self.assertEqual(self._count(), 3)
+
+    def test_clean(self):
+        self.registry.load()
+        ids = self.registry.resolve([{"storm_name": "Laura", "event_type": 2}])
+        with self.engine.begin() as conn:
+            conn.execute(
+                text("INSERT INTO result VALUES (:id)"), {"id": ids[("Laura", 2)]}
+            )
+        self.registry.clean()
+        self.assertIsNone(self.registry.get("Ida", 3))
+        self.assertEqual(self.registry.get("Laura", 2), ids[("Laura", 2)])
+
+    def test_pickle(self):
+        self.registry.load()
+        copy = pickle.loads(pickle.dumps(self.registry))
+        self.assertIsNone(copy.engine)
+        self.assertEqual(copy.get("Ida", 3), 1)
+
+
+class TestAddDataStorm(unittest.TestCase):
+    def test_storm_id_from_the_registry(self):
+        registry = StormRegistry("storm")
+        registry.storms = {("100yr", 1): 12}
+        job = AddData({"Bucket": "b", "Key": _KEYS[0]}, storms=registry)
+        job._connect = MagicMock()
+        job.tables = [{"name": "result"}, {"name": "storm"}]
+        job.engine = MagicMock()
+        with patch.multiple(
+            AddData,
+            _read_data=MagicMock(return_value=MagicMock()),
+            _AddData__get_regions=MagicMock(return_value=[1]),
+        ), patch("utils.vector_pipeline.add.to_epsg"), patch(
+            "utils.vector_pipeline.add.compact_dtypes"
+        ):
+            self.assertEqual(job.plan()["storm_id"], 12)
+        job.engine.begin.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
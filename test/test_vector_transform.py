@@ -0,0 +1,71 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely.geometry import Point, box
+
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from utils.vector_pipeline.transform import get_transformer, to_epsg
+
+
+class TestToEpsg(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        self.points = gpd.GeoDataFrame(
+            {"fd_id": np.arange(1000)},
+            geometry=gpd.points_from_xy(
+                rng.uniform(-94, -89, 1000), rng.uniform(29, 33, 1000)
+            ),
+            crs=4326,
+        )
+
+    def test_matches_to_crs(self):
+        expected = self.points.to_crs(3857)
+        projected = to_epsg(self.points)
+        self.assertEqual(projected.crs.to_epsg(), 3857)
+        np.testing.assert_allclose(
+            shapely.get_coordinates(projected.geometry.values),
+            shapely.get_coordinates(expected.geometry.values),
+            rtol=0,
+            atol=1e-6,
+        )
+        self.assertEqual(projected["fd_id"].tolist(), expected["fd_id"].tolist())
+        # The input keeps its crs
+        self.assertEqual(self.points.crs.to_epsg(), 4326)
+
+    def test_renamed_geometry_column(self):
+        points = self.points.rename_geometry("shape")
+        projected = to_epsg(points)
+        self.assertEqual(projected.geometry.name, "shape")
+        self.assertEqual(projected.crs.to_epsg(), 3857)
+
+    def test_same_crs_is_not_copied(self):
+        projected = to_epsg(self.points.to_crs(3857))
+        self.assertIs(to_epsg(projected), projected)
+
+    def test_other_geometries_use_to_crs(self):
+        gdf = gpd.GeoDataFrame(
+            geometry=[box(-91, 30, -90, 31), Point(-91, 30)], crs=4326
+        )
+        np.testing.assert_allclose(
+            shapely.get_coordinates(to_epsg(gdf).geometry.values),
+            shapely.get_coordinates(gdf.to_crs(3857).geometry.values),
+        )
+
+    def test_transformer_is_cached(self):
+        self.assertIs(get_transformer(4326, 3857), get_transformer(4326, 3857))
+
+    def test_each_thread_has_its_transformer(self):
+        main = get_transformer(4326, 3857)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            other = executor.submit(get_transformer, 4326, 3857).result()
+        self.assertIsNot(main, other)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import unittest
+from types import SimpleNamespace
+
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from utils.raster_pipeline.webmap import WebmapChanges  # noqa: E402
+
+
+class FakeContent:
+    """Portal content holding map services and webmaps"""
+
+    def __init__(self, services, webmaps):
+        self.services = services
+        self.webmaps = webmaps
+        self.searches = []
+
+    def search(self, query, item_type=None, max_items=10):
+        self.searches.append((query, item_type))
+        if item_type == "Web Map":
+            return [w for w in self.webmaps if query in w.title]
+        return [
+            s for s in self.services if f'title:"{s.title}"' in query.split(" OR ")
+        ][:max_items]
+
+
+class FakeWebMap:
+    updates = 0
+
+    def __init__(self, item):
+        self.layers = item.data
+
+    def update(self):
+        FakeWebMap.updates += 1
+
+
+def _service(name):
+    return SimpleNamespace(
+        title=name,
+        id=f"id-{name}",
+        url=f"https://server/rest/services/LWI/{name}/MapServer",
+        layers=[SimpleNamespace(properties=SimpleNamespace(name=name))],
+    )
+
+
+class TestWebmapChanges(unittest.TestCase):
+    def setUp(self):
+        FakeWebMap.updates = 0
+        self.webmap = SimpleNamespace(
+            title="GoConsequence",
+            data=[
+                {"title": "Region 1", "layers": [{"title": "old_depth"}]},
+                {"title": "Region 2", "layers": []},
+            ],
+        )
+        self.content = FakeContent(
+            [_service(f"depth_{i}") for i in range(5)], [self.webmap]
+        )
+        self.changes = WebmapChanges(
+            config_file="missing.yaml",
+            gis=SimpleNamespace(content=self.content),
+            webmap_factory=FakeWebMap,
+        )
+        self.changes.webmapName = "GoConsequence"
+
+    def test_one_update_per_webmap(self):
+        for i in range(5):
+            self.changes.add(f"depth_{i}", f"Region {1 + i % 2}")
+        # Duplicated adds of the same service are applied once
+        self.changes.add("depth_0", "Region 1")
+        self.changes.remove("old_depth")
+        summary = self.changes.apply()
+
+        self.assertEqual(FakeWebMap.updates, 1)
+        self.assertEqual(summary["removed"], ["old_depth"])
+        self.assertEqual(summary["added"], [f"depth_{i}" for i in range(5)])
+        region_1 = [layer["title"] for layer in self.webmap.data[0]["layers"]]
+        region_2 = [layer["title"] for layer in self.webmap.data[1]["layers"]]
+        self.assertEqual(region_1, ["depth_0", "depth_2", "depth_4"])
+        self.assertEqual(region_2, ["depth_1", "depth_3"])
+        # One search for the layers and one for the webmaps
+        self.assertEqual(len(self.content.searches), 2)
+
+    def test_republished_layer_is_not_duplicated(self):
+        self.changes.add("depth_0", "Region 1")
+        self.changes.apply()
+        self.changes.add("depth_0", "Region 1")
+        self.changes.apply()
+        titles = [layer["title"] for layer in self.webmap.data[0]["layers"]]
+        self.assertEqual(titles, ["old_depth", "depth_0"])
+
+    def test_remove_after_add_wins(self):
+        self.changes.add("depth_0", "Region 1")
+        self.changes.remove("depth_0")
+        summary = self.changes.apply()
+        self.assertEqual(summary["added"], [])
+        self.assertEqual(summary["removed"], ["depth_0"])
+        self.assertEqual(FakeWebMap.updates, 0)
+
+    def test_portal_error_keeps_the_changes(self):
+        self.changes.add("depth_0", "Region 1")
+        self.changes.remove("old_depth")
+        search = self.content.search
+
+        def unavailable(*args, **kwargs):
+            raise ConnectionError("portal unavailable")
+
+        self.content.search = unavailable
+        with self.assertLogs("utils.raster_pipeline.webmap", level="ERROR"):
+            summary = self.changes.apply()
+        self.assertIsInstance(summary["error"], ConnectionError)
+        self.assertEqual(FakeWebMap.updates, 0)
+        # The next apply of the run retries them
+        self.content.search = search
+        summary = self.changes.apply()
+        self.assertIsNone(summary["error"])
+        self.assertEqual(summary["added"], ["depth_0"])
+        self.assertEqual(summary["removed"], ["old_depth"])
+        titles = [layer["title"] for layer in self.webmap.data[0]["layers"]]
+        self.assertEqual(titles, ["depth_0"])
+
+    def test_nothing_to_apply(self):
+        self.changes.apply()
+        self.assertEqual(self.content.searches, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,16 +1,33 @@
-from .S3ObjectMonitor import S3ObjectMonitor
-from .database_utils import get_db_connection, copy_from_stringio
-from .vector_pipeline import AddData, DeleteData
+import importlib
 
-# from .arcgis_services import configure_mapserver_capabilities, activate_cache, change_cache_dir, share_options, edit_scales
-# from .raster_pipeline import AddData, DeleteData
-from .report import Report
+# Public names and the module defining them, the modules are imported on first use so
+# the entry points do not pay for the geo and database stack when nothing changed
+_EXPORTS = {
+    "S3ObjectMonitor": ".S3ObjectMonitor",
+    "get_db_connection": ".database_utils",
+    "copy_from_stringio": ".database_utils",
+    "get_table": ".database_utils",
+    "has_unique_index": ".database_utils",
+    "ensure_unique_index": ".database_utils",
+    "clear_index_cache": ".database_utils",
+    "AddData": ".vector_pipeline",
+    "DeleteData": ".vector_pipeline",
+    "Report": ".report",
+    "ReportBatch": ".report",
+}
 
-__all__ = [
-    "S3ObjectMonitor",
-    "get_db_connection",
-    "copy_from_stringio",
-    "AddData",
-    "DeleteData",
-    "Report",
-]
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    # The S3ObjectMonitor submodule is bound to the package when it is imported,
+    # the class replaces it as before
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
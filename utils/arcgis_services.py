@@ -1,86 +1,163 @@
 """This file contains all the functions to edit the XML generated by the ArcGIS Server REST API"""
 
-import xml.dom.minidom as DOM
+import logging
+import xml.etree.ElementTree as ET
+
+log = logging.getLogger(__name__)
+
+
+class SddraftDocument:
+    def __init__(self, sddraftPath: str):
+        """Define an in-memory service definition draft
+        The file is parsed once, the Key/Value pairs of its property sets are indexed and
+        every edit is applied to the tree, save() writes the result once.
+        parameters:
+        sddraftPath: str - Path of the .sddraft file"""
+        self.path = sddraftPath
+        # Prefixes such as typens only appear inside xsi:type values, they are kept so
+        # the declarations are written back even if no tag uses them
+        self.namespaces = {}
+        parser = ET.iterparse(sddraftPath, events=("start-ns",))
+        for _, (prefix, uri) in parser:
+            self.namespaces.setdefault(prefix, uri)
+        self.root = parser.root
+        self._index()
+
+    @staticmethod
+    def _pairs(property_array) -> dict:
+        """Return the Value element of each Key of a PropertyArray"""
+        pairs = {}
+        if property_array is None:
+            return pairs
+        for prop in property_array.findall("PropertySetProperty"):
+            key = prop.find("Key")
+            value = prop.find("Value")
+            if key is not None and value is not None:
+                pairs[key.text] = value
+        return pairs
+
+    def _index(self) -> None:
+        """Index the Key/Value pairs of the configuration, the extensions and the whole file"""
+        self.properties = {}
+        for prop in self.root.iter("PropertySetProperty"):
+            key = prop.find("Key")
+            value = prop.find("Value")
+            if key is not None and value is not None:
+                self.properties.setdefault(key.text, []).append(value)
+        self.configuration = self._pairs(
+            self.root.find(".//ConfigurationProperties/PropertyArray")
+        )
+        # The MapServer service keeps its own properties (e.g. WebCapabilities) in the
+        # Info of its definition, next to the extensions
+        self.service_info = {}
+        for configuration in self.root.iter("SVCConfiguration"):
+            if configuration.findtext("TypeName") == "MapServer":
+                self.service_info = self._pairs(
+                    configuration.find("Definition/Info/PropertyArray")
+                )
+        self.extensions = {}
+        for extension in self.root.iter("SVCExtension"):
+            type_name = extension.findtext("TypeName")
+            self.extensions[type_name] = self._pairs(
+                extension.find("Info/PropertyArray")
+            )
+        self.item_info = self.root.find(".//ItemInfo")
+
+    def get(self, key: str, extension: str = None):
+        """Return the value of a configuration property (or of an extension property)"""
+        pairs = self.extensions.get(extension, {}) if extension else self.configuration
+        value = pairs.get(key)
+        return None if value is None else value.text
+
+    def set_configuration(self, key: str, value: str) -> None:
+        """Set a property of the service configuration"""
+        if key in self.configuration:
+            self.configuration[key].text = value
+
+    def set_extension(self, type_name: str, key: str, value: str) -> None:
+        """Set a property of a service extension e.g. MapServer"""
+        pairs = self.extensions.get(type_name, {})
+        if key in pairs:
+            pairs[key].text = value
+
+    def set_property(self, key: str, value: str) -> None:
+        """Set every property with this key, wherever it is defined"""
+        for element in self.properties.get(key, []):
+            element.text = value
+
+    def configure_capabilities(self, capabilities: str) -> None:
+        """Set the web capabilities of the MapServer service
+        raises: ValueError when the draft does not define them"""
+        value = self.service_info.get("WebCapabilities")
+        if value is None:
+            raise ValueError(f"{self.path} has no MapServer WebCapabilities property")
+        value.text = capabilities
+
+    def activate_cache(self) -> None:
+        self.set_configuration("isCached", "true")
+
+    def set_cache_dir(self, cache_dir: str) -> None:
+        self.set_property("cacheDir", cache_dir)
+
+    def share(
+        self,
+        SharetoOrganization: str,
+        SharetoEveryone: str,
+        SharetoGroup: str,
+        GroupID=None,
+    ) -> None:
+        """Set the sharing level of the service"""
+        self.set_property("PackageUnderMyOrg", SharetoOrganization)
+        self.set_property("PackageIsPublic", SharetoEveryone)
+        self.set_property("PackageShareGroups", SharetoGroup)
+        if SharetoGroup == "true":
+            self.set_property("PackageGroupIDs", GroupID)
+
+    def set_scales(self, minScale: str, maxScale: str) -> None:
+        """Set the visible scales of the service and of its portal item"""
+        self.set_configuration("minScale", minScale)
+        self.set_configuration("maxScale", maxScale)
+        if self.item_info is not None:
+            self.item_info.find("MinScale").text = minScale
+            self.item_info.find("MaxScale").text = maxScale
+
+    def save(self, sddraftPath: str = None) -> None:
+        """Write the document (to its own file by default)"""
+        used = {
+            name[1 : name.index("}")]
+            for element in self.root.iter()
+            for name in (element.tag, *element.attrib)
+            if name.startswith("{")
+        }
+        for prefix, uri in self.namespaces.items():
+            if prefix:
+                ET.register_namespace(prefix, uri)
+            if uri not in used:
+                attribute = f"xmlns:{prefix}" if prefix else "xmlns"
+                self.root.set(attribute, uri)
+        ET.ElementTree(self.root).write(
+            sddraftPath or self.path, encoding="utf-8", xml_declaration=True
+        )
 
 
 def configure_mapserver_capabilities(sddraftPath, capabilities):
     """Function to configure MapServer properties"""
-    # Read the .sddraft file
-    doc = DOM.parse(sddraftPath)
-
-    # Find all elements named TypeName
-    # This is where the additional layers and capabilities are defined
-    typeNames = doc.getElementsByTagName("TypeName")
-    for typeName in typeNames:
-        # Get the TypeName to enable
-        if typeName.firstChild.data == "MapServer":
-            extension = typeName.parentNode
-            for extElement in extension.childNodes:
-                if extElement.tagName == "Definition":
-                    for propArray in extElement.childNodes:
-                        if propArray.tagName == "Info":
-                            for propSet in propArray.childNodes:
-                                for prop in propSet.childNodes:
-                                    for prop1 in prop.childNodes:
-                                        if prop1.tagName == "Key":
-                                            if (
-                                                prop1.firstChild.data
-                                                == "WebCapabilities"
-                                            ):
-                                                if prop1.nextSibling.hasChildNodes():
-                                                    prop1.nextSibling.firstChild.data = capabilities
-                                                else:
-                                                    txt = doc.createTextNode(
-                                                        capabilities
-                                                    )
-                                                    prop1.nextSibling.appendChild(txt)
-    # Write to the .sddraft file
-    f = open(sddraftPath, "w")
-    doc.writexml(f)
-    f.close()
+    doc = SddraftDocument(sddraftPath)
+    doc.configure_capabilities(capabilities)
+    doc.save()
 
 
 def activate_cache(ssdraftPath):
-    doc = DOM.parse(ssdraftPath)
-
-    configProps = doc.getElementsByTagName("ConfigurationProperties")[0]
-    propArray = configProps.firstChild
-    propSets = propArray.childNodes
-    for propSet in propSets:
-        keyValues = propSet.childNodes
-        for keyValue in keyValues:
-            if keyValue.tagName == "Key":
-                if keyValue.firstChild.data == "isCached":
-                    keyValue.nextSibling.firstChild.data = "true"
-
-    # update sddraft file
-    f = open(ssdraftPath, "w")
-    doc.writexml(f)
-    f.close()
+    doc = SddraftDocument(ssdraftPath)
+    doc.activate_cache()
+    doc.save()
 
 
 def change_cache_dir(cache_dir: str, sddraftPath: str):
-    # Parse the sddraft
-    doc = DOM.parse(sddraftPath)
-
-    property_set_properties = doc.getElementsByTagName("PropertySetProperty")
-    for prop in property_set_properties:
-        key_element = prop.getElementsByTagName("Key")[0]
-        if key_element.firstChild.data == "cacheDir":
-            value_element = prop.getElementsByTagName("Value")[0]
-            if value_element:
-                if value_element.firstChild is None:
-                    # Create a text node for the <Value> element if it doesn't exist
-                    text_node = doc.createTextNode(cache_dir)
-                    value_element.appendChild(text_node)
-                else:
-                    value_element.firstChild.data = cache_dir
-
-    # Save the modified sddraft back to a file
-    with open(sddraftPath, "w") as sddraft_file:
-        doc.writexml(sddraft_file)
-
-    print("cacheDir property updated.")
+    doc = SddraftDocument(sddraftPath)
+    doc.set_cache_dir(cache_dir)
+    doc.save()
+    log.info("cacheDir property updated.")
 
 
 def share_options(
@@ -90,48 +167,12 @@ def share_options(
     sddraftPath: str,
     GroupID=None,
 ):
-    docs = DOM.parse(sddraftPath)
-    key_list = docs.getElementsByTagName("Key")
-    value_list = docs.getElementsByTagName("Value")
-    for i in range(key_list.length):
-        if key_list[i].firstChild.nodeValue == "PackageUnderMyOrg":
-            value_list[i].firstChild.nodeValue = SharetoOrganization
-        if key_list[i].firstChild.nodeValue == "PackageIsPublic":
-            value_list[i].firstChild.nodeValue = SharetoEveryone
-        if key_list[i].firstChild.nodeValue == "PackageShareGroups":
-            value_list[i].firstChild.nodeValue = SharetoGroup
-        if (
-            SharetoGroup == "true"
-            and key_list[i].firstChild.nodeValue == "PackageGroupIDs"
-        ):
-            value_list[i].firstChild.nodeValue = GroupID
-    with open(sddraftPath, "w") as sddraft_file:
-        docs.writexml(sddraft_file)
+    doc = SddraftDocument(sddraftPath)
+    doc.share(SharetoOrganization, SharetoEveryone, SharetoGroup, GroupID)
+    doc.save()
 
 
 def edit_scales(ssdraftPath, minScale, maxScale):
-    doc = DOM.parse(ssdraftPath)
-    iteminfo = doc.getElementsByTagName("ItemInfo")
-    item_info = iteminfo.item(0)
-    configProps = doc.getElementsByTagName("ConfigurationProperties")[0]
-    propArray = configProps.firstChild
-    propSets = propArray.childNodes
-    for propSet in propSets:
-        keyValues = propSet.childNodes
-        for keyValue in keyValues:
-            if keyValue.tagName == "Key":
-                if keyValue.firstChild.data == "minScale":
-                    keyValue.nextSibling.firstChild.data = minScale
-                if keyValue.firstChild.data == "maxScale":
-                    keyValue.nextSibling.firstChild.data = maxScale
-
-    min_scale_element = item_info.getElementsByTagName("MinScale")[0]
-    max_scale_element = item_info.getElementsByTagName("MaxScale")[0]
-
-    # Update the values
-    min_scale_element.firstChild.nodeValue = minScale
-    max_scale_element.firstChild.nodeValue = maxScale
-    # update sddraft file
-    f = open(ssdraftPath, "w")
-    doc.writexml(f)
-    f.close()
+    doc = SddraftDocument(ssdraftPath)
+    doc.set_scales(minScale, maxScale)
+    doc.save()
@@ -1,5 +1,16 @@
 import psycopg2
+import logging
+import threading
 from io import StringIO
+from sqlalchemy import MetaData, Table, text
+
+log = logging.getLogger(__name__)
+
+# Reflected tables shared by the whole process: {(url, schema, name): Table}
+_TABLE_CACHE = {}
+_TABLE_CACHE_LOCK = threading.Lock()
+# Unique indexes found by has_unique_index(cache=True): {(url, table, columns): bool}
+_INDEX_CACHE = {}
 
 
 def get_db_connection(database, user, password, host, port):
@@ -41,3 +52,99 @@ def copy_from_stringio(conn, df, table):
         return 1
     print("copy_from_stringio() done")
     cursor.close()
+
+
+def get_table(engine, name, schema=None):
+    """
+    Function that returns the SQLAlchemy Table of a database table, reflecting it
+    only the first time it is requested in the process. Engines pointing to the
+    same database share the reflected metadata.
+    params:
+    - engine: SQLAlchemy engine
+    - name: table name
+    - schema: table schema, the default search path when None
+
+    """
+    key = (engine.url, schema, name)
+    with _TABLE_CACHE_LOCK:
+        if key not in _TABLE_CACHE:
+            _TABLE_CACHE[key] = Table(
+                name, MetaData(), schema=schema, autoload_with=engine
+            )
+        return _TABLE_CACHE[key]
+
+
+def clear_table_cache():
+    """Forget the reflected tables (e.g. after a schema migration)"""
+    with _TABLE_CACHE_LOCK:
+        _TABLE_CACHE.clear()
+
+
+def has_unique_index(conn, table, columns, cache=False):
+    """
+    Function that tells if a PostgreSQL table has a unique index (or constraint) on
+    exactly the given columns, the index ON CONFLICT needs.
+    params:
+    - conn: SQLAlchemy connection
+    - table: table name, optionally with its schema
+    - columns: column names
+    - cache: keep the answer for the whole process, the indexes are created by the
+             migration (src/migrate_database.py) and not while loading
+
+    """
+    key = (conn.engine.url, table, tuple(sorted(columns)))
+    if cache and key in _INDEX_CACHE:
+        return _INDEX_CACHE[key]
+    found = conn.execute(
+        text(
+            "SELECT EXISTS (SELECT 1 FROM pg_index i WHERE i.indisunique "
+            "AND i.indrelid = to_regclass(:table) AND ARRAY(SELECT a.attname::text "
+            "FROM pg_attribute a WHERE a.attrelid = i.indrelid "
+            "AND a.attnum = ANY(i.indkey) ORDER BY a.attname) = :columns)"
+        ),
+        {"table": table, "columns": sorted(columns)},
+    ).scalar()
+    with _TABLE_CACHE_LOCK:
+        _INDEX_CACHE[key] = found
+    return found
+
+
+def clear_index_cache():
+    """Forget the unique indexes found (e.g. after a schema migration)"""
+    with _TABLE_CACHE_LOCK:
+        _INDEX_CACHE.clear()
+
+
+def ensure_unique_index(conn, table, columns):
+    """
+    Function that creates the unique index of the columns when the table has none.
+    Existing tables may hold duplicated keys, the index is then not created and the
+    duplicates are logged so they can be fixed.
+    params:
+    - conn: SQLAlchemy connection
+    - table: table name, optionally with its schema
+    - columns: column names
+    returns: True when the table has the index
+
+    """
+    if has_unique_index(conn, table, columns):
+        return True
+    keys = ", ".join(columns)
+    duplicates = conn.execute(
+        text(
+            f"SELECT count(*) FROM (SELECT 1 FROM {table} GROUP BY {keys} "
+            "HAVING count(*) > 1) d"
+        )
+    ).scalar()
+    if duplicates:
+        log.warning(
+            f"{table} has {duplicates} duplicated ({keys}) keys, "
+            "its unique index is not created"
+        )
+        return False
+    name = f"{table.split('.')[-1]}_{'_'.join(columns)}_key"
+    log.info(f"Creating the unique index {name}")
+    conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS {name} ON {table} ({keys})"))
+    with _TABLE_CACHE_LOCK:
+        _INDEX_CACHE[(conn.engine.url, table, tuple(sorted(columns)))] = True
+    return True
@@ -1,4 +1,37 @@
-from .add import AddData
-from .delete import DeleteData
+import importlib
 
-__all__ = [AddData, DeleteData]
+# arcpy, arcgis and rasterio are imported with the first class used
+_EXPORTS = {
+    "AddData": ".add",
+    "DeleteData": ".delete",
+    "DiskAdmission": ".admission",
+    "RasterCache": ".cache",
+    "SignatureStore": ".diff",
+    "FootprintIndex": ".footprint",
+    "compute_footprint": ".footprint",
+    "load_footprint_index": ".footprint",
+    "DepthStatistics": ".stats",
+    "StatisticsStore": ".stats",
+    "compute_statistics": ".stats",
+    "load_statistics_store": ".stats",
+    "PortalSession": ".portal",
+    "get_session": ".portal",
+    "Stage": ".pipeline",
+    "StagedPipeline": ".pipeline",
+    "publishing_pipeline": ".pipeline",
+    "WebmapChanges": ".webmap",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,39 +1,81 @@
 import logging
-import coloredlogs
 import os
-import arcpy
-import string
+import shutil
+import tempfile
 import yaml
 import re
 import random
-from arcgis.mapping import WebMap
-from arcgis.gis import GIS
-from .. import (
-    configure_mapserver_capabilities,
-    activate_cache,
-    change_cache_dir,
-    share_options,
-    edit_scales,
-)
+from .cache import DEFAULT_TRANSFER_CONFIG
+from .pipeline import run_on_arcpy_thread
+from .portal import get_session
+from .webmap import create_layer_id, get_region_index
+from ..arcgis_services import SddraftDocument
 
 log = logging.getLogger(__name__)
-coloredlogs.install(level="INFO")
 
 
 class AddData:
-    def __init__(self, path, temp_path, s3, config_file="credentials.yaml"):
+    def __init__(
+        self,
+        path,
+        temp_path,
+        s3,
+        config_file="credentials.yaml",
+        cache=None,
+        reprojection="auto",
+        cog=False,
+        update=False,
+        signatures=None,
+        webmap_changes=None,
+        quantize=None,
+        footprints=None,
+        statistics=None,
+        region_table=None,
+    ):
         """Define a class to add data and publish a raster
         parameters:
         path: dict - Contains the bucket and key of the file to be processed
-        temp_path: str - Path to the temp folder to store temporal resources as the project and the image
-        s3: S3 Client using boto3"""
-        log.info(" This class will remove the temp folder at the end of the process")
+        temp_path: str - Path to the temp folder, each raster stores its temporal resources as
+                         the project and the image in its own scratch folder inside it
+        s3: S3 Client using boto3
+        cache: RasterCache - Local cache of the downloaded rasters (optional)
+        reprojection: str - Engine used to project to 3857: "gdal" (windowed and
+                            multi-threaded), "arcpy" or "auto" (gdal when rasterio is installed)
+        cog: bool - Convert the raster to a Cloud-Optimized GeoTIFF with overviews aligned
+                    to the cache scales before publishing it (requires rasterio)
+        update: bool - The service already exists (corrected raster): it is overwritten and
+                       only the cache tiles of the changed area are regenerated
+        signatures: SignatureStore - Window checksums of the published rasters, used to find
+                                     the changed area of updates (requires rasterio)
+        webmap_changes: WebmapChanges - Collects the webmap layers of the run, the caller
+                                        applies them once (optional)
+        quantize: str - Encode the depths as "uint16" or "uint8" codes with a scale, keeping
+                        the symbology classes, before the COG conversion (requires rasterio)
+        footprints: FootprintIndex - Valid-data footprints of the rasters (optional)
+        statistics: StatisticsStore - Depth statistics of the rasters (optional)
+        region_table: str - Regions the statistics are computed for (optional)
+        The stores are created once for the run and shared by every raster, like the
+        signatures"""
+        log.info(" This class will remove its temp files at the end of the process")
         self.path = path
         self.s3 = s3
+        self.cache = cache
+        self.reprojection = self._get_reprojection_engine(reprojection)
+        self.cog = cog
+        self.update = update
+        self.signatures = signatures
+        self.new_signatures = None
+        self.webmap_changes = webmap_changes
+        self.quantize = quantize
+        self.quantization_report = None
         self.temp_path = temp_path
         if not os.path.exists(self.temp_path):
             os.mkdir(self.temp_path)
+        self.work_path = None
         self.config_file = config_file
+        self.portal = None
+        self.footprints = footprints
+        self.statistics, self.region_table = statistics, region_table
         self._load_config(self.config_file)
         self.s3_path = self._get_s3_path()
         self.min_scale = "9244648.868618"
@@ -45,7 +87,9 @@ class AddData:
         self.symbology = os.path.join(
             package_directory, "../../static/arcgis_resources/raster.lyrx"
         )
-        self.raster_path = self._download_raster()
+        # Symbology applied to the layer, the quantized rasters use a rescaled copy
+        self.layer_symbology = self.symbology
+        self.raster_path = None
         self.region = self._get_region()
         # Scales defined for each raster
         self.scales = "9244648.868618;4622324.434309;2311162.217155;1155581.108577;577790.554289;288895.277144;"
@@ -64,9 +108,9 @@ class AddData:
             self.portalUser = config_data["portal"]["username"]
             self.portalPass = config_data["portal"]["password"]
             self.webmapName = config_data["portal"]["webmap"]
-            self.portalConnection = arcpy.SignInToPortal(
-                self.portalUrl, self.portalUser, self.portalPass
-            )
+            # One sign in for the whole process, shared by every raster
+            self.portal = get_session(self.portalUrl, self.portalUser, self.portalPass)
+            self.portalConnection = self.portal.connection()
             return True
 
         except FileNotFoundError:
@@ -79,36 +123,89 @@ class AddData:
 
     def _download_raster(self) -> str:
         """Read the data from the s3 bucket and download a tif image
-        if it has a projection different than 3857, it projects it to 3857
         return the path to the image"""
         log.info(f" Downloading {self.s3_path}")
         pattern = r"\.(?!(tif|tiff))"
         result = re.sub(pattern, "_", self.path["Key"].split("/")[-1])
-        local_path = self.temp_path + result
-        temp_full_path = os.path.abspath(self.temp_path)
+        local_path = os.path.join(self._get_work_path(), result)
         try:
-            self.s3.download_file(self.path["Bucket"], self.path["Key"], local_path)
+            if self.cache is not None:
+                self.cache.fetch(
+                    self.s3, self.path["Bucket"], self.path["Key"], local_path
+                )
+            else:
+                self.s3.download_file(
+                    self.path["Bucket"],
+                    self.path["Key"],
+                    local_path,
+                    Config=DEFAULT_TRANSFER_CONFIG,
+                )
         except (OSError, Exception) as e:
             log.error(f" Error downloading {self.s3_path}")
             log.error(e)
             return False
-        out_coor_system = arcpy.Describe(os.path.abspath(local_path)).spatialReference
+        return os.path.abspath(local_path)
+
+    def _get_reprojection_engine(self, reprojection: str) -> str:
+        """Resolve the reprojection engine, gdal is used when rasterio is available"""
+        if reprojection == "auto":
+            try:
+                import rasterio  # noqa: F401
+
+                return "gdal"
+            except ImportError:
+                return "arcpy"
+        if reprojection not in ("gdal", "arcpy"):
+            raise ValueError(f"Unknown reprojection engine {reprojection}")
+        return reprojection
+
+    def _project_raster(self, local_path: str) -> str:
+        """If the image has a projection different than 3857, it projects it to 3857
+        return the path to the image"""
+        if self.reprojection == "gdal":
+            return self._project_raster_gdal(local_path)
+        import arcpy
+
+        out_coor_system = arcpy.Describe(local_path).spatialReference
         if out_coor_system.factoryCode != 3857:
             log.info(f" Projecting {self.s3_path} to 3857")
             sr = arcpy.SpatialReference(3857)
             new_path = re.sub(r"\.(tif|tiff)$", r"_proj.\1", local_path)
-            arcpy.ProjectRaster_management(local_path, os.path.abspath(new_path), sr)
+            arcpy.ProjectRaster_management(local_path, new_path, sr)
             os.remove(local_path)
-            files = [f for f in os.listdir(temp_full_path)]
-            for f in files:
-                source_file = os.path.join(temp_full_path, f)
-                destination_file = os.path.join(temp_full_path, f.replace("_proj", ""))
-                os.rename(source_file, destination_file)
+            # The files of the projected raster take the original name back
+            temp_full_path = os.path.dirname(new_path)
+            proj_name = os.path.basename(new_path)
+            proj_stem = proj_name[: proj_name.rindex(".")]
+            for f in os.listdir(temp_full_path):
+                if f.startswith(proj_stem + "."):
+                    os.rename(
+                        os.path.join(temp_full_path, f),
+                        os.path.join(
+                            temp_full_path,
+                            proj_stem[: -len("_proj")] + f[len(proj_stem) :],
+                        ),
+                    )
             log.info(f" {self.s3_path} projected to 3857")
-        return os.path.abspath(local_path)
+        return local_path
+
+    def _project_raster_gdal(self, local_path: str) -> str:
+        """Project the image to 3857 with the windowed GDAL engine
+        return the path to the image"""
+        from .reproject import get_epsg, reproject_raster
+
+        if get_epsg(local_path) != 3857:
+            log.info(f" Projecting {self.s3_path} to 3857")
+            new_path = re.sub(r"\.(tif|tiff)$", r"_proj.\1", local_path)
+            reproject_raster(local_path, new_path, "EPSG:3857")
+            os.replace(new_path, local_path)
+            log.info(f" {self.s3_path} projected to 3857")
+        return local_path
 
     def create_project(self) -> str:
         """Create a project in the temp folder, adding image and symbology to it"""
+        import arcpy
+
         project_temp = arcpy.mp.ArcGISProject(self.template)
 
         m_temp = project_temp.listMaps()[0]
@@ -117,10 +214,10 @@ class AddData:
         lyrs_temp[0].name = lyrs_temp[0].name.replace(".tiff", "").replace(".tif", "")
         self.service_name = lyrs_temp[0].name
         new_project_path = os.path.join(
-            os.path.abspath(self.temp_path), f"{self.service_name}.aprx"
+            os.path.abspath(self._get_work_path()), f"{self.service_name}.aprx"
         )
         log.info(self.service_name)
-        arcpy.ApplySymbologyFromLayer_management(lyrs_temp[0], self.symbology)
+        arcpy.ApplySymbologyFromLayer_management(lyrs_temp[0], self.layer_symbology)
         project_temp.saveACopy(new_project_path)
         ## Adding elements from the new project
         self.project = arcpy.mp.ArcGISProject(new_project_path)
@@ -132,7 +229,7 @@ class AddData:
     def create_draft(self, cache_dir="/cloudStores/lwi_goconsequence_cache"):
         """Create a draft for the raster service"""
         self.sddraftPath = os.path.abspath(
-            os.path.join(self.temp_path, self.service_name + ".sddraft")
+            os.path.join(self._get_work_path(), self.service_name + ".sddraft")
         )
         server_type = "FEDERATED_SERVER"
         sharing_draft = self.m.getWebLayerSharingDraft(
@@ -151,24 +248,23 @@ class AddData:
         sharing_draft.portalFolder = self.serverFolder
         sharing_draft.serverFolder = self.serverFolder
         sharing_draft.copyDataToServer = False
+        # Updates keep the service and its cache, the changed tiles are rebuilt later
+        sharing_draft.overwriteExistingService = self.update
         sharing_draft.exportToSDDraft(self.sddraftPath)
-        configure_mapserver_capabilities(self.sddraftPath, "Map")
-        activate_cache(self.sddraftPath)
-        change_cache_dir(cache_dir, self.sddraftPath)
+        # All the edits are applied to one parsed document, written once
+        sddraft = SddraftDocument(self.sddraftPath)
+        sddraft.configure_capabilities("Map")
+        sddraft.activate_cache()
+        sddraft.set_cache_dir(cache_dir)
         # Change following to "true" to share
         SharetoOrganization = "false"
         SharetoEveryone = "true"
         SharetoGroup = "false"
         # if there are more than one Put the ID seaparated by commas
         GroupID = ""
-        share_options(
-            SharetoOrganization,
-            SharetoEveryone,
-            SharetoGroup,
-            self.sddraftPath,
-            GroupID,
-        )
-        edit_scales(self.sddraftPath, self.min_scale, self.max_scale)
+        sddraft.share(SharetoOrganization, SharetoEveryone, SharetoGroup, GroupID)
+        sddraft.set_scales(self.min_scale, self.max_scale)
+        sddraft.save()
 
     def _get_region(self) -> str:
         """Get the region from the s3 path"""
@@ -179,10 +275,11 @@ class AddData:
 
         return f"Region {region}"
 
-    def publish_raster(self) -> None:
-        """Publish the raster service usig the dratf created"""
+    def publish_raster(self) -> bool:
+        """Publish the raster service usig the dratf created
+        returns: bool - The service was published and its cache generated"""
         self.sdPath = os.path.abspath(
-            os.path.join(self.temp_path, self.service_name + ".sd")
+            os.path.join(self._get_work_path(), self.service_name + ".sd")
         )
         input_service = (
             self.serverUrl
@@ -193,6 +290,8 @@ class AddData:
             + "/MapServer"
         )
 
+        import arcpy
+
         try:
             arcpy.server.StageService(
                 self.sddraftPath, self.sdPath, staging_version=209
@@ -209,17 +308,59 @@ class AddData:
                     str(stage_exception)
                 )
             )
-        # Generating cache only for scales defined
-        arcpy.server.ManageMapServerCacheTiles(
-            input_service, self.scales, "RECREATE_ALL_TILES"
+            # The published service and its signatures are left as they are
+            return False
+        return self._cache_tiles(input_service)
+
+    def _changed_extents(self):
+        """Return the extents that differ from the published raster,
+        None when the whole cache has to be generated"""
+        if self.signatures is None:
+            return None
+        from .diff import changed_extents, window_signatures
+
+        self.new_signatures = window_signatures(self.raster_path)
+        if not self.update:
+            return None
+        return changed_extents(
+            self.signatures.load(self.service_name), self.new_signatures
         )
 
+    def _cache_tiles(self, input_service: str) -> bool:
+        """Generate the cache for the scales defined, only in the changed area of updates
+        The signatures of the raster are saved once its cache is generated, a failed
+        cache is rebuilt from the previous signatures by the next update.
+        returns: bool - The cache was generated"""
+        import arcpy
+
+        try:
+            extents = self._changed_extents()
+            if extents is None:
+                arcpy.server.ManageMapServerCacheTiles(
+                    input_service, self.scales, "RECREATE_ALL_TILES"
+                )
+            else:
+                log.info(f" {len(extents)} changed areas in {self.s3_path}")
+                for xmin, ymin, xmax, ymax in extents:
+                    arcpy.server.ManageMapServerCacheTiles(
+                        input_service,
+                        self.scales,
+                        "RECREATE_ALL_TILES",
+                        update_extent=f"{xmin} {ymin} {xmax} {ymax}",
+                    )
+        except Exception as cache_exception:
+            log.error(f" Cache of {input_service} not generated - {cache_exception}")
+            return False
+        if self.new_signatures is not None:
+            self.signatures.save(self.service_name, self.new_signatures)
+        return True
+
     def add_to_webmap(self) -> bool:
         """Add the raster to the webmap"""
+        from arcgis.mapping import WebMap
+
         try:
-            gis = GIS(
-                self.portalUrl, self.portalUser, self.portalPass, verify_cert=True
-            )
+            gis = self.portal.get_gis()
 
             for item_s in gis.content.search(self.webmapName, item_type="Web Map"):
                 log.info(f"Working on {item_s.title} webmap")
@@ -248,42 +389,163 @@ class AddData:
 
     def create_layer_id(self, layerIndex: int) -> str:
         """Create a layer id for the webmap"""
-        return (
-            "".join(random.choices(string.ascii_lowercase + string.digits, k=11))
-            + "-layer-"
-            + str(layerIndex)
-        )
+        return create_layer_id(layerIndex)
 
     def get_region_index(self, region_name: str, layers: list) -> int:
         """Get the index of the region in the webmap"""
-        for i, dictionary in enumerate(layers):
-            if dictionary.get("title") == region_name:
-                return i
+        return get_region_index(region_name, layers)
+
+    def _get_work_path(self) -> str:
+        """Return the scratch folder of this raster, created on first use"""
+        if self.work_path is None:
+            name = os.path.splitext(self.path["Key"].split("/")[-1])[0]
+            self.work_path = tempfile.mkdtemp(prefix=f"{name}_", dir=self.temp_path)
+        return self.work_path
+
+    def input_size(self) -> int:
+        """Return the size in bytes of the raster in the s3 bucket"""
+        head = self.s3.head_object(Bucket=self.path["Bucket"], Key=self.path["Key"])
+        return head["ContentLength"]
 
     def clean_local(self) -> None:
-        """Clean the local resources"""
-        import shutil
+        """Clean the local resources of this raster (its whole scratch folder)"""
+        if self.work_path is not None:
+            shutil.rmtree(self.work_path, ignore_errors=True)
+            self.work_path = None
 
-        shutil.rmtree(self.temp_path)
+    def _renew_sign_in(self) -> None:
+        """Sign in again if the shared token expires soon, long runs outlive it"""
+        if self.portal is not None:
+            self.portal.connection()
 
-    def execute(self) -> bool:
-        """Execute the pipeline"""
+    def download(self) -> None:
+        """Pipeline stage: download the raster from the s3 bucket"""
+        self.raster_path = self._download_raster()
+        if not self.raster_path:
+            raise RuntimeError(f"{self.s3_path} could not be downloaded")
+
+    def reproject(self) -> None:
+        """Pipeline stage: project the raster to 3857 when needed"""
+        if self.reprojection == "arcpy":
+            self.raster_path = run_on_arcpy_thread(
+                self._project_raster, self.raster_path
+            )
+        else:
+            self.raster_path = self._project_raster(self.raster_path)
+
+    def _quantize_raster(self) -> None:
+        """Encode the depths as integer codes and rescale the symbology to the codes"""
+        from .quantize import quantization_plan, quantize_raster, write_symbology
+        from .tiles import load_colormap
+
+        colormap = load_colormap(self.symbology)
+        plan = quantization_plan(
+            colormap["upper_bounds"], colormap["minimum"], self.quantize
+        )
+        encoded_path = re.sub(r"\.(tif|tiff)$", r"_q.\1", self.raster_path)
+        report = quantize_raster(self.raster_path, encoded_path, plan)
+        if report["class_mismatches"]:
+            os.remove(encoded_path)
+            raise ValueError(
+                f"{report['class_mismatches']} pixels of {self.s3_path} change their "
+                f"class when encoded as {self.quantize}"
+            )
+        os.replace(encoded_path, self.raster_path)
+        self.layer_symbology = write_symbology(
+            self.symbology,
+            os.path.join(self._get_work_path(), "raster_quantized.lyrx"),
+            plan,
+        )
+        self.quantization_report = report
+
+    def optimize(self) -> None:
+        """Pipeline stage: quantize the depths and convert the raster to COG when they
+        are enabled"""
+        if self.quantize:
+            log.info(f" Encoding {self.s3_path} as {self.quantize}")
+            self._quantize_raster()
+        if not self.cog:
+            return
+        from .cog import convert_to_cog
+
+        log.info(f" Converting {self.s3_path} to COG")
+        cog_path = re.sub(r"\.(tif|tiff)$", r"_cog.\1", self.raster_path)
+        convert_to_cog(self.raster_path, cog_path, self.scales.split(";"))
+        os.replace(cog_path, self.raster_path)
+
+    def prepare(self) -> None:
+        """Pipeline stage: create the project and the service draft"""
+        log.info(f" Creating Project for {self.s3_path}")
         self.create_project()
+        log.info(f" Creating draft for {self.s3_path}")
+        self._renew_sign_in()
         self.create_draft()
+
+    def publish(self) -> None:
+        """Pipeline stage: stage, upload and cache the service"""
+        log.info(f" Publishing {self.s3_path}")
+        self._renew_sign_in()
+        if not self.publish_raster():
+            raise RuntimeError(f"{self.s3_path} could not be published")
+
+    def index_footprint(self) -> None:
+        """Pipeline stage: store the valid-data footprint of the published raster"""
+        if self.footprints is None:
+            return
+        from .footprint import compute_footprint
+
+        log.info(f" Computing the footprint of {self.s3_path}")
+        footprint = compute_footprint(self.raster_path)
+        self.footprints.save(self.service_name, self.s3_path, self.region, footprint)
+
+    def index_statistics(self) -> None:
+        """Pipeline stage: store the depth statistics of the raster, per region when the
+        region table is configured"""
+        if self.statistics is None:
+            return
+        from .stats import compute_statistics
+        from .tiles import load_colormap
+
+        log.info(f" Computing the depth statistics of {self.s3_path}")
+        colormap = load_colormap(self.symbology)
+        zones = (
+            self.statistics.load_zones(self.region_table) if self.region_table else None
+        )
+        results = compute_statistics(
+            self.raster_path, colormap["upper_bounds"], colormap["minimum"], zones
+        )
+        self.statistics.save(
+            self.service_name, self.s3_path, results, colormap["upper_bounds"]
+        )
+
+    def update_webmap(self) -> None:
+        """Pipeline stage: add the service to the webmap"""
+        if self.update:
+            # The layer of an overwritten service is already in the webmap
+            return
+        if self.webmap_changes is not None:
+            self.webmap_changes.add(self.service_name, self.region)
+            return
+        log.info(f" Adding {self.s3_path} to webmap")
+        self.add_to_webmap()
+
+    def execute(self) -> bool:
+        """Execute the pipeline"""
         try:
-            log.info(f" Creating Project for {self.s3_path}")
-
-            log.info(f" Creating draft for {self.s3_path}")
-            self.create_draft()
-            log.info(f" Publishing {self.s3_path}")
-            self.publish_raster()
-            log.info(f" Adding {self.s3_path} to webmap")
-            self.add_to_webmap()
-            log.info(f" Cleaning local resources for {self.s3_path}")
-            self.clean_local()
+            self.download()
+            self.reproject()
+            self.optimize()
+            self.prepare()
+            self.publish()
+            self.index_footprint()
+            self.index_statistics()
+            self.update_webmap()
             log.info(f" Finished processing {self.s3_path}")
             return True
         except Exception as e:
             log.error(f" Error processing {self.s3_path}")
             log.error(e)
             return False
+        finally:
+            log.info(f" Cleaning local resources for {self.s3_path}")
+            self.clean_local()
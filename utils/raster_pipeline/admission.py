@@ -0,0 +1,62 @@
+import logging
+import shutil
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class DiskAdmission:
+    def __init__(
+        self,
+        path: str,
+        expansion: float = 4.0,
+        budget_bytes: int = None,
+        reserve_bytes: int = 10 * 1024**3,
+        disk_usage=shutil.disk_usage,
+    ):
+        """Define an admission controller that only lets a raster start when its projected
+        disk footprint (input size x expansion) fits in the free space budget
+        parameters:
+        path: str - Folder where the rasters are processed
+        expansion: float - Disk used by a raster relative to its input size (download,
+                           reprojected copy, COG and intermediate files)
+        budget_bytes: int - Disk that the rasters in progress may use, by default the free
+                            space of path minus reserve_bytes when the controller is created
+        reserve_bytes: int - Free space always left on the disk
+        disk_usage: callable - Returns the usage of path (shutil.disk_usage)"""
+        self.expansion = expansion
+        if budget_bytes is None:
+            budget_bytes = max(disk_usage(path).free - reserve_bytes, 0)
+        self.budget_bytes = budget_bytes
+        self.reserved = 0
+        self.active = 0
+        self._condition = threading.Condition()
+
+    def footprint(self, input_bytes: int) -> int:
+        """Return the projected disk footprint of an input"""
+        return int(input_bytes * self.expansion)
+
+    def acquire(self, input_bytes: int) -> int:
+        """Wait until the footprint of the input fits the budget and reserve it
+        A raster larger than the whole budget is admitted alone, so it can not wait forever.
+        returns: int - Reserved bytes, to be given back to release()"""
+        need = self.footprint(input_bytes)
+        with self._condition:
+            while self.active and self.reserved + need > self.budget_bytes:
+                log.info(
+                    f" Waiting for disk space: {need} bytes needed, "
+                    f"{self.budget_bytes - self.reserved} available"
+                )
+                self._condition.wait()
+            if need > self.budget_bytes:
+                log.warning(f" {need} bytes needed, more than the disk budget")
+            self.reserved += need
+            self.active += 1
+            return need
+
+    def release(self, reserved: int) -> None:
+        """Give back the space reserved for a raster once its files are removed"""
+        with self._condition:
+            self.reserved -= reserved
+            self.active -= 1
+            self._condition.notify_all()
@@ -0,0 +1,124 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from boto3.s3.transfer import TransferConfig
+
+log = logging.getLogger(__name__)
+
+# Depth grids are several GB: large parts downloaded by many threads
+DEFAULT_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=64 * 1024 * 1024,
+    multipart_chunksize=64 * 1024 * 1024,
+    max_concurrency=16,
+    use_threads=True,
+)
+
+
+class RasterCache:
+    def __init__(self, cache_path: str, max_bytes: int, transfer_config=None):
+        """Define a persistent local cache of the rasters downloaded from S3
+        Entries are addressed by bucket, key and ETag, so a republished or retried raster
+        is never transferred twice while a modified object is always downloaded again.
+        The least recently used entries are removed when the cache exceeds max_bytes,
+        except the entries pinned by a fetch that has not linked them yet.
+        parameters:
+        cache_path: str - Folder of the cache
+        max_bytes: int - Disk budget of the cache in bytes
+        transfer_config: TransferConfig - Multipart settings used to download misses"""
+        self.cache_path = os.path.abspath(cache_path)
+        self.max_bytes = max_bytes
+        self.transfer_config = transfer_config or DEFAULT_TRANSFER_CONFIG
+        self._lock = threading.Lock()
+        # {entry path: number of fetches using it}, guarded by _lock
+        self._pinned = {}
+        os.makedirs(self.cache_path, exist_ok=True)
+
+    def _entry_path(self, bucket: str, key: str, etag: str) -> str:
+        """Return the cache file of an object version"""
+        digest = hashlib.sha256(f"{bucket}/{key}/{etag}".encode()).hexdigest()
+        extension = os.path.splitext(key)[1]
+        return os.path.join(self.cache_path, digest + extension)
+
+    def fetch(self, s3, bucket: str, key: str, destination: str = None) -> str:
+        """Return the path of the cached copy of s3://bucket/key, downloading it on a miss
+        The entry is pinned until it is linked to the destination, so the eviction of a
+        concurrent fetch can not remove it in between.
+        parameters:
+        s3: boto3 S3 client
+        bucket: str - Bucket of the raster
+        key: str - Key of the raster
+        destination: str - Working copy linked to the entry (optional), returned instead
+        of the entry"""
+        head = s3.head_object(Bucket=bucket, Key=key)
+        entry = self._entry_path(bucket, key, head["ETag"].strip('"'))
+        with self._lock:
+            self._pinned[entry] = self._pinned.get(entry, 0) + 1
+        try:
+            if os.path.exists(entry):
+                log.info(f" Cache hit for s3://{bucket}/{key}")
+                # The modification time orders the entries for the LRU eviction
+                os.utime(entry)
+            else:
+                log.info(f" Cache miss for s3://{bucket}/{key}")
+                self._download(s3, bucket, key, entry)
+                self.evict()
+            if destination is None:
+                return entry
+            return self.link(entry, destination)
+        finally:
+            with self._lock:
+                self._pinned[entry] -= 1
+                if not self._pinned[entry]:
+                    del self._pinned[entry]
+
+    def _download(self, s3, bucket: str, key: str, entry: str) -> None:
+        """Download an object to a partial file renamed to the entry when complete"""
+        fd, partial = tempfile.mkstemp(dir=self.cache_path, suffix=".part")
+        os.close(fd)
+        try:
+            s3.download_file(bucket, key, partial, Config=self.transfer_config)
+            os.replace(partial, entry)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    def entries(self) -> list:
+        """Return the cache entries (path, size, last use) from the oldest to the newest"""
+        entries = []
+        for f in os.listdir(self.cache_path):
+            if f.endswith(".part"):
+                continue
+            stat = os.stat(os.path.join(self.cache_path, f))
+            entries.append(
+                (os.path.join(self.cache_path, f), stat.st_size, stat.st_mtime)
+            )
+        return sorted(entries, key=lambda e: e[2])
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache fits its budget, the
+        pinned entries are kept"""
+        with self._lock:
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            for path, size, _ in entries:
+                if total <= self.max_bytes:
+                    break
+                if path in self._pinned:
+                    continue
+                log.info(f" Evicting {path} from the raster cache")
+                os.remove(path)
+                total -= size
+
+    def link(self, entry: str, destination: str) -> str:
+        """Place a cached raster in a working folder without copying it when possible
+        (the hard link keeps the data alive even if the entry is evicted)"""
+        if os.path.exists(destination):
+            os.remove(destination)
+        try:
+            os.link(entry, destination)
+        except OSError:
+            shutil.copy2(entry, destination)
+        return destination
@@ -0,0 +1,106 @@
+"""Cloud-Optimized GeoTIFF conversion with overviews matching the map service cache scales"""
+
+import logging
+import math
+import os
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+
+log = logging.getLogger(__name__)
+
+# Size of a pixel at 96 dpi: ground meters per pixel = scale * INCHES_TO_METERS / DPI
+INCHES_TO_METERS = 0.0254
+DPI = 96
+
+
+def overview_factors(
+    resolution: float, scales: list, shape: tuple, min_size: int = 256
+) -> list:
+    """Return the power of two overview factors matching the cache scales
+    parameters:
+    resolution: float - Pixel size of the raster in meters (EPSG:3857)
+    scales: list - Cache scales e.g. [9244648.868618, ..., 9027.977411]
+    shape: tuple - (height, width) of the raster
+    min_size: int - Smallest overview side worth storing"""
+    factors = set()
+    for scale in scales:
+        ratio = float(scale) * INCHES_TO_METERS / DPI / resolution
+        if ratio < 1.5:
+            # The full resolution serves this scale
+            continue
+        factor = 2 ** round(math.log2(ratio))
+        if max(shape) / factor >= min_size:
+            factors.add(factor)
+    return sorted(factors)
+
+
+def convert_to_cog(
+    src_path: str,
+    dst_path: str,
+    scales: list,
+    block_size: int = 512,
+    compress: str = "deflate",
+    resampling: Resampling = Resampling.nearest,
+) -> str:
+    """Convert a raster to a Cloud-Optimized GeoTIFF with internal tiling, compression
+    and overviews aligned to the cache scales, then validate the result
+    parameters:
+    src_path: str - Raster to convert
+    dst_path: str - Output COG
+    scales: list - Cache scales of the service
+    block_size: int - Internal tile size
+    compress: str - Compression of the tiles and overviews
+    resampling: Resampling - Resampling used to build the overviews
+    returns: str - dst_path"""
+    with rasterio.open(src_path) as src:
+        factors = overview_factors(src.res[0], scales, src.shape)
+    tiled_path = dst_path + ".tiled.tif"
+    try:
+        log.info(f" Building overviews {factors} for {src_path}")
+        rasterio.shutil.copy(
+            src_path,
+            tiled_path,
+            driver="GTiff",
+            tiled=True,
+            blockxsize=block_size,
+            blockysize=block_size,
+            BIGTIFF="IF_SAFER",
+        )
+        with rasterio.open(tiled_path, "r+") as tiled:
+            if factors:
+                tiled.build_overviews(factors, resampling)
+        rasterio.shutil.copy(
+            tiled_path,
+            dst_path,
+            driver="COG",
+            BLOCKSIZE=block_size,
+            COMPRESS=compress.upper(),
+            PREDICTOR="YES",
+            OVERVIEWS="FORCE_USE_EXISTING" if factors else "NONE",
+            BIGTIFF="IF_SAFER",
+        )
+    finally:
+        if os.path.exists(tiled_path):
+            os.remove(tiled_path)
+    validate_cog(dst_path, len(factors), block_size)
+    log.info(f" {dst_path} converted to COG")
+    return dst_path
+
+
+def validate_cog(path: str, overview_count: int, block_size: int) -> None:
+    """Check the layout of a COG, it raises ValueError when it is not valid"""
+    with rasterio.open(path) as ds:
+        errors = []
+        if ds.tags(ns="IMAGE_STRUCTURE").get("LAYOUT") != "COG":
+            errors.append("the file does not have the COG layout")
+        if ds.block_shapes[0] != (block_size, block_size):
+            errors.append(f"internal tiles are {ds.block_shapes[0]}")
+        if len(ds.overviews(1)) != overview_count:
+            errors.append(
+                f"{len(ds.overviews(1))} overviews found, {overview_count} expected"
+            )
+        if ds.compression is None:
+            errors.append("the file is not compressed")
+    if errors:
+        raise ValueError(f"Invalid COG {path}: {', '.join(errors)}")
@@ -1,20 +1,35 @@
 import yaml
 import logging
-import arcpy
-from arcgis.mapping import WebMap
-from arcgis.gis import GIS
+from .portal import get_session
 
 log = logging.getLogger(__name__)
 
 
 class DeleteData:
-    def __init__(self, path, s3, config_file="credentials.yaml"):
+    def __init__(
+        self,
+        path,
+        s3,
+        config_file="credentials.yaml",
+        signatures=None,
+        webmap_changes=None,
+        footprints=None,
+        statistics=None,
+    ):
         """Define a class to delete cache, remove from a webmap a raster punlished
         parameters:
         path: dict - Contains the bucket and key of the file to be processed
-        s3: S3 Client using boto3"""
+        s3: S3 Client using boto3
+        signatures: SignatureStore - Window checksums of the published rasters (optional)
+        webmap_changes: WebmapChanges - Collects the webmap layers of the run, the caller
+                                        applies them before execute() (optional)
+        footprints: FootprintIndex - Valid-data footprints of the rasters (optional)
+        statistics: StatisticsStore - Depth statistics of the rasters (optional)"""
         self.path = path
         self.s3 = s3
+        self.signatures = signatures
+        self.webmap_changes = webmap_changes
+        self.gis = None
         self.config_file = config_file
 
         self.s3_path = self._get_s3_path()
@@ -25,6 +40,9 @@ class DeleteData:
             .replace(".tif", "")
             .replace(".", "_")
         )
+        self.portal = None
+        self.footprints = footprints
+        self.statistics = statistics
         self._load_config(self.config_file)
         self.region_int = self._get_region_int()
 
@@ -39,9 +57,9 @@ class DeleteData:
             self.portalUser = config_data["portal"]["username"]
             self.portalPass = config_data["portal"]["password"]
             self.webmapName = config_data["portal"]["webmap"]
-            self.portalConnection = arcpy.SignInToPortal(
-                self.portalUrl, self.portalUser, self.portalPass
-            )
+            # One sign in for the whole process, shared by every raster
+            self.portal = get_session(self.portalUrl, self.portalUser, self.portalPass)
+            self.portalConnection = self.portal.connection()
             self.input_service = (
                 self.serverUrl
                 + "/rest/services/"
@@ -61,11 +79,11 @@ class DeleteData:
         return f"s3://{self.path['Bucket']}/{self.path['Key']}"
 
     def remove_from_webmap(self, region_idx: int) -> bool:
+        from arcgis.mapping import WebMap
+
         try:
             """Remove the tile layer from the webmap"""
-            self.gis = GIS(
-                self.portalUrl, self.portalUser, self.portalPass, verify_cert=True
-            )
+            self.gis = self.portal.get_gis()
 
             for item_s in self.gis.content.search(self.webmapName, item_type="Web Map"):
                 log.info(f"Webmap ID {item_s.id}")
@@ -90,9 +108,15 @@ class DeleteData:
             log.error(e)
             return False
 
+    def queue_webmap_removal(self) -> None:
+        """Record the removal of the layer in the webmap changes of the run"""
+        self.webmap_changes.remove(self.service_name)
+
     def delete_layer(self) -> bool:
         """Delete the layer from the server/portal"""
         try:
+            if self.gis is None:
+                self.gis = self.portal.get_gis()
             layer_id = self.gis.content.search(self.service_name)[0].id
             layer_item = self.gis.content.get(layer_id)
             layer_item.delete()
@@ -104,7 +128,11 @@ class DeleteData:
 
     def delete_cache(self) -> bool:
         """Delete the cache for the service"""
+        import arcpy
+
         try:
+            if self.portal is not None:
+                self.portal.connection()
             arcpy.server.DeleteMapServerCache(self.input_service)
         except Exception as e:
             log.error(f"Error deleting the cache for {self.s3_path}")
@@ -123,12 +151,19 @@ class DeleteData:
     def execute(self) -> bool:
         """Execute the pipeline"""
         try:
-            log.info(f"Removing {self.s3_path} from the webmap")
-            self.remove_from_webmap(self.region_int)
+            if self.webmap_changes is None:
+                log.info(f"Removing {self.s3_path} from the webmap")
+                self.remove_from_webmap(self.region_int)
             log.info(f"Deleting cache for {self.s3_path}")
             self.delete_cache()
             log.info(f"Deleting service {self.input_service}")
             self.delete_layer()
+            if self.signatures is not None:
+                self.signatures.remove(self.service_name)
+            if self.footprints is not None:
+                self.footprints.delete(self.service_name)
+            if self.statistics is not None:
+                self.statistics.delete(self.service_name)
             log.info(f"{self.s3_path} deleted")
             return True
         except Exception as e:
@@ -0,0 +1,136 @@
+"""Per-window checksums of the published rasters, used to find the area changed by an update"""
+
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def window_signatures(path: str, block_size: int = 512) -> dict:
+    """Return the checksum of every block_size window of a raster (data and mask)
+    parameters:
+    path: str - Raster in its published projection
+    block_size: int - Side of the windows in pixels
+    returns: dict - grid of the raster and one digest per window, JSON serializable"""
+    import rasterio
+    from rasterio.windows import Window
+
+    windows = {}
+    with rasterio.open(path) as ds:
+        for row in range(0, ds.height, block_size):
+            for col in range(0, ds.width, block_size):
+                window = Window(
+                    col,
+                    row,
+                    min(block_size, ds.width - col),
+                    min(block_size, ds.height - row),
+                )
+                digest = hashlib.blake2b(digest_size=16)
+                for band in range(1, ds.count + 1):
+                    digest.update(ds.read(band, window=window).tobytes())
+                    digest.update(ds.read_masks(band, window=window).tobytes())
+                windows[f"{row // block_size}_{col // block_size}"] = digest.hexdigest()
+        return {
+            "crs": ds.crs.to_string() if ds.crs else None,
+            "transform": list(ds.transform)[:6],
+            "shape": [ds.height, ds.width],
+            "block_size": block_size,
+            "windows": windows,
+        }
+
+
+def cluster_windows(windows: set) -> list:
+    """Group touching windows (8-neighbourhood) and return the bounding box of each group
+    parameters:
+    windows: set - (row, col) indices of the windows
+    returns: list - (row_min, col_min, row_max, col_max) of every group, inclusive"""
+    pending = set(windows)
+    clusters = []
+    while pending:
+        stack = [pending.pop()]
+        rows, cols = [], []
+        while stack:
+            row, col = stack.pop()
+            rows.append(row)
+            cols.append(col)
+            for d_row in (-1, 0, 1):
+                for d_col in (-1, 0, 1):
+                    neighbour = (row + d_row, col + d_col)
+                    if neighbour in pending:
+                        pending.remove(neighbour)
+                        stack.append(neighbour)
+        clusters.append((min(rows), min(cols), max(rows), max(cols)))
+    return sorted(clusters)
+
+
+def changed_extents(previous: dict, current: dict, max_extents: int = 16):
+    """Return the extents of the raster that differ between two signatures
+    parameters:
+    previous: dict - Signatures of the published raster (None if unknown)
+    current: dict - Signatures of the new raster
+    max_extents: int - Above this number of areas a single envelope is returned
+    returns: list - (xmin, ymin, xmax, ymax) in the raster crs, [] when nothing changed,
+                    None when the grids can not be compared and the whole cache is needed"""
+    keys = ("crs", "transform", "shape", "block_size")
+    if previous is None or any(previous[k] != current[k] for k in keys):
+        return None
+    names = set(previous["windows"]) | set(current["windows"])
+    changed = {
+        tuple(int(i) for i in name.split("_"))
+        for name in names
+        if previous["windows"].get(name) != current["windows"].get(name)
+    }
+    clusters = cluster_windows(changed)
+    if len(clusters) > max_extents:
+        clusters = [
+            (
+                min(c[0] for c in clusters),
+                min(c[1] for c in clusters),
+                max(c[2] for c in clusters),
+                max(c[3] for c in clusters),
+            )
+        ]
+    a, _, c, _, e, f = current["transform"]
+    height, width = current["shape"]
+    size = current["block_size"]
+    extents = []
+    for row_min, col_min, row_max, col_max in clusters:
+        xs = np.array([col_min * size, min((col_max + 1) * size, width)]) * a + c
+        ys = np.array([row_min * size, min((row_max + 1) * size, height)]) * e + f
+        extents.append((xs.min(), ys.min(), xs.max(), ys.max()))
+    return extents
+
+
+class SignatureStore:
+    def __init__(self, path: str):
+        """Define a folder keeping the window signatures of each published service
+        parameters:
+        path: str - Folder of the signatures (one JSON file per service)"""
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def _file(self, service_name: str) -> str:
+        return os.path.join(self.path, f"{service_name}.json")
+
+    def load(self, service_name: str):
+        """Return the signatures of a service, None if they are unknown"""
+        try:
+            with open(self._file(service_name), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def save(self, service_name: str, signatures: dict) -> None:
+        """Store the signatures of a service once its cache is up to date"""
+        temp = self._file(service_name) + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(signatures, f)
+        os.replace(temp, self._file(service_name))
+
+    def remove(self, service_name: str) -> None:
+        """Forget a deleted service"""
+        if os.path.exists(self._file(service_name)):
+            os.remove(self._file(service_name))
@@ -0,0 +1,190 @@
+"""Valid-data footprint of the depth rasters and its PostGIS index"""
+
+import logging
+import numpy as np
+from sqlalchemy import create_engine, text
+
+log = logging.getLogger(__name__)
+
+
+def compute_footprint(
+    path: str, factor: int = 8, window_size: int = 4096, simplify: bool = True
+) -> dict:
+    """Return the polygon covering the valid pixels of a raster
+    The mask is read window by window and reduced to cells of factor x factor pixels,
+    a cell is valid when any of its pixels is, so no flooded area is lost.
+    parameters:
+    path: str - Raster to describe
+    factor: int - Pixels per side of the footprint cells
+    window_size: int - Pixels per side of the windows read at a time (multiple of factor)
+    simplify: bool - Simplify the polygon with half the cell size as tolerance
+    returns: dict - geometry (shapely, raster crs), epsg, raster bounds, valid pixels"""
+    import rasterio
+    import shapely
+    from affine import Affine
+    from rasterio.features import shapes
+    from rasterio.windows import Window
+    from shapely.geometry import shape
+
+    window_size = max(window_size // factor, 1) * factor
+    parts = []
+    valid_pixels = 0
+    with rasterio.open(path) as ds:
+        for row in range(0, ds.height, window_size):
+            for col in range(0, ds.width, window_size):
+                window = Window(
+                    col,
+                    row,
+                    min(window_size, ds.width - col),
+                    min(window_size, ds.height - row),
+                )
+                mask = ds.read_masks(1, window=window) > 0
+                count = int(mask.sum())
+                if count == 0:
+                    continue
+                valid_pixels += count
+                # Pad to whole cells and keep the cells holding any valid pixel
+                height = -(-mask.shape[0] // factor) * factor
+                width = -(-mask.shape[1] // factor) * factor
+                padded = np.zeros((height, width), dtype=bool)
+                padded[: mask.shape[0], : mask.shape[1]] = mask
+                cells = padded.reshape(
+                    height // factor, factor, width // factor, factor
+                ).any(axis=(1, 3))
+                transform = ds.window_transform(window) * Affine.scale(factor)
+                parts.extend(
+                    shape(geom)
+                    for geom, _ in shapes(
+                        cells.astype(np.uint8), mask=cells, transform=transform
+                    )
+                )
+        geometry = shapely.union_all(parts) if parts else shapely.MultiPolygon()
+        if simplify and not geometry.is_empty:
+            # Half a cell removes the staircase of the cell edges, not the small areas
+            geometry = geometry.simplify(
+                abs(ds.res[0]) * factor / 2, preserve_topology=True
+            )
+        return {
+            "geometry": geometry,
+            "epsg": ds.crs.to_epsg() if ds.crs else None,
+            "bounds": tuple(ds.bounds),
+            "valid_pixels": valid_pixels,
+        }
+
+
+class FootprintIndex:
+    def __init__(self, engine, table: str = "raster_footprints"):
+        """Define the table keeping the valid-data footprint of every published raster
+        Footprints are stored in EPSG:3857 with a GIST index, so the rasters covering a
+        place are found with an index lookup instead of reading pixels.
+        parameters:
+        engine: SQLAlchemy engine of the database
+        table: str - Name of the footprint table"""
+        self.engine = engine
+        self.table = table
+        self._created = False
+
+    def create_table(self) -> None:
+        """Create the table and its spatial index if they do not exist"""
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                    "service_name text PRIMARY KEY, "
+                    "path_aws text, "
+                    "region text, "
+                    "valid_pixels bigint, "
+                    "raster_extent geometry(Polygon, 3857), "
+                    "data_extent geometry(Polygon, 3857), "
+                    "shape geometry(MultiPolygon, 3857), "
+                    "updated timestamptz DEFAULT now())"
+                )
+            )
+            conn.execute(
+                text(
+                    f"CREATE INDEX IF NOT EXISTS {self.table}_shape_idx "
+                    f"ON {self.table} USING GIST (shape)"
+                )
+            )
+
+    def save(
+        self, service_name: str, path_aws: str, region: str, footprint: dict
+    ) -> None:
+        """Insert or replace the footprint of a service"""
+        import shapely
+
+        if not self._created:
+            self.create_table()
+            self._created = True
+
+        geometry = footprint["geometry"]
+        srid = footprint["epsg"] or 3857
+        envelope = (
+            "ST_Transform(ST_MakeEnvelope(:xmin, :ymin, :xmax, :ymax, :srid), 3857)"
+        )
+        shape_sql = "ST_Multi(ST_Transform(ST_GeomFromWKB(:wkb, :srid), 3857))"
+        xmin, ymin, xmax, ymax = footprint["bounds"]
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    f"INSERT INTO {self.table} (service_name, path_aws, region, "
+                    "valid_pixels, raster_extent, data_extent, shape, updated) "
+                    f"VALUES (:service_name, :path_aws, :region, :valid_pixels, "
+                    f"{envelope}, ST_Envelope({shape_sql}), {shape_sql}, now()) "
+                    "ON CONFLICT (service_name) DO UPDATE SET "
+                    "path_aws = EXCLUDED.path_aws, region = EXCLUDED.region, "
+                    "valid_pixels = EXCLUDED.valid_pixels, "
+                    "raster_extent = EXCLUDED.raster_extent, "
+                    "data_extent = EXCLUDED.data_extent, "
+                    "shape = EXCLUDED.shape, updated = EXCLUDED.updated"
+                ),
+                {
+                    "service_name": service_name,
+                    "path_aws": path_aws,
+                    "region": region,
+                    "valid_pixels": footprint["valid_pixels"],
+                    "xmin": xmin,
+                    "ymin": ymin,
+                    "xmax": xmax,
+                    "ymax": ymax,
+                    "srid": srid,
+                    "wkb": None if geometry.is_empty else shapely.to_wkb(geometry),
+                },
+            )
+        log.info(f" Footprint of {service_name} saved in {self.table}")
+
+    def delete(self, service_name: str) -> None:
+        """Remove the footprint of a deleted service"""
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(f"DELETE FROM {self.table} WHERE service_name = :service_name"),
+                {"service_name": service_name},
+            )
+
+    def covering(self, x: float, y: float, srid: int = 4326) -> list:
+        """Return the services holding valid data at a point"""
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                text(
+                    f"SELECT service_name FROM {self.table} WHERE ST_Intersects(shape, "
+                    "ST_Transform(ST_SetSRID(ST_MakePoint(:x, :y), :srid), 3857)) "
+                    "ORDER BY service_name"
+                ),
+                {"x": x, "y": y, "srid": srid},
+            )
+            return [row[0] for row in rows]
+
+
+def load_footprint_index(config_data: dict):
+    """Return the FootprintIndex of the database in the configuration,
+    None when no table of type footprints is configured"""
+    db = config_data.get("database")
+    if not db:
+        return None
+    tables = [t["name"] for t in db.get("raster", []) if t["type"] == "footprints"]
+    if not tables:
+        return None
+    engine = create_engine(
+        f"postgresql://{db['user']}:{db['password']}@{db['host']}:{db['port']}/{db['database']}"
+    )
+    return FootprintIndex(engine, tables[0])
@@ -0,0 +1,186 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# Marks the end of the items sent to a stage
+_DONE = object()
+
+# ArcPy is not thread safe: all the arcpy work of the process runs on this one thread
+_ARCPY_LOCAL = threading.local()
+_ARCPY_THREAD = ThreadPoolExecutor(
+    max_workers=1,
+    thread_name_prefix="arcpy",
+    initializer=lambda: setattr(_ARCPY_LOCAL, "inside", True),
+)
+# Stages of publishing_pipeline calling arcpy (arcpy.mp, StageService, cache tiles)
+ARCPY_STAGES = ("prepare", "publish")
+
+
+def run_on_arcpy_thread(func, *args):
+    """Run func on the arcpy thread and return its result (errors are raised here)"""
+    if getattr(_ARCPY_LOCAL, "inside", False):
+        return func(*args)
+    return _ARCPY_THREAD.submit(func, *args).result()
+
+
+class Stage:
+    def __init__(self, name: str, func, workers: int = 1, arcpy: bool = False):
+        """Define a step of a StagedPipeline
+        parameters:
+        name: str - Name of the stage (used in logs and results)
+        func: callable - Function applied to each item, it raises to mark the item as failed
+        workers: int - Number of items processed by the stage at the same time
+        arcpy: bool - The function calls arcpy, it runs on the arcpy thread with one
+                      worker"""
+        if arcpy and workers > 1:
+            log.warning(f"Stage {name} calls arcpy, it runs one item at a time")
+            workers = 1
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.arcpy = arcpy
+
+
+class StagedPipeline:
+    def __init__(
+        self,
+        stages: list,
+        queue_size: int = 1,
+        cleanup=None,
+        admission=None,
+        footprint=None,
+    ):
+        """Define a pipeline where every stage has its own bounded pool of workers,
+        so different items can be in different stages at the same time
+        (item N+1 downloads while item N reprojects and item N-1 is staged).
+        A failure only stops the item that failed, the other items keep flowing.
+        parameters:
+        stages: list - Stage objects in execution order
+        queue_size: int - Items waiting in front of each stage, it bounds the
+                          amount of work done ahead of a slow stage
+        cleanup: callable - Function called once for every item when it leaves the pipeline
+        admission: DiskAdmission - Controls when an item may enter the pipeline (optional)
+        footprint: callable - Input size in bytes of an item, used by the admission
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+        self.cleanup = cleanup
+        self.admission = admission
+        self.footprint = footprint
+
+    def run(self, items: list) -> list:
+        """Process the items and return one result per item, in the input order
+        result: dict - item, ok, failed_stage, error and duration of each stage"""
+        items = list(items)
+        results = [
+            {"item": item, "ok": True, "failed_stage": None, "error": None, "times": {}}
+            for item in items
+        ]
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        lock = threading.Lock()
+        # Workers still running per stage, the last one to finish closes the next stage
+        running = [stage.workers for stage in self.stages]
+        threads = []
+
+        reservations = {}
+
+        def finish(idx):
+            result = results[idx]
+            if self.cleanup is not None:
+                try:
+                    self.cleanup(result["item"])
+                except Exception as e:
+                    log.error(f"Error cleaning {result['item']}: {e}")
+            if idx in reservations:
+                self.admission.release(reservations.pop(idx))
+
+        def worker(stage_idx):
+            stage = self.stages[stage_idx]
+            next_queue = queues[stage_idx + 1] if stage_idx + 1 < len(queues) else None
+            while True:
+                idx = queues[stage_idx].get()
+                if idx is _DONE:
+                    break
+                result = results[idx]
+                start = time.perf_counter()
+                try:
+                    if stage.arcpy:
+                        run_on_arcpy_thread(stage.func, result["item"])
+                    else:
+                        stage.func(result["item"])
+                except Exception as e:
+                    name = getattr(result["item"], "s3_path", result["item"])
+                    log.error(f"Stage {stage.name} failed for {name}: {e}")
+                    result.update(ok=False, failed_stage=stage.name, error=e)
+                result["times"][stage.name] = time.perf_counter() - start
+                if result["ok"] and next_queue is not None:
+                    next_queue.put(idx)
+                else:
+                    finish(idx)
+            with lock:
+                running[stage_idx] -= 1
+                last = running[stage_idx] == 0
+            if last and next_queue is not None:
+                for _ in range(self.stages[stage_idx + 1].workers):
+                    next_queue.put(_DONE)
+
+        for stage_idx, stage in enumerate(self.stages):
+            for n in range(stage.workers):
+                thread = threading.Thread(
+                    target=worker, args=(stage_idx,), name=f"{stage.name}-{n}"
+                )
+                thread.start()
+                threads.append(thread)
+        for idx in range(len(items)):
+            if self.admission is not None:
+                start = time.perf_counter()
+                try:
+                    size = self.footprint(items[idx])
+                except Exception as e:
+                    log.error(f"Error reading the size of {items[idx]}: {e}")
+                    size = 0
+                reservations[idx] = self.admission.acquire(size)
+                results[idx]["times"]["admission"] = time.perf_counter() - start
+            queues[0].put(idx)
+        for _ in range(self.stages[0].workers):
+            queues[0].put(_DONE)
+        for thread in threads:
+            thread.join()
+        failed = [r for r in results if not r["ok"]]
+        log.info(f"{len(items) - len(failed)} items processed, {len(failed)} failed")
+        return results
+
+
+def publishing_pipeline(
+    workers: dict = None, cleanup: bool = True, admission=None
+) -> StagedPipeline:
+    """Return the pipeline used to publish raster_pipeline.AddData items
+    parameters:
+    workers: dict - Workers per stage e.g. {"download": 4}, missing stages use one
+                    worker, the arcpy stages (ARCPY_STAGES) always use one
+    cleanup: bool - Remove the local files of each item when it leaves the pipeline
+    admission: DiskAdmission - Start a raster only when its disk footprint fits (optional)"""
+    workers = workers or {}
+    steps = [
+        ("download", lambda item: item.download()),
+        ("reproject", lambda item: item.reproject()),
+        ("optimize", lambda item: item.optimize()),
+        ("prepare", lambda item: item.prepare()),
+        ("publish", lambda item: item.publish()),
+        ("footprint", lambda item: item.index_footprint()),
+        ("statistics", lambda item: item.index_statistics()),
+        ("webmap", lambda item: item.update_webmap()),
+    ]
+    return StagedPipeline(
+        [
+            Stage(name, func, workers.get(name, 1), arcpy=name in ARCPY_STAGES)
+            for name, func in steps
+        ],
+        cleanup=(lambda item: item.clean_local()) if cleanup else None,
+        admission=admission,
+        footprint=lambda item: item.input_size(),
+    )
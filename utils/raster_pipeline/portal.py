@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Sessions shared by every item and stage of the process
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def _arcpy_sign_in(url, username, password):
+    import arcpy
+
+    return arcpy.SignInToPortal(url, username, password)
+
+
+def _arcgis_gis(url, username, password):
+    from arcgis.gis import GIS
+
+    return GIS(url, username, password, verify_cert=True)
+
+
+class PortalSession:
+    def __init__(
+        self,
+        url: str,
+        username: str,
+        password: str,
+        sign_in=None,
+        gis_factory=None,
+        token_lifetime: int = 3600,
+        refresh_margin: int = 300,
+        clock=time.time,
+    ):
+        """Define a portal session signed in once and shared by all the rasters of a run
+        The arcpy token is refreshed refresh_margin seconds before it expires.
+        parameters:
+        url: str - Portal url
+        username: str - Portal user
+        password: str - Portal password
+        sign_in: callable - (url, username, password) -> token dict, arcpy.SignInToPortal
+        gis_factory: callable - (url, username, password) -> GIS, arcgis.gis.GIS
+        token_lifetime: int - Seconds a token is valid when the portal does not tell
+        refresh_margin: int - Seconds before the expiration when the token is renewed
+        clock: callable - Current time in seconds"""
+        self.url = url
+        self.username = username
+        self.password = password
+        self._sign_in = sign_in or _arcpy_sign_in
+        self._gis_factory = gis_factory or _arcgis_gis
+        self.token_lifetime = token_lifetime
+        self.refresh_margin = refresh_margin
+        self.clock = clock
+        self._lock = threading.RLock()
+        self._connection = None
+        self._expires = 0
+        self._gis = None
+
+    def _expiration(self, connection) -> float:
+        """Return the expiration of a token in seconds since the epoch"""
+        expires = connection.get("expires") if isinstance(connection, dict) else None
+        if not expires:
+            return self.clock() + self.token_lifetime
+        expires = float(expires)
+        # The portal answers in milliseconds
+        return expires / 1000 if expires > 1e11 else expires
+
+    def connection(self):
+        """Return the arcpy portal connection, signing in again when the token expires soon"""
+        with self._lock:
+            if (
+                self._connection is None
+                or self.clock() >= self._expires - self.refresh_margin
+            ):
+                log.info(f" Signing in to {self.url}")
+                self._connection = self._sign_in(self.url, self.username, self.password)
+                self._expires = self._expiration(self._connection)
+            return self._connection
+
+    def get_gis(self):
+        """Return the GIS session (the arcgis module renews its own token)"""
+        with self._lock:
+            if self._gis is None:
+                self._gis = self._gis_factory(self.url, self.username, self.password)
+            return self._gis
+
+
+def get_session(url: str, username: str, password: str, **kwargs) -> PortalSession:
+    """Return the session of a portal user, it is created on the first call of the process
+    kwargs are passed to PortalSession when the session is created"""
+    with _SESSIONS_LOCK:
+        key = (url, username)
+        if key not in _SESSIONS:
+            _SESSIONS[key] = PortalSession(url, username, password, **kwargs)
+        return _SESSIONS[key]
+
+
+def clear_sessions() -> None:
+    """Forget the sessions of the process"""
+    with _SESSIONS_LOCK:
+        _SESSIONS.clear()
@@ -0,0 +1,171 @@
+"""Integer encoding of the depth rasters that keeps the raster.lyrx classes unchanged
+
+A depth v is stored as the code q = ceil(v * factor), decoded as q * scale with
+scale = 1 / factor. When every class break B gives an integer B * factor, the code breaks
+B * factor classify the codes exactly as the breaks classify the depths:
+ceil(v * factor) <= B * factor if and only if v <= B.
+Code 0 holds the valid pixels below the minimum break and the largest value is nodata.
+"""
+
+import json
+import logging
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def _factor(breaks, limit: int) -> int:
+    """Return the largest integer factor <= limit giving integer codes for all the breaks"""
+    for factor in range(int(limit), 0, -1):
+        codes = np.asarray(breaks, dtype=np.float64) * factor
+        if np.allclose(codes, np.round(codes), rtol=0, atol=1e-9):
+            return factor
+    raise ValueError(f"The class breaks {list(breaks)} can not be encoded")
+
+
+def quantization_plan(upper_bounds, minimum: float, dtype: str = "uint16") -> dict:
+    """Choose the encoding of the depths for an integer type
+    All the breaks are encoded exactly when they fit, otherwise the depths between the
+    last two breaks share the code below the largest one (the last class keeps its color)
+    parameters:
+    upper_bounds: array - Upper bound of each depth class
+    minimum: float - Smallest depth drawn by the symbology
+    dtype: str - uint16 or uint8
+    returns: dict - factor, scale, offset, nodata and code breaks"""
+    upper_bounds = [float(b) for b in upper_bounds]
+    nodata = int(np.iinfo(dtype).max)
+    top = nodata - 1
+    try:
+        factor = _factor(upper_bounds, top // upper_bounds[-1])
+        exact = True
+    except ValueError:
+        exact = False
+    if exact:
+        code_bounds = [b * factor for b in upper_bounds]
+    else:
+        # top - 1 is the code of the last class, top the code of deeper values
+        factor = _factor(upper_bounds[:-1], (top - 2) // upper_bounds[-2])
+        code_bounds = [b * factor for b in upper_bounds[:-1]] + [top - 1]
+    return {
+        "dtype": dtype,
+        "factor": factor,
+        "scale": 1 / factor,
+        "offset": 0.0,
+        "nodata": nodata,
+        "minimum": minimum,
+        "upper_bounds": upper_bounds,
+        "code_bounds": [int(round(c)) for c in code_bounds],
+        "exact": exact,
+    }
+
+
+def encode(values, plan: dict) -> np.ndarray:
+    """Return the codes of the depths (masked values become nodata)"""
+    data = np.ma.asarray(values)
+    depth = np.ma.filled(data.astype(np.float64), np.nan)
+    top = plan["nodata"] - 1
+    with np.errstate(invalid="ignore"):
+        codes = np.maximum(np.ceil(np.nan_to_num(depth) * plan["factor"]), 1)
+        codes = np.where(depth < plan["minimum"], 0, codes)
+        if plan["exact"]:
+            codes = np.minimum(codes, top)
+        else:
+            codes = np.where(
+                depth > plan["upper_bounds"][-1], top, np.minimum(codes, top - 1)
+            )
+    codes = np.where(np.isnan(depth), plan["nodata"], codes)
+    return codes.astype(plan["dtype"])
+
+
+def decode(codes, plan: dict) -> np.ndarray:
+    """Return the depths of the codes, nodata becomes NaN"""
+    codes = np.asarray(codes)
+    depth = codes * plan["scale"] + plan["offset"]
+    return np.where(codes == plan["nodata"], np.nan, depth)
+
+
+def _classes(values, bounds, minimum) -> np.ndarray:
+    """Class of every value, -1 when it is not drawn"""
+    classes = np.searchsorted(np.asarray(bounds, dtype=np.float64), values, side="left")
+    hidden = (values < minimum) | (classes >= len(bounds))
+    return np.where(hidden, -1, classes)
+
+
+def quantize_raster(
+    src_path: str, dst_path: str, plan: dict, window_size: int = 2048
+) -> dict:
+    """Encode a depth raster window by window and verify the encoding
+    parameters:
+    src_path: str - Depth raster (float)
+    dst_path: str - Encoded GeoTIFF, the scale and offset are stored in its metadata
+    plan: dict - Encoding from quantization_plan
+    window_size: int - Pixels per side of the windows processed at a time
+    returns: dict - verification report: max quantization error, pixels whose class
+                    changed (must be 0) and depths clipped to the last class"""
+    import rasterio
+    from rasterio.windows import Window
+
+    report = {
+        "dtype": plan["dtype"],
+        "scale": plan["scale"],
+        "offset": plan["offset"],
+        "nodata": plan["nodata"],
+        "pixels": 0,
+        "max_error": 0.0,
+        "class_mismatches": 0,
+        "clipped_pixels": 0,
+    }
+    code_minimum = 1
+    with rasterio.open(src_path) as src:
+        profile = src.profile.copy()
+        profile.update(dtype=plan["dtype"], nodata=plan["nodata"], predictor=2)
+        with rasterio.open(dst_path, "w", **profile) as dst:
+            for row in range(0, src.height, window_size):
+                for col in range(0, src.width, window_size):
+                    window = Window(
+                        col,
+                        row,
+                        min(window_size, src.width - col),
+                        min(window_size, src.height - row),
+                    )
+                    data = src.read(1, window=window, masked=True)
+                    codes = encode(data, plan)
+                    dst.write(codes, 1, window=window)
+                    valid = ~np.ma.getmaskarray(data)
+                    depth = data.data[valid].astype(np.float64)
+                    code = codes[valid].astype(np.float64)
+                    report["pixels"] += int(depth.size)
+                    report["class_mismatches"] += int(
+                        (
+                            _classes(depth, plan["upper_bounds"], plan["minimum"])
+                            != _classes(code, plan["code_bounds"], code_minimum)
+                        ).sum()
+                    )
+                    # Depths kept with the resolution of the encoding
+                    kept = (depth >= plan["minimum"]) & (
+                        depth <= plan["upper_bounds"][-1 if plan["exact"] else -2]
+                    )
+                    report["clipped_pixels"] += int(
+                        ((depth >= plan["minimum"]) & ~kept).sum()
+                    )
+                    if kept.any():
+                        error = np.abs(decode(code[kept], plan) - depth[kept]).max()
+                        report["max_error"] = max(report["max_error"], float(error))
+            dst.scales = (plan["scale"],)
+            dst.offsets = (plan["offset"],)
+    log.info(f" {src_path} encoded as {plan['dtype']}: {json.dumps(report)}")
+    return report
+
+
+def write_symbology(src_lyrx: str, dst_lyrx: str, plan: dict) -> str:
+    """Write a copy of the layer file whose class breaks apply to the codes"""
+    with open(src_lyrx, "r") as f:
+        layer = json.load(f)
+    colorizer = layer["layerDefinitions"][0]["colorizer"]
+    for class_break, code in zip(colorizer["classBreaks"], plan["code_bounds"]):
+        class_break["upperBound"] = code
+    # Code 0 holds the valid depths below the original minimum break
+    colorizer["minimumBreak"] = 0.5
+    with open(dst_lyrx, "w") as f:
+        json.dump(layer, f)
+    return dst_lyrx
@@ -0,0 +1,152 @@
+"""Windowed, multi-threaded raster reprojection with GDAL (rasterio), no ArcGIS licence needed"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform
+from rasterio.windows import Window
+
+log = logging.getLogger(__name__)
+
+
+def get_epsg(path: str):
+    """Return the EPSG code of a raster (None if it can not be identified)"""
+    with rasterio.open(path) as src:
+        return src.crs.to_epsg() if src.crs else None
+
+
+def _output_nodata(dtype, nodata):
+    """Return the nodata of the output, a source without one gets NaN (floats) or the
+    extreme value of its integer type, so the area outside the source is not 0"""
+    if nodata is not None:
+        return nodata
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f":
+        return np.nan
+    info = np.iinfo(dtype)
+    return info.min if dtype.kind == "i" else info.max
+
+
+def _window_shape(width, count, dtype, block_size, memory_budget, num_threads):
+    """Rows and columns of the windows processed by each thread so all of them fit the
+    budget, windows are aligned to the output blocks
+    Full width windows are used while a row of blocks fits the budget, wider rasters are
+    split in tile shaped windows of one row of blocks. A window is never smaller than one
+    block."""
+    pixel_bytes = count * np.dtype(dtype).itemsize
+    # Source and destination buffers of every thread live at the same time
+    pixels = memory_budget // (2 * num_threads * pixel_bytes)
+    if pixels >= width * block_size:
+        return pixels // width // block_size * block_size, width
+    cols = pixels // block_size // block_size * block_size
+    if cols < block_size:
+        log.warning(
+            f"A budget of {memory_budget} bytes is smaller than one block per thread, "
+            f"windows of {block_size}x{block_size} pixels are used"
+        )
+    return block_size, min(max(block_size, cols), width)
+
+
+def reproject_raster(
+    src_path: str,
+    dst_path: str,
+    dst_crs: str = "EPSG:3857",
+    num_threads: int = 4,
+    memory_budget: int = 512 * 1024 * 1024,
+    block_size: int = 512,
+    resampling: Resampling = Resampling.nearest,
+    compress: str = "deflate",
+) -> str:
+    """Reproject a raster to dst_crs processing it in windows across threads
+    The output is a tiled, compressed GeoTIFF. Each thread warps its own windows through
+    a WarpedVRT, so memory stays bounded by memory_budget whatever the raster size.
+    parameters:
+    src_path: str - Raster to reproject
+    dst_path: str - Output GeoTIFF
+    dst_crs: str - Target coordinate system
+    num_threads: int - Windows warped at the same time
+    memory_budget: int - Bytes used by the window buffers of all the threads
+    block_size: int - Internal tile size of the output
+    resampling: Resampling - Resampling method (nearest as ArcGIS ProjectRaster)
+    compress: str - Compression of the output
+    returns: str - dst_path"""
+    with rasterio.open(src_path) as src:
+        transform, width, height = calculate_default_transform(
+            src.crs, dst_crs, src.width, src.height, *src.bounds
+        )
+        profile = src.profile.copy()
+        nodata = _output_nodata(profile["dtype"], src.nodata)
+        if src.nodata is None:
+            log.info(f" {src_path} has no nodata, {nodata} is used outside of it")
+        vrt_options = {
+            "crs": dst_crs,
+            "transform": transform,
+            "width": width,
+            "height": height,
+            "resampling": resampling,
+            "nodata": nodata,
+            "warp_mem_limit": max(memory_budget // (2 * num_threads * 1024**2), 1),
+        }
+    profile.update(
+        driver="GTiff",
+        crs=dst_crs,
+        transform=transform,
+        width=width,
+        height=height,
+        nodata=nodata,
+        tiled=True,
+        blockxsize=block_size,
+        blockysize=block_size,
+        compress=compress,
+        predictor=3 if np.dtype(profile["dtype"]).kind == "f" else 2,
+        BIGTIFF="IF_SAFER",
+    )
+    rows, cols = _window_shape(
+        width,
+        profile["count"],
+        profile["dtype"],
+        block_size,
+        memory_budget,
+        num_threads,
+    )
+    windows = [
+        Window(col, row, min(cols, width - col), min(rows, height - row))
+        for row in range(0, height, rows)
+        for col in range(0, width, cols)
+    ]
+    log.info(
+        f" Reprojecting {src_path} to {dst_crs} in {len(windows)} windows of "
+        f"{rows}x{cols} pixels"
+    )
+
+    # Datasets are not thread safe: every thread opens its own source and VRT
+    local = threading.local()
+    opened = []
+    write_lock = threading.Lock()
+
+    with rasterio.Env(GDAL_NUM_THREADS=1), rasterio.open(
+        dst_path, "w", **profile
+    ) as dst:
+
+        def warp(window):
+            if not hasattr(local, "vrt"):
+                local.src = rasterio.open(src_path)
+                local.vrt = WarpedVRT(local.src, **vrt_options)
+                opened.append((local.vrt, local.src))
+            data = local.vrt.read(window=window)
+            with write_lock:
+                dst.write(data, window=window)
+
+        try:
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                # list() propagates the first error of the workers
+                list(executor.map(warp, windows))
+        finally:
+            for vrt, src in opened:
+                vrt.close()
+                src.close()
+    return dst_path
@@ -0,0 +1,267 @@
+"""Depth statistics of the rasters computed in one streaming pass at ingest"""
+
+import json
+import logging
+import numpy as np
+from sqlalchemy import create_engine, text
+
+log = logging.getLogger(__name__)
+
+EARTH_RADIUS = 6378137.0
+METERS_PER_DEGREE = 2 * np.pi * EARTH_RADIUS / 360
+
+
+class DepthStatistics:
+    def __init__(self, upper_bounds, minimum: float, zones: int = 1):
+        """Define the accumulators of the depth statistics of one or several zones
+        Windows are added with update(), memory does not depend on the raster size.
+        parameters:
+        upper_bounds: array - Upper bound of each depth class (raster.lyrx class breaks)
+        minimum: float - Smallest depth considered flooded (minimumBreak of the symbology)
+        zones: int - Number of zones, pixels are assigned to zones 0..zones-1"""
+        self.upper_bounds = np.asarray(upper_bounds, dtype=float)
+        self.minimum = minimum
+        self.zones = zones
+        # The last bin holds the depths above the last class
+        bins = len(self.upper_bounds) + 1
+        self.valid = np.zeros(zones, dtype=np.int64)
+        self.flooded = np.zeros(zones, dtype=np.int64)
+        self.total = np.zeros(zones, dtype=np.float64)
+        self.maximum = np.full(zones, -np.inf)
+        self.area = np.zeros(zones, dtype=np.float64)
+        self.histogram = np.zeros((zones, bins), dtype=np.int64)
+        self.class_area = np.zeros((zones, bins), dtype=np.float64)
+
+    def update(self, values, zone=None, pixel_area=1.0) -> None:
+        """Add the valid pixels of a window
+        parameters:
+        values: array - Depths of the valid pixels
+        zone: array - Zone of every pixel (all in zone 0 by default)
+        pixel_area: float or array - Ground area of every pixel in square meters"""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        zone = (
+            np.zeros(values.shape, dtype=np.int64)
+            if zone is None
+            else np.asarray(zone, dtype=np.int64).ravel()
+        )
+        pixel_area = np.broadcast_to(
+            np.asarray(pixel_area, dtype=np.float64), values.shape
+        )
+        self.valid += np.bincount(zone, minlength=self.zones)
+        wet = values >= self.minimum
+        values, zone, pixel_area = values[wet], zone[wet], pixel_area.ravel()[wet]
+        if values.size == 0:
+            return
+        bins = self.histogram.shape[1]
+        classes = np.searchsorted(self.upper_bounds, values, side="left")
+        self.flooded += np.bincount(zone, minlength=self.zones)
+        self.total += np.bincount(zone, weights=values, minlength=self.zones)
+        self.area += np.bincount(zone, weights=pixel_area, minlength=self.zones)
+        np.maximum.at(self.maximum, zone, values)
+        cells = zone * bins + classes
+        self.histogram += np.bincount(cells, minlength=self.zones * bins).reshape(
+            self.zones, bins
+        )
+        self.class_area += np.bincount(
+            cells, weights=pixel_area, minlength=self.zones * bins
+        ).reshape(self.zones, bins)
+
+    def result(self, zone: int = 0) -> dict:
+        """Return the statistics of a zone"""
+        flooded = int(self.flooded[zone])
+        return {
+            "valid_pixels": int(self.valid[zone]),
+            "flooded_pixels": flooded,
+            "flooded_area": float(self.area[zone]),
+            "max_depth": float(self.maximum[zone]) if flooded else None,
+            "mean_depth": float(self.total[zone] / flooded) if flooded else None,
+            "histogram": self.histogram[zone].tolist(),
+            "class_area": self.class_area[zone].tolist(),
+        }
+
+
+def row_pixel_area(transform, crs, rows) -> np.ndarray:
+    """Return the ground area in square meters of the pixels of each row
+    Web Mercator and geographic pixels shrink with the latitude."""
+    rows = np.asarray(rows, dtype=np.float64)
+    nominal = abs(transform.a * transform.e)
+    y = transform.f + (rows + 0.5) * transform.e
+    if crs is not None and crs.to_epsg() == 3857:
+        latitude = np.arctan(np.sinh(y / EARTH_RADIUS))
+        return nominal * np.cos(latitude) ** 2
+    if crs is not None and crs.is_geographic:
+        return nominal * METERS_PER_DEGREE**2 * np.cos(np.radians(y))
+    return np.full(rows.shape, nominal)
+
+
+def compute_statistics(
+    path: str,
+    upper_bounds,
+    minimum: float,
+    zones: list = None,
+    window_size: int = 2048,
+) -> dict:
+    """Compute the depth statistics of a raster reading it window by window
+    parameters:
+    path: str - Depth raster
+    upper_bounds: array - Upper bound of each depth class
+    minimum: float - Smallest depth considered flooded
+    zones: list - (zone id, shapely geometry in the raster crs) for zonal statistics
+    window_size: int - Pixels per side of the windows read at a time
+    returns: dict - statistics of the whole raster ("all") and of every zone"""
+    import rasterio
+    from rasterio.features import rasterize
+    from rasterio.windows import Window
+
+    zones = zones or []
+    overall = DepthStatistics(upper_bounds, minimum)
+    # Zone 0 collects the pixels outside every zone
+    zonal = DepthStatistics(upper_bounds, minimum, len(zones) + 1)
+    with rasterio.open(path) as ds:
+        # Quantized rasters store codes, the statistics are computed on the depths
+        scale, offset = ds.scales[0], ds.offsets[0]
+        for row in range(0, ds.height, window_size):
+            for col in range(0, ds.width, window_size):
+                window = Window(
+                    col,
+                    row,
+                    min(window_size, ds.width - col),
+                    min(window_size, ds.height - row),
+                )
+                data = ds.read(1, window=window, masked=True)
+                valid = ~np.ma.getmaskarray(data)
+                if not valid.any():
+                    continue
+                rows = np.arange(row, row + window.height)
+                area = np.broadcast_to(
+                    row_pixel_area(ds.transform, ds.crs, rows)[:, None], valid.shape
+                )[valid]
+                values = data.data[valid] * scale + offset
+                overall.update(values, pixel_area=area)
+                if zones:
+                    zone = rasterize(
+                        [(geom, i + 1) for i, (_, geom) in enumerate(zones)],
+                        out_shape=valid.shape,
+                        transform=ds.window_transform(window),
+                        fill=0,
+                        dtype="int32",
+                    )
+                    zonal.update(values, zone[valid], area)
+    results = {"all": overall.result()}
+    for i, (zone_id, _) in enumerate(zones):
+        results[str(zone_id)] = zonal.result(i + 1)
+    return results
+
+
+class StatisticsStore:
+    def __init__(self, engine, table: str = "raster_statistics"):
+        """Define the table with the depth statistics of every published raster,
+        one row per service and zone ("all" for the whole raster)
+        parameters:
+        engine: SQLAlchemy engine of the database
+        table: str - Name of the statistics table"""
+        self.engine = engine
+        self.table = table
+        self._created = False
+
+    def create_table(self) -> None:
+        """Create the table if it does not exist"""
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                    "service_name text, "
+                    "zone text, "
+                    "path_aws text, "
+                    "valid_pixels bigint, "
+                    "flooded_pixels bigint, "
+                    "flooded_area double precision, "
+                    "max_depth double precision, "
+                    "mean_depth double precision, "
+                    "class_bounds jsonb, "
+                    "histogram jsonb, "
+                    "class_area jsonb, "
+                    "updated timestamptz DEFAULT now(), "
+                    "PRIMARY KEY (service_name, zone))"
+                )
+            )
+
+    def load_zones(self, region_table: str, epsg: int = 3857) -> list:
+        """Return the regions as (region id, shapely geometry) in the raster crs"""
+        import shapely
+
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                text(
+                    "SELECT region_watershed, ST_AsBinary(ST_Transform(shape, :epsg)) "
+                    f"FROM {region_table}"
+                ),
+                {"epsg": epsg},
+            )
+            return [(row[0], shapely.from_wkb(bytes(row[1]))) for row in rows]
+
+    def save(
+        self, service_name: str, path_aws: str, results: dict, class_bounds
+    ) -> None:
+        """Replace the statistics of a service"""
+        if not self._created:
+            self.create_table()
+            self._created = True
+        rows = [
+            {
+                "service_name": service_name,
+                "zone": zone,
+                "path_aws": path_aws,
+                "valid_pixels": stats["valid_pixels"],
+                "flooded_pixels": stats["flooded_pixels"],
+                "flooded_area": stats["flooded_area"],
+                "max_depth": stats["max_depth"],
+                "mean_depth": stats["mean_depth"],
+                "class_bounds": json.dumps([float(b) for b in class_bounds]),
+                "histogram": json.dumps(stats["histogram"]),
+                "class_area": json.dumps(stats["class_area"]),
+            }
+            for zone, stats in results.items()
+        ]
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(f"DELETE FROM {self.table} WHERE service_name = :service_name"),
+                {"service_name": service_name},
+            )
+            conn.execute(
+                text(
+                    f"INSERT INTO {self.table} (service_name, zone, path_aws, "
+                    "valid_pixels, flooded_pixels, flooded_area, max_depth, mean_depth, "
+                    "class_bounds, histogram, class_area) VALUES (:service_name, :zone, "
+                    ":path_aws, :valid_pixels, :flooded_pixels, :flooded_area, "
+                    ":max_depth, :mean_depth, CAST(:class_bounds AS jsonb), "
+                    "CAST(:histogram AS jsonb), CAST(:class_area AS jsonb))"
+                ),
+                rows,
+            )
+        log.info(f" Statistics of {service_name} saved in {self.table}")
+
+    def delete(self, service_name: str) -> None:
+        """Remove the statistics of a deleted service"""
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(f"DELETE FROM {self.table} WHERE service_name = :service_name"),
+                {"service_name": service_name},
+            )
+
+
+def load_statistics_store(config_data: dict):
+    """Return the StatisticsStore and the region table of the configuration,
+    (None, None) when no table of type statistics is configured"""
+    db = config_data.get("database")
+    if not db:
+        return None, None
+    tables = [t["name"] for t in db.get("raster", []) if t["type"] == "statistics"]
+    if not tables:
+        return None, None
+    engine = create_engine(
+        f"postgresql://{db['user']}:{db['password']}@{db['host']}:{db['port']}/{db['database']}"
+    )
+    # The regions are the fourth table of the vector pipeline
+    region_table = db["tables"][3]["name"] if len(db.get("tables", [])) > 3 else None
+    return StatisticsStore(engine, tables[0]), region_table
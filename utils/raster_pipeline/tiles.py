@@ -0,0 +1,272 @@
+"""Sparse XYZ tile renderer for the depth rasters, it does not need ArcGIS Server"""
+
+import json
+import logging
+import math
+import os
+import sqlite3
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.windows import from_bounds
+
+log = logging.getLogger(__name__)
+
+# Web Mercator extent and scale of zoom level 0 in the ArcGIS Online tiling scheme (96 dpi)
+ORIGIN = 20037508.342789244
+ZOOM_0_SCALE = 591657527.591555
+
+
+def scale_to_zoom(scale: float) -> int:
+    """Return the XYZ zoom level of a cache scale"""
+    return round(math.log2(ZOOM_0_SCALE / float(scale)))
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple:
+    """Return the (left, bottom, right, top) bounds of a tile in EPSG:3857"""
+    size = 2 * ORIGIN / 2**z
+    left = -ORIGIN + x * size
+    top = ORIGIN - y * size
+    return left, top - size, left + size, top
+
+
+def load_colormap(lyrx_path: str) -> dict:
+    """Read the class breaks of a raster.lyrx classify colorizer
+    returns: dict - minimum break, upper bounds and RGBA colors of the classes"""
+    with open(lyrx_path, "r") as f:
+        colorizer = json.load(f)["layerDefinitions"][0]["colorizer"]
+    breaks = colorizer["classBreaks"]
+    colors = np.array([b["color"]["values"] for b in breaks], dtype=float)
+    # CIM colors store the transparency as an opacity percentage
+    colors[:, 3] = colors[:, 3] * 255 / 100
+    return {
+        "minimum": colorizer.get("minimumBreak", -np.inf),
+        "upper_bounds": np.array([b["upperBound"] for b in breaks], dtype=float),
+        "colors": colors.round().astype(np.uint8),
+    }
+
+
+def apply_colormap(data: np.ma.MaskedArray, colormap: dict) -> np.ndarray:
+    """Return the RGBA image of the depths, values outside the classes are transparent"""
+    values = np.ma.filled(data.astype(float), np.nan)
+    classes = np.searchsorted(colormap["upper_bounds"], values, side="left")
+    visible = (
+        ~np.isnan(values)
+        & (values >= colormap["minimum"])
+        & (classes < len(colormap["colors"]))
+    )
+    rgba = np.zeros(values.shape + (4,), dtype=np.uint8)
+    rgba[visible] = colormap["colors"][classes[visible]]
+    return rgba
+
+
+def encode_png(rgba: np.ndarray) -> bytes:
+    """Encode an RGBA image as PNG"""
+    height, width, _ = rgba.shape
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgba.reshape(height, width * 4)
+
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(raw.tobytes(), 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+def valid_tiles(raster_path: str, max_zoom: int) -> set:
+    """Return the tiles of max_zoom holding at least one valid pixel
+    The raster (EPSG:3857, north up) is streamed block by block, only the mask is read.
+    The tile of a pixel center is given by its column and its row, the mask of a block is
+    reduced over the runs of columns and rows falling in the same tile."""
+    tiles = set()
+    size = 2 * ORIGIN / 2**max_zoom
+    with rasterio.open(raster_path) as ds:
+        transform = ds.transform
+        for _, window in ds.block_windows(1):
+            mask = ds.read_masks(1, window=window) > 0
+            if not mask.any():
+                continue
+            cols = window.col_off + np.arange(window.width) + 0.5
+            rows = window.row_off + np.arange(window.height) + 0.5
+            tx = ((transform.c + cols * transform.a + ORIGIN) // size).astype(np.int64)
+            ty = ((ORIGIN - transform.f - rows * transform.e) // size).astype(np.int64)
+            # First column and row of each tile of the block
+            col_starts = np.flatnonzero(np.diff(tx, prepend=tx[0] - 1))
+            row_starts = np.flatnonzero(np.diff(ty, prepend=ty[0] - 1))
+            valid = np.logical_or.reduceat(mask, row_starts, axis=0)
+            valid = np.logical_or.reduceat(valid, col_starts, axis=1)
+            tile_rows, tile_cols = np.nonzero(valid)
+            tiles.update(
+                zip(
+                    tx[col_starts[tile_cols]].tolist(),
+                    ty[row_starts[tile_rows]].tolist(),
+                )
+            )
+    return tiles
+
+
+_dataset = None
+
+
+def _open_dataset(raster_path):
+    """Process pool initializer: every process keeps its own open dataset"""
+    global _dataset
+    _dataset = rasterio.open(raster_path)
+
+
+def _render(tiles, colormap, tile_size):
+    """Render a batch of tiles, empty tiles are skipped"""
+    rendered = []
+    for z, x, y in tiles:
+        window = from_bounds(*tile_bounds(z, x, y), transform=_dataset.transform)
+        inside = (
+            window.col_off >= 0
+            and window.row_off >= 0
+            and window.col_off + window.width <= _dataset.width
+            and window.row_off + window.height <= _dataset.height
+        )
+        data = _dataset.read(
+            1,
+            window=window,
+            out_shape=(tile_size, tile_size),
+            boundless=not inside,
+            masked=True,
+            resampling=Resampling.nearest,
+        )
+        if data.mask.all():
+            continue
+        # Quantized rasters store codes, the colormap applies to the depths
+        scale, offset = _dataset.scales[0], _dataset.offsets[0]
+        if (scale, offset) != (1.0, 0.0):
+            data = data * scale + offset
+        rgba = apply_colormap(data, colormap)
+        if rgba[..., 3].any():
+            rendered.append((z, x, y, encode_png(rgba)))
+    return rendered
+
+
+class DirectoryTileWriter:
+    def __init__(self, path: str):
+        """Write tiles as {z}/{x}/{y}.png files"""
+        self.path = path
+
+    def write(self, z, x, y, png):
+        folder = os.path.join(self.path, str(z), str(x))
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"{y}.png"), "wb") as f:
+            f.write(png)
+
+    def close(self):
+        pass
+
+
+class MBTilesWriter:
+    def __init__(self, path: str, name: str, zooms: list):
+        """Write tiles to an MBTiles archive (TMS row order)"""
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(
+            "CREATE TABLE IF NOT EXISTS metadata (name text, value text);"
+            "CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, "
+            "tile_row integer, tile_data blob);"
+            "CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles "
+            "(zoom_level, tile_column, tile_row);"
+            # Archives written before the index may repeat a name, the last row is kept
+            "DELETE FROM metadata WHERE rowid NOT IN "
+            "(SELECT max(rowid) FROM metadata GROUP BY name);"
+            "CREATE UNIQUE INDEX IF NOT EXISTS metadata_index ON metadata (name);"
+        )
+        metadata = {
+            "name": name,
+            "format": "png",
+            "minzoom": min(zooms),
+            "maxzoom": max(zooms),
+        }
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO metadata VALUES (?, ?)",
+            [(k, str(v)) for k, v in metadata.items()],
+        )
+
+    def write(self, z, x, y, png):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+            (z, x, 2**z - 1 - y, sqlite3.Binary(png)),
+        )
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def _write(writer, rendered) -> int:
+    """Write a rendered batch, returns the number of tiles"""
+    for z, x, y, png in rendered:
+        writer.write(z, x, y, png)
+    return len(rendered)
+
+
+def render_tiles(
+    raster_path: str,
+    output: str,
+    scales: list,
+    lyrx_path: str,
+    processes: int = None,
+    tile_size: int = 256,
+    batch_size: int = 64,
+) -> int:
+    """Render the XYZ tiles of the cache scales for a depth raster in EPSG:3857
+    Only the tiles whose footprint holds valid pixels are rendered.
+    parameters:
+    raster_path: str - Depth raster in EPSG:3857
+    output: str - Folder for {z}/{x}/{y}.png tiles or a .mbtiles archive
+    scales: list - Cache scales, converted to zoom levels
+    lyrx_path: str - Layer file with the classify colorizer
+    processes: int - Rendering processes (all the cpus by default)
+    tile_size: int - Tile size in pixels
+    batch_size: int - Tiles sent to a process at a time
+    returns: int - Number of tiles written"""
+    zooms = sorted({scale_to_zoom(s) for s in scales})
+    colormap = load_colormap(lyrx_path)
+    deepest = valid_tiles(raster_path, max(zooms))
+    tiles = []
+    for z in zooms:
+        shift = max(zooms) - z
+        tiles.extend(
+            (z, x, y) for x, y in sorted({(x >> shift, y >> shift) for x, y in deepest})
+        )
+    log.info(f" Rendering {len(tiles)} tiles of {raster_path} for zooms {zooms}")
+    if output.endswith(".mbtiles"):
+        name = os.path.splitext(os.path.basename(raster_path))[0]
+        writer = MBTilesWriter(output, name, zooms)
+    else:
+        writer = DirectoryTileWriter(output)
+    batches = (tiles[i : i + batch_size] for i in range(0, len(tiles), batch_size))
+    processes = processes or os.cpu_count() or 1
+    written = 0
+    try:
+        with ProcessPoolExecutor(
+            max_workers=processes, initializer=_open_dataset, initargs=(raster_path,)
+        ) as executor:
+            # A bounded window of batches is in flight, the rendered tiles are written
+            # as they come instead of piling up for the whole zoom range
+            window = 2 * processes
+            pending = deque()
+            for batch in batches:
+                pending.append(executor.submit(_render, batch, colormap, tile_size))
+                if len(pending) == window:
+                    written += _write(writer, pending.popleft().result())
+            while pending:
+                written += _write(writer, pending.popleft().result())
+    finally:
+        writer.close()
+    log.info(f" {written} tiles written to {output}")
+    return written
@@ -0,0 +1,161 @@
+import logging
+import random
+import string
+import yaml
+from .portal import get_session
+
+log = logging.getLogger(__name__)
+
+# Titles searched per portal query
+_SEARCH_BATCH = 50
+
+
+def create_layer_id(layerIndex: int) -> str:
+    """Create a layer id for the webmap"""
+    return (
+        "".join(random.choices(string.ascii_lowercase + string.digits, k=11))
+        + "-layer-"
+        + str(layerIndex)
+    )
+
+
+def get_region_index(region_name: str, layers: list) -> int:
+    """Get the index of the region in the webmap"""
+    for i, dictionary in enumerate(layers):
+        if dictionary.get("title") == region_name:
+            return i
+
+
+class WebmapChanges:
+    def __init__(self, config_file="credentials.yaml", gis=None, webmap_factory=None):
+        """Define the layers added to and removed from the webmaps during a run
+        Changes are deduplicated by service name and applied with one load-modify-update
+        cycle per webmap, the layer items are resolved with batched searches.
+        parameters:
+        config_file: str - Yaml file with the portal credentials
+        gis: GIS - Portal session (the shared session of the process by default)
+        webmap_factory: callable - Builds the webmap of a portal item (arcgis WebMap)"""
+        self.gis = gis
+        self.webmap_factory = webmap_factory
+        self.adds = {}
+        self.removes = set()
+        self._load_config(config_file)
+
+    def _load_config(self, config_file: str) -> bool:
+        """Load the portal credentials from the yaml file"""
+        try:
+            with open(config_file, "r") as f:
+                config_data = yaml.safe_load(f)
+            self.portalUrl = config_data["portal"]["portalUrl"]
+            self.portalUser = config_data["portal"]["username"]
+            self.portalPass = config_data["portal"]["password"]
+            self.webmapName = config_data["portal"]["webmap"]
+            return True
+        except FileNotFoundError:
+            log.info("Credentials file not found")
+            return False
+
+    def add(self, service_name: str, region: str) -> None:
+        """Add the layer of a service to the group layer of its region e.g. "Region 3" """
+        self.adds[service_name] = region
+
+    def remove(self, service_name: str) -> None:
+        """Remove the layer of a service from the webmaps"""
+        self.adds.pop(service_name, None)
+        self.removes.add(service_name)
+
+    def get_gis(self):
+        """Return the portal session of the run"""
+        if self.gis is None:
+            self.gis = get_session(
+                self.portalUrl, self.portalUser, self.portalPass
+            ).get_gis()
+        return self.gis
+
+    def _get_webmap(self, item):
+        if self.webmap_factory is None:
+            from arcgis.mapping import WebMap
+
+            self.webmap_factory = WebMap
+        return self.webmap_factory(item)
+
+    def _search_layers(self, service_names: list) -> dict:
+        """Return the portal item of each service, searching many titles per query"""
+        gis = self.get_gis()
+        items = {}
+        for i in range(0, len(service_names), _SEARCH_BATCH):
+            batch = service_names[i : i + _SEARCH_BATCH]
+            query = " OR ".join(f'title:"{name}"' for name in batch)
+            for item in gis.content.search(
+                query, item_type="Map Service", max_items=2 * len(batch)
+            ):
+                if item.title in batch:
+                    items.setdefault(item.title, item)
+        return items
+
+    def _new_layers(self) -> dict:
+        """Return the webmap layer of each service to add"""
+        items = self._search_layers(sorted(self.adds))
+        layers = {}
+        for service_name in self.adds:
+            layer_item = items.get(service_name)
+            if layer_item is None:
+                log.error(f" Layer {service_name} not found in the portal")
+                continue
+            layers[service_name] = {
+                "id": create_layer_id(random.randint(100, 99999)),
+                "url": layer_item.url,
+                "title": layer_item.layers[0].properties.name,
+                "visibility": False,
+                "itemId": layer_item.id,
+                "layerType": "ArcGISTiledMapServiceLayer",
+            }
+        return layers
+
+    def apply(self) -> dict:
+        """Apply the pending changes to every webmap
+        A portal error is logged, as the webmap updates of the pipeline always did, and
+        the changes are kept pending so the next apply() of the run tries them again.
+        returns: dict - services added and removed, error when the changes failed"""
+        summary = {"added": [], "removed": sorted(self.removes), "error": None}
+        if not self.adds and not self.removes:
+            return summary
+        try:
+            self._apply(summary)
+        except Exception as e:
+            log.error(f" Error updating the webmaps: {e}")
+            summary.update(added=[], removed=[], error=e)
+            return summary
+        self.adds = {}
+        self.removes = set()
+        return summary
+
+    def _apply(self, summary: dict) -> None:
+        new_layers = self._new_layers()
+        summary["added"] = sorted(new_layers)
+        # Previous layers of the added services are replaced, never duplicated
+        titles = self.removes | set(new_layers)
+        titles |= {layer["title"] for layer in new_layers.values()}
+        for item in self.get_gis().content.search(self.webmapName, item_type="Web Map"):
+            log.info(f"Working on {item.title} webmap")
+            wm = self._get_webmap(item)
+            modified = False
+            for group in wm.layers:
+                layers = list(group.get("layers") or [])
+                kept = [layer for layer in layers if layer.get("title") not in titles]
+                if len(kept) != len(layers):
+                    group["layers"] = kept
+                    modified = True
+            for service_name, layer in new_layers.items():
+                region_idx = get_region_index(self.adds[service_name], wm.layers)
+                if region_idx is None:
+                    log.error(f" {self.adds[service_name]} not found in {item.title}")
+                    continue
+                wm.layers[region_idx].setdefault("layers", []).append(dict(layer))
+                modified = True
+            if modified:
+                wm.update()
+        log.info(
+            f" {len(summary['added'])} layers added and "
+            f"{len(summary['removed'])} removed from the webmaps"
+        )
@@ -1,14 +1,128 @@
-from sqlalchemy import create_engine, MetaData, Table, and_, text
+from sqlalchemy import create_engine, and_, text, tuple_
+from sqlalchemy.dialects.postgresql import insert
 import pandas as pd
 import boto3
-from io import StringIO
 import logging
 import yaml
-from . import get_db_connection
-from sqlalchemy import insert, select, delete
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from . import get_db_connection, get_table, has_unique_index
+from .s3_utils import upload_csv, upload_parquet
+from .report_manifest import ReportManifest
+from sqlalchemy import delete
 
 log = logging.getLogger(__name__)
 
+CATEGORY_DICT = {
+    "Com": "Commercial",
+    "Ind": "Industrial",
+    "Pub": "Public",
+    "Res": "Residential",
+}
+REPORT_COLS = [
+    "block_code",
+    "us_block_name",
+    "boundary_type",
+    "boundary_name",
+    "category",
+    "si_affected",
+    "si_at_risk",
+    "total_damage",
+    "content_damage",
+    "structure_damage",
+    "total_value_at_risk",
+    "content_value_at_risk",
+    "structure_value_at_risk",
+]
+RENAMED_COLS = {
+    "block_code": "Block code",
+    "us_block_name": "Block name",
+    "category": "Category",
+    "si_affected": "Affected structures",
+    "si_at_risk": "Structures at risk",
+    "total_damage": "Total damage cost",
+    "content_damage": "Content damage cost",
+    "structure_damage": "Structure damage cost",
+    "total_value_at_risk": "Total value at risk",
+    "content_value_at_risk": "Content value at risk",
+    "structure_value_at_risk": "Structure value at risk",
+}
+TOTAL_AGG = {
+    "us_block_name": "first",
+    "boundary_type": "first",
+    "boundary_name": "first",
+    "si_affected": "sum",
+    "si_at_risk": "sum",
+    "total_damage": "sum",
+    "content_damage": "sum",
+    "structure_damage": "sum",
+    "total_value_at_risk": "sum",
+    "content_value_at_risk": "sum",
+    "structure_value_at_risk": "sum",
+}
+
+# A report is registered once per region, storm and boundary type
+REPORT_KEY = ("region_id", "storm_id", "boundary_type")
+# At-risk aggregates only change with the structure inventory, so they are
+# kept for the whole process and shared by every storm: {(table, region_id): df}
+_AT_RISK_CACHE = {}
+
+
+def clear_at_risk_cache() -> None:
+    """Forget the cached at-risk aggregates (e.g. after the structure inventory changes)"""
+    _AT_RISK_CACHE.clear()
+
+
+def build_region_reports(
+    results_data: pd.DataFrame, at_risk_data: pd.DataFrame
+) -> dict:
+    """Build the report tables of one region
+    parameters:
+    results_data: pd.DataFrame - Aggregated results of the storm for the region
+    at_risk_data: pd.DataFrame - Aggregated values at risk for the region
+    returns: dict - {boundary_type: report dataframe} ready to be written as csv"""
+    at_risk_data = at_risk_data.copy()
+    at_risk_data["category"] = at_risk_data["category"].map(CATEGORY_DICT)
+    merged_data = results_data.merge(
+        at_risk_data,
+        how="left",
+        left_on=[
+            "name20",
+            "geoid20",
+            "boundary_type",
+            "boundary_name",
+            "damage_cat_str",
+        ],
+        right_on=[
+            "us_block_name",
+            "block_code",
+            "boundary_type",
+            "boundary_name",
+            "category",
+        ],
+    )
+    merged_data = merged_data[REPORT_COLS]
+    # Rows without a block code can not be totalized, they are not reported
+    merged_data = merged_data.loc[merged_data["block_code"].notna()]
+    reports = {}
+    for bt in merged_data.boundary_type.unique():
+        csv = merged_data.loc[merged_data["boundary_type"] == bt].copy()
+        # Block order follows the first appearance of each block in the results
+        block_order = {block: i for i, block in enumerate(csv.block_code.unique())}
+        total_rows = csv.groupby("block_code", sort=False).agg(TOTAL_AGG).reset_index()
+        total_rows["category"] = "Total"
+        csv["_total"] = 0
+        total_rows["_total"] = 1
+        result_df = pd.concat([csv, total_rows[csv.columns]], ignore_index=True)
+        result_df["_block"] = result_df["block_code"].map(block_order)
+        result_df = result_df.sort_values(
+            ["_block", "_total"], kind="mergesort"
+        ).reset_index(drop=True)
+        result_df = result_df[REPORT_COLS].drop(columns=["boundary_type"])
+        renamed_cols = {**RENAMED_COLS, "boundary_name": bt}
+        reports[bt] = result_df.rename(columns=renamed_cols)
+    return reports
+
 
 class Report:
     def __init__(
@@ -16,19 +130,35 @@ class Report:
         region_id: int,
         storm_id: int,
         config_file="credentials.yaml",
+        compress: bool = False,
+        parquet: bool = False,
+        max_workers: int = 4,
+        cache_control: str = "max-age=3600",
     ):
         """Define a class to add data to the database
         parameters:
         region_id: int - Region id to generate or delete the reports
         storm_id: int - Storm id to generate or delete the reports
         config_file: str - Path to the yaml credentials file (database connection info)
+        compress: bool - Store the csv reports gzip encoded (Content-Encoding: gzip)
+        parquet: bool - Upload a parquet copy of each report next to the csv
+        max_workers: int - Number of reports uploaded concurrently
+        cache_control: str - Cache-Control header of the uploaded reports
         """
         self.region_id = region_id
         self.storm_id = storm_id
         self.config_file = config_file
+        self.compress = compress
+        self.parquet = parquet
+        self.max_workers = max_workers
+        self.cache_control = cache_control
 
         self._load_config(self.config_file)
         self.s3_resource = boto3.resource("s3")
+        # Clients are thread safe, resources are not: uploads run in a thread pool
+        self.s3_client = boto3.client("s3")
+        # Built on first use, a missing configuration fails when the reports are made
+        self.manifest = None
 
     def _load_config(self, config_file):
         """Load the database credentials from the yaml file
@@ -60,192 +190,224 @@ class Report:
             log.info("Credentials file not found")
             return None
 
-    def __insert_to_table(self, boundary_type: str):
-        """Insert the report path into the database"""
+    def get_manifest(self) -> ReportManifest:
+        """Return the manifest of the reports of the bucket"""
+        if self.manifest is None:
+            self.manifest = ReportManifest(self.s3_client, self.bucket_name)
+        return self.manifest
 
-        log.info(
-            f"Inserting report data for region {self.region_id} and storm {self.storm_id}"
-        )
-        metadata = MetaData()
-        report_table = Table(
-            self.tables[2]["name"], metadata, autoload_with=self.engine
-        )
-        select_stmt = select(report_table).where(
-            (report_table.c.region_id == int(self.region_id))
-            & (report_table.c.storm_id == int(self.storm_id))
-            & (report_table.c.boundary_type == boundary_type)
-        )
-        with self.engine.connect() as conn:
-            existing_row = conn.execute(select_stmt).fetchone()
-            if existing_row:
-                log.info(f"Report {existing_row} already exists")
-                return existing_row
+    def __upsert_to_table(self, reports: list):
+        """Insert or update the report paths of a batch in a single statement
+        The upsert needs a unique index on REPORT_KEY, created by the migration
+        (src/migrate_database.py) and checked once per process. Without it, the rows of
+        the batch are deleted and inserted again.
+        parameters:
+        reports: list - (region_id, boundary_type) of the uploaded reports"""
+        if not reports:
+            return None
+        log.info(f"Registering {len(reports)} reports for storm {self.storm_id}")
+        report_table = get_table(self.engine, self.tables[2]["name"])
+        rows = [
+            {
+                "region_id": int(region_id),
+                "storm_id": int(self.storm_id),
+                "boundary_type": boundary_type,
+                "aws_path": f"https://{self.bucket_name}.s3.{self.bucket_region}.amazonaws.com/consequence_reports/download.html?Storm_{self.storm_id}/Region_{region_id}/S{self.storm_id}_R{region_id}_B_{boundary_type}.csv",
+            }
+            for region_id, boundary_type in reports
+        ]
+        insert_stmt = insert(report_table).values(rows)
+        with self.engine.begin() as conn:
+            if has_unique_index(conn, self.tables[2]["name"], REPORT_KEY, cache=True):
+                conn.execute(
+                    insert_stmt.on_conflict_do_update(
+                        index_elements=list(REPORT_KEY),
+                        set_={"aws_path": insert_stmt.excluded.aws_path},
+                    )
+                )
             else:
-                insert_stmt = insert(report_table).values(
-                    region_id=int(self.region_id),
-                    storm_id=int(self.storm_id),
-                    boundary_type=boundary_type,
-                    aws_path=f"https://{self.bucket_name}.s3.{self.bucket_region}.amazonaws.com/consequence_reports/download.html?Storm_{self.storm_id}/Region_{self.region_id}/S{self.storm_id}_R{self.region_id}_B_{boundary_type}.csv",
+                key = tuple_(*(report_table.c[c] for c in REPORT_KEY))
+                conn.execute(
+                    delete(report_table).where(
+                        key.in_([tuple(row[c] for c in REPORT_KEY) for row in rows])
+                    )
                 )
-                result = conn.execute(insert_stmt)
-                conn.commit()
-                log.info(f"Report {result.inserted_primary_key} inserted")
-                return result.inserted_primary_key
+                conn.execute(insert_stmt)
+        log.info(f"{len(rows)} reports registered for storm {self.storm_id}")
 
-    def __delete_to_table(self):
-        """delete the report path into the database"""
+    def __delete_to_table(self, region_ids: list):
+        """delete the report paths of the regions from the database"""
 
         log.info(
-            f"Deleting report data for region {self.region_id} and storm {self.storm_id} from table"
-        )
-        metadata = MetaData()
-        report_table = Table(
-            self.tables[2]["name"], metadata, autoload_with=self.engine
+            f"Deleting report data for regions {region_ids} and storm {self.storm_id} from table"
         )
+        report_table = get_table(self.engine, self.tables[2]["name"])
         delete_stmt = delete(report_table).where(
             and_(
-                report_table.c.region_id == int(self.region_id),
+                report_table.c.region_id.in_([int(r) for r in region_ids]),
                 report_table.c.storm_id == int(self.storm_id),
             )
         )
         with self.engine.connect() as conn:
             conn.execute(delete_stmt)
             conn.commit()
-        log.info(
-            f"Reports for storm {self.storm_id} and region {self.region_id} deleted"
-        )
+        log.info(f"Reports for storm {self.storm_id} and regions {region_ids} deleted")
 
-    def generate(self):
-        """Generate the report"""
-        log.info(
-            f"Generating report for region {self.region_id} and storm {self.storm_id}"
-        )
+    def _read_at_risk(self, region_ids: list) -> dict:
+        """Return the at-risk aggregates of the regions, querying only the regions
+        that are not cached yet"""
         aggregate_at_risk_table = self.tables[0]["name"]
+        missing = [
+            r for r in region_ids if (aggregate_at_risk_table, r) not in _AT_RISK_CACHE
+        ]
+        if missing:
+            with self.engine.connect() as conn:
+                at_risk_data = pd.read_sql_query(
+                    text(
+                        f"select * from {aggregate_at_risk_table} where region_id = ANY(:region_ids)"
+                    ),
+                    con=conn,
+                    params={"region_ids": missing},
+                )
+            for r in missing:
+                _AT_RISK_CACHE[(aggregate_at_risk_table, r)] = at_risk_data.loc[
+                    at_risk_data["region_id"] == r
+                ].reset_index(drop=True)
+        return {r: _AT_RISK_CACHE[(aggregate_at_risk_table, r)] for r in region_ids}
+
+    def _read_results(self, region_ids: list) -> pd.DataFrame:
+        """Return the aggregated results of the storm for all the regions in one query"""
         results_table = self.tables[1]["name"]
         with self.engine.connect() as conn:
-            at_risk_sql = text(
-                f"select * from {aggregate_at_risk_table} where region_id={self.region_id}"
-            )
-            at_risk_data = pd.read_sql_query(
-                at_risk_sql,
+            return pd.read_sql_query(
+                text(
+                    f"select * from {results_table} where storm_id = :storm_id and region_id = ANY(:region_ids)"
+                ),
                 con=conn,
+                params={"storm_id": int(self.storm_id), "region_ids": region_ids},
             )
-            sql_results = text(
-                f"select * from {results_table} where region_id={self.region_id} and storm_id={self.storm_id}"
-            )
-            results_data = pd.read_sql_query(
-                sql_results,
-                con=conn,
-            )
-        category_dict = {
-            "Com": "Commercial",
-            "Ind": "Industrial",
-            "Pub": "Public",
-            "Res": "Residential",
-        }
-        at_risk_data["category"] = at_risk_data["category"].map(category_dict)
-        merged_data = results_data.merge(
-            at_risk_data,
-            how="left",
-            left_on=[
-                "name20",
-                "geoid20",
-                "boundary_type",
-                "boundary_name",
-                "damage_cat_str",
-            ],
-            right_on=[
-                "us_block_name",
-                "block_code",
-                "boundary_type",
-                "boundary_name",
-                "category",
-            ],
+
+    def _upload_report(
+        self, region_id: int, boundary_type: str, df: pd.DataFrame
+    ) -> dict:
+        """Stream one report csv (and its optional parquet copy) to the public bucket
+        returns: dict - manifest entry of the report"""
+        filename = f"S{self.storm_id}_R{region_id}_B_{boundary_type}.csv"
+        key = f"consequence_reports/Storm_{self.storm_id}/Region_{region_id}/{filename}"
+        log.info(f"Uploading report: {filename}")
+        writer = upload_csv(
+            self.s3_client,
+            df,
+            self.bucket_name,
+            key,
+            compress=self.compress,
+            cache_control=self.cache_control,
         )
-        report_cols = [
-            "block_code",
-            "us_block_name",
-            "boundary_type",
-            "boundary_name",
-            "category",
-            "si_affected",
-            "si_at_risk",
-            "total_damage",
-            "content_damage",
-            "structure_damage",
-            "total_value_at_risk",
-            "content_value_at_risk",
-            "structure_value_at_risk",
-        ]
-        merged_data = merged_data[report_cols]
-        renamed_cols = {
-            "block_code": "Block code",
-            "us_block_name": "Block name",
-            "category": "Category",
-            "si_affected": "Affected structures",
-            "si_at_risk": "Structures at risk",
-            "total_damage": "Total damage cost",
-            "content_damage": "Content damage cost",
-            "structure_damage": "Structure damage cost",
-            "total_value_at_risk": "Total value at risk",
-            "content_value_at_risk": "Content value at risk",
-            "structure_value_at_risk": "Structure value at risk",
+        if self.parquet:
+            try:
+                upload_parquet(
+                    self.s3_client,
+                    df,
+                    self.bucket_name,
+                    key.replace(".csv", ".parquet"),
+                    cache_control=self.cache_control,
+                )
+            except ImportError as e:
+                log.warning(f"Parquet copy of {filename} skipped: {e}")
+        log.info(f"Report generated: {filename}")
+        return {
+            "region_id": region_id,
+            "boundary_type": boundary_type,
+            "key": key,
+            "size": writer.size,
+            "rows": len(df),
+            "etag": writer.etag,
+            "encoding": "gzip" if self.compress else None,
+            "generated": datetime.now(timezone.utc).isoformat(),
         }
-        for bt in merged_data.boundary_type.unique():
-            result_df = pd.DataFrame(columns=merged_data.columns)
-            csv = merged_data.loc[merged_data["boundary_type"] == bt].copy()
-            for block in csv.block_code.unique():
-                block_df = csv[csv["block_code"] == block].copy()
-                total_row = (
-                    block_df.groupby("block_code")
-                    .agg(
-                        {
-                            "us_block_name": "first",
-                            "boundary_type": "first",
-                            "boundary_name": "first",
-                            "si_affected": "sum",
-                            "si_at_risk": "sum",
-                            "total_damage": "sum",
-                            "content_damage": "sum",
-                            "structure_damage": "sum",
-                            "total_value_at_risk": "sum",
-                            "content_value_at_risk": "sum",
-                            "structure_value_at_risk": "sum",
-                        }
+
+    def _generate_regions(self, region_ids: list) -> bool:
+        """Generate the reports of several regions from a single load of the storm results
+        returns: bool - All the reports were uploaded, the failed ones are logged"""
+        region_ids = sorted({int(r) for r in region_ids})
+        log.info(
+            f"Generating report for regions {region_ids} and storm {self.storm_id}"
+        )
+        at_risk_data = self._read_at_risk(region_ids)
+        results_data = self._read_results(region_ids)
+        uploads = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for region_id, region_results in results_data.groupby("region_id"):
+                region_id = int(region_id)
+                reports = build_region_reports(region_results, at_risk_data[region_id])
+                for bt, report_df in reports.items():
+                    future = executor.submit(
+                        self._upload_report, region_id, bt, report_df
                     )
-                    .reset_index()
-                )
-                total_row["block_code"] = block
-                total_row["category"] = "Total"
-                result_df = pd.concat(
-                    [result_df, block_df, total_row], ignore_index=True
+                    uploads.append((region_id, bt, future))
+        # Only the reports that reached the bucket are registered
+        entries = []
+        for region_id, bt, future in uploads:
+            try:
+                entries.append(future.result())
+            except Exception as e:
+                log.error(
+                    f"Report {bt} of region {region_id} and storm {self.storm_id} "
+                    f"was not uploaded: {e}"
                 )
+        self.__upsert_to_table([(e["region_id"], e["boundary_type"]) for e in entries])
+        if entries:
+            self.get_manifest().update(self.storm_id, entries)
+        return len(entries) == len(uploads)
 
-            result_df.drop(columns=["boundary_type"], inplace=True)
-            renamed_cols["boundary_name"] = bt
-            result_df.rename(columns=renamed_cols, inplace=True)
-            filename = f"S{self.storm_id}_R{self.region_id}_B_{bt}.csv"
-            csv_buffer = StringIO()
-            result_df.to_csv(csv_buffer, index=False)
-            log.info(f"Uploading report: {filename}")
-
-            self.s3_resource.Object(
-                self.bucket_name,
-                f"consequence_reports/Storm_{self.storm_id}/Region_{self.region_id}/{filename}",
-            ).put(Body=csv_buffer.getvalue())
-            log.info(f"Report generated: {filename}")
-            self.__insert_to_table(bt)
+    def _delete_regions(self, region_ids: list) -> bool:
+        """Delete the reports of several regions"""
+        region_ids = sorted({int(r) for r in region_ids})
+        bucket = self.s3_resource.Bucket(self.bucket_name)
+        for region_id in region_ids:
+            log.info(
+                f"Deleting report for region {region_id} and storm {self.storm_id}"
+            )
+            to_delete = bucket.objects.filter(
+                Prefix=f"consequence_reports/Storm_{self.storm_id}/Region_{region_id}/"
+            )
+            to_delete.delete()
+        self.__delete_to_table(region_ids)
+        self.get_manifest().remove_regions(self.storm_id, region_ids)
         return True
 
+    def generate(self):
+        """Generate the report"""
+        return self._generate_regions([self.region_id])
+
     def delete(self):
         """Delete the report"""
-        log.info(
-            f"Deleting report for region {self.region_id} and storm {self.storm_id}"
-        )
-        bucket = self.s3_resource.Bucket(self.bucket_name)
-        to_delete = bucket.objects.filter(
-            Prefix=f"consequence_reports/Storm_{self.storm_id}/Region_{self.region_id}/"
-        )
-        to_delete.delete()
-        self.__delete_to_table()
-        return True
+        return self._delete_regions([self.region_id])
+
+
+class ReportBatch(Report):
+    def __init__(
+        self,
+        region_ids: list,
+        storm_id: int,
+        config_file="credentials.yaml",
+        **kwargs,
+    ):
+        """Define a class to generate or delete the reports of several regions of a storm
+        in one pass: the storm results are loaded once and partitioned by region
+        parameters:
+        region_ids: list - Region ids to generate or delete the reports
+        storm_id: int - Storm id to generate or delete the reports
+        config_file: str - Path to the yaml credentials file (database connection info)
+        kwargs: upload options of Report (compress, parquet, max_workers, cache_control)
+        """
+        super().__init__(None, storm_id, config_file, **kwargs)
+        self.region_ids = sorted({int(r) for r in region_ids})
+
+    def generate(self):
+        """Generate the reports of all the regions"""
+        return self._generate_regions(self.region_ids)
+
+    def delete(self):
+        """Delete the reports of all the regions"""
+        return self._delete_regions(self.region_ids)
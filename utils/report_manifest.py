@@ -0,0 +1,147 @@
+import json
+import logging
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+
+log = logging.getLogger(__name__)
+
+# Errors returned by S3 when a conditional write loses a race
+_CONFLICT_CODES = ("PreconditionFailed", "ConditionalRequestConflict")
+
+
+class ReportManifest:
+    """Class that maintains a json manifest of the reports of each storm and a global index
+    so the download page can list the reports with a single GET.
+    Manifests are rewritten with conditional PUTs (If-Match/If-None-Match) and retried on
+    conflicts, so concurrent runs never overwrite each other's changes.
+    params:
+        s3: boto3 S3 client
+        bucket: public bucket name: str
+        prefix: prefix of the reports in the bucket: str
+        cache_control: Cache-Control header of the manifests: str
+        max_attempts: attempts of a read-modify-write cycle before giving up: int
+    """
+
+    def __init__(
+        self,
+        s3,
+        bucket,
+        prefix="consequence_reports",
+        cache_control="max-age=60",
+        max_attempts=5,
+    ):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.cache_control = cache_control
+        self.max_attempts = max_attempts
+
+    def manifest_key(self, storm_id: int) -> str:
+        return f"{self.prefix}/Storm_{storm_id}/manifest.json"
+
+    def index_key(self) -> str:
+        return f"{self.prefix}/index.json"
+
+    def _load(self, key: str):
+        """Return the json document stored in key and its ETag (None if missing)"""
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None, None
+            raise
+        return json.loads(response["Body"].read()), response["ETag"]
+
+    def _save(self, key: str, document, etag) -> None:
+        """Write the document only if the object did not change since it was read"""
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=json.dumps(document, separators=(",", ":")).encode(),
+            ContentType="application/json",
+            CacheControl=self.cache_control,
+            **condition,
+        )
+
+    def _delete(self, key: str, etag) -> None:
+        self.s3.delete_object(Bucket=self.bucket, Key=key, IfMatch=etag)
+
+    def _modify(self, key: str, change) -> dict:
+        """Apply change (document -> document or None to delete it) with optimistic locking"""
+        for attempt in range(1, self.max_attempts + 1):
+            document, etag = self._load(key)
+            new_document = change(document)
+            try:
+                if new_document is not None:
+                    self._save(key, new_document, etag)
+                elif etag is not None:
+                    self._delete(key, etag)
+                return new_document
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in _CONFLICT_CODES:
+                    raise
+                log.info(f"{key} changed while updating it, retrying ({attempt})")
+        raise RuntimeError(f"Could not update {key} after {self.max_attempts} attempts")
+
+    def update(self, storm_id: int, reports: list) -> dict:
+        """Add or replace report entries in the storm manifest
+        reports: list of dict with region_id, boundary_type, key, size, rows, etag, generated"""
+        new_entries = {(r["region_id"], r["boundary_type"]): r for r in reports}
+
+        def change(document):
+            entries = {
+                (r["region_id"], r["boundary_type"]): r
+                for r in (document or {}).get("reports", [])
+            }
+            entries.update(new_entries)
+            return self._storm_document(storm_id, entries.values())
+
+        manifest = self._modify(self.manifest_key(storm_id), change)
+        self._update_index(storm_id, manifest)
+        return manifest
+
+    def remove_regions(self, storm_id: int, region_ids: list) -> dict:
+        """Remove the report entries of the regions from the storm manifest"""
+        region_ids = {int(r) for r in region_ids}
+
+        def change(document):
+            entries = [
+                r
+                for r in (document or {}).get("reports", [])
+                if r["region_id"] not in region_ids
+            ]
+            return self._storm_document(storm_id, entries) if entries else None
+
+        manifest = self._modify(self.manifest_key(storm_id), change)
+        self._update_index(storm_id, manifest)
+        return manifest
+
+    def _storm_document(self, storm_id: int, entries) -> dict:
+        return {
+            "storm_id": int(storm_id),
+            "updated": datetime.now(timezone.utc).isoformat(),
+            "reports": sorted(
+                entries, key=lambda r: (r["region_id"], r["boundary_type"])
+            ),
+        }
+
+    def _update_index(self, storm_id: int, manifest) -> None:
+        """Reflect the storm manifest in the global index"""
+
+        def change(document):
+            document = document or {"storms": {}}
+            if manifest is None:
+                document["storms"].pop(str(storm_id), None)
+            else:
+                document["storms"][str(storm_id)] = {
+                    "manifest": self.manifest_key(storm_id),
+                    "updated": manifest["updated"],
+                    "regions": sorted({r["region_id"] for r in manifest["reports"]}),
+                    "reports": len(manifest["reports"]),
+                    "size": sum(r["size"] for r in manifest["reports"]),
+                }
+            document["updated"] = datetime.now(timezone.utc).isoformat()
+            return document
+
+        self._modify(self.index_key(), change)
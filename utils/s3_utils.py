@@ -0,0 +1,159 @@
+import gzip
+import io
+import logging
+
+log = logging.getLogger(__name__)
+
+# S3 rejects multipart parts smaller than 5 MiB (except the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """Writable file object that streams its content to S3 using a multipart upload
+    Data is buffered until a part is full and each part is uploaded as soon as it is
+    ready, so only one part is kept in memory. Small objects (less than one part)
+    are sent with a single put_object call.
+    params:
+        s3: boto3 S3 client
+        bucket: bucket name: str
+        key: object key: str
+        part_size: size of each uploaded part in bytes: int (>= 5 MiB)
+        extra_args: extra put/create_multipart_upload arguments: dict e.g. {"ContentType": "text/csv"}
+    """
+
+    def __init__(self, s3, bucket, key, part_size=8 * 1024 * 1024, extra_args=None):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"part_size must be at least {MIN_PART_SIZE} bytes")
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.extra_args = extra_args or {}
+        self.size = 0
+        self.etag = None
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.size
+
+    def write(self, b) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+        self._buffer.extend(b)
+        self.size += len(b)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[: self.part_size]))
+            del self._buffer[: self.part_size]
+        return len(b)
+
+    def _upload_part(self, body: bytes) -> None:
+        """Upload one part, starting the multipart upload on the first one"""
+        if self._upload_id is None:
+            response = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.extra_args
+            )
+            self._upload_id = response["UploadId"]
+        part_number = len(self._parts) + 1
+        response = self.s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def close(self) -> None:
+        """Send the remaining data and complete the upload"""
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                response = self.s3.put_object(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    Body=bytes(self._buffer),
+                    **self.extra_args,
+                )
+            else:
+                if self._buffer:
+                    self._upload_part(bytes(self._buffer))
+                response = self.s3.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": self._parts},
+                )
+            self.etag = response["ETag"].strip('"')
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+            super().close()
+
+    def abort(self) -> None:
+        """Abort the multipart upload so no orphan parts are left in the bucket"""
+        if self._upload_id is not None:
+            log.error(f"Aborting upload of s3://{self.bucket}/{self.key}")
+            self.s3.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+            )
+            self._upload_id = None
+        self._buffer = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def upload_csv(
+    s3, df, bucket, key, compress=False, cache_control=None, chunk_rows=50000
+):
+    """Stream a dataframe as csv to S3, optionally gzip encoded
+    params:
+        s3: boto3 S3 client
+        df: Pandas dataframe
+        bucket: bucket name: str
+        key: object key: str
+        compress: if True the object is stored gzip encoded (Content-Encoding: gzip)
+        cache_control: Cache-Control header of the object: str e.g. "max-age=3600"
+        chunk_rows: number of rows rendered at a time: int
+    returns: the closed S3MultipartWriter (size and etag of the stored object)
+    """
+    extra_args = {"ContentType": "text/csv; charset=utf-8"}
+    if compress:
+        extra_args["ContentEncoding"] = "gzip"
+    if cache_control:
+        extra_args["CacheControl"] = cache_control
+    with S3MultipartWriter(s3, bucket, key, extra_args=extra_args) as writer:
+        stream = gzip.GzipFile(fileobj=writer, mode="wb") if compress else writer
+        text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+        df.to_csv(text, index=False, chunksize=chunk_rows)
+        text.flush()
+        if compress:
+            # Closing the gzip stream writes its trailer, it does not close the writer
+            text.detach()
+            stream.close()
+        else:
+            text.detach()
+    return writer
+
+
+def upload_parquet(s3, df, bucket, key, cache_control=None):
+    """Stream a dataframe as a parquet file to S3 (requires pyarrow)
+    returns: the closed S3MultipartWriter (size and etag of the stored object)"""
+    extra_args = {"ContentType": "application/vnd.apache.parquet"}
+    if cache_control:
+        extra_args["CacheControl"] = cache_control
+    with S3MultipartWriter(s3, bucket, key, extra_args=extra_args) as writer:
+        df.to_parquet(writer, index=False)
+    return writer
@@ -1,4 +1,22 @@
-from .add import AddData
-from .delete import DeleteData
+import importlib
 
-__all__ = [AddData, DeleteData]
+# geopandas and SQLAlchemy are imported with the first class used
+_EXPORTS = {
+    "AddData": ".add",
+    "DeleteData": ".delete",
+    "StormRegistry": ".storms",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -4,35 +4,141 @@ import numpy as np
 import psycopg2
 from sqlalchemy import create_engine, text
 import logging
-from .. import get_db_connection
+from .aggregate import BlockAggregation
+from .load import MergeLoader
+from .preflight import parse_storm_name
+from .storms import StormRegistry
+from .transform import to_epsg
 
 log = logging.getLogger(__name__)
 
+# Dtypes applied to the raw and to the processed columns: repeated strings as categories
+# and 32 bit ids. The measures stay float64, the float8 columns of the results table
+# would store the widened float32 values (1.100000023841858) with to_postgis
+DTYPE_PLAN = {
+    "fd_id": "int32",
+    "storm_id": "int32",
+    "occupancy": "category",
+    "damage cat": "category",
+    "damage_cat": "category",
+    "occupancy_str": "category",
+    "damage_cat_str": "category",
+}
+# Bytes per value of the object columns (strings) and of the geometries
+_OBJECT_BYTES = 64
+_GEOMETRY_BYTES = 120
+# Peak memory of process_data relative to the data read (copy, merge and output frame)
+PEAK_FACTOR = 4
+# A file needing chunks smaller than this to fit the memory budget is refused
+MIN_CHUNK_ROWS = 1000
+
+
+def compact_dtypes(df):
+    """Apply DTYPE_PLAN to the columns of the frame"""
+    dtypes = {c: t for c, t in DTYPE_PLAN.items() if c in df.columns}
+    return df.astype(dtypes) if dtypes else df
+
+
+def estimate_memory(info: dict) -> int:
+    """Return the estimated peak memory in bytes of processing a file at once
+    parameters:
+    info: dict - Description of the file from pyogrio.read_info (features and dtypes)"""
+    row_bytes = _GEOMETRY_BYTES
+    for dtype in info["dtypes"]:
+        try:
+            dtype = np.dtype(dtype)
+            row_bytes += _OBJECT_BYTES if dtype.kind == "O" else dtype.itemsize
+        except TypeError:
+            row_bytes += _OBJECT_BYTES
+    return int(info["features"] * row_bytes * PEAK_FACTOR)
+
+
+# Attributes rebuilt by the worker from the job description
+_NOT_SHIPPED = (
+    "tables",
+    "engine",
+    "schema",
+    "aggregation",
+    "data",
+    "source_data",
+    "processed_data",
+)
+
 
 class AddData:
-    def __init__(self, path: dict, config_file: str = "credentials.yaml"):
-        """Define a class to add data to the database
+    def __init__(
+        self,
+        path: dict,
+        config_file: str = "credentials.yaml",
+        memory_budget: int = None,
+        load_mode: str = "append",
+        storms: StormRegistry = None,
+    ):
+        """Define a job adding a shapefile to the database
+        Creating the job does not read the file nor connect to the database, so jobs can be
+        listed and sent to workers (they can be pickled). plan() reads the file and resolves
+        its regions and storm, execute() stores it. A file read in chunks is read once, by
+        execute(), which resolves its regions while storing it. Each step keeps its
+        result, a failed job is retried from the step that failed.
         parameters:
         path: dict - Contains the bucket and key of the file to be processed
-        config_file: str - Path to the yaml credentials file (database connection info)"""
+        config_file: str - Path to the yaml credentials file (database connection info)
+        memory_budget: int - Bytes the job may use, a larger file is read and stored in
+                             chunks (it is refused if the chunks would be too small)
+        load_mode: str - "append" the rows, or "merge" them on (storm_id, fd_id): only
+                         new and changed rows are written (see load.MergeLoader). Once
+                         the result table has the unique index of the key, append
+                         skips the keys already loaded
+        storms: StormRegistry - Storms resolved for the whole run, the storms without
+                                results are then cleaned by the registry at the end of
+                                the run instead of after each file"""
+        if load_mode not in ("append", "merge"):
+            raise ValueError(f"Unknown load mode {load_mode}")
         self.path = path
         self.config_file = config_file
-        self._load_config(self.config_file)
+        self.memory_budget = memory_budget
+        self.load_mode = load_mode
+        self.load_counts = None
+        self.storms = storms
         self.s3_path = self._get_s3_path()
-        self.data = self._read_data()
-        self.regions_id = self.__get_regions(self.data)
-        storm_data = self.__get_storm_name()
-        if storm_data is None:
-            print("Tropical and Nontropical storms are not supported")
-            return None
-        else:
-            self.storm_name = storm_data["storm_name"]
-            self.storm_event_type = storm_data["event_type"]
-        self.storm_id = self.__insert_event()
+        self.tables = None
+        self.engine = None
+        self.chunk_size = None
+        self.rows = None
+        self.data = None
+        self.source_data = None
+        self.regions_id = None
+        self.storm_name = None
+        self.storm_event_type = None
+        self.storm_id = None
+        self.processed_data = None
+        self.saved = False
+
+    def __getstate__(self) -> dict:
+        """The configuration (it holds the database password), the engine and the
+        frames are not shipped with the job, the worker loads them again from the path
+        and the config_file of the job"""
+        state = self.__dict__.copy()
+        state.update({name: None for name in _NOT_SHIPPED if name in state})
+        return state
+
+    def to_job(self) -> dict:
+        """Return the description of the job"""
+        return {
+            "path": self.path,
+            "config_file": self.config_file,
+            "memory_budget": self.memory_budget,
+            "load_mode": self.load_mode,
+        }
+
+    @classmethod
+    def from_job(cls, job: dict) -> "AddData":
+        """Create the job from its description"""
+        return cls(**job)
 
     def _load_config(self, config_file: str) -> bool:
         """Load the database credentials from the yaml file
-        It sets the connection, engine, schema and tables attributes"""
+        It sets the engine, schema and tables attributes"""
         try:
             with open(config_file, "r") as f:
                 config_data = yaml.safe_load(f)
@@ -45,8 +151,19 @@ class AddData:
                 {"type": table["type"], "name": table["name"]}
                 for table in config_data["database"]["tables"]
             ]
-            self.connection = get_db_connection(
-                db_name, db_user, db_password, db_host, db_port
+            report_tables = {
+                table["type"]: table["name"]
+                for table in config_data["database"].get("report", [])
+            }
+            # The block summary is only maintained when the boundaries table is configured
+            self.aggregation = (
+                BlockAggregation(
+                    self.tables[0]["name"],
+                    report_tables["results_data"],
+                    report_tables["boundaries"],
+                )
+                if "boundaries" in report_tables
+                else None
             )
             self.engine = create_engine(
                 f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
@@ -58,10 +175,100 @@ class AddData:
             log.info("Credentials file not found")
             return False
 
-    def _read_data(self) -> gpd.GeoDataFrame:
-        """Read the data from the s3 bucket and return a geopandas dataframe"""
+    def _connect(self) -> None:
+        """Load the configuration and create the engine when they are not loaded"""
+        if self.tables is None and not self._load_config(self.config_file):
+            raise FileNotFoundError(f"{self.config_file} not found")
+
+    def plan(self) -> dict:
+        """Read the file (projected to 3857) and resolve its regions and its storm, the
+        steps already done are not repeated. A file processed in chunks is not read here,
+        its regions are resolved by execute()
+        returns: dict - Summary of the job"""
+        if self.storm_name is None:
+            # The file name is checked before any read or database work
+            storm_data = self.__get_storm_name()
+            if storm_data is None:
+                raise ValueError("Tropical and Nontropical storms are not supported")
+            self.storm_name = storm_data["storm_name"]
+            self.storm_event_type = storm_data["event_type"]
+        self._connect()
+        if self.chunk_size is None:
+            self.chunk_size = self._memory_plan()
+        if not self.chunk_size and self.regions_id is None:
+            self.regions_id = self.__get_regions(self._load_data())
+        if self.storm_id is None:
+            self.storm_id = self.__insert_event()
+        return {
+            **self.to_job(),
+            "regions": None if self.regions_id is None else list(self.regions_id),
+            "storm_name": self.storm_name,
+            "storm_id": self.storm_id,
+            "rows": self.rows,
+            "chunk_size": self.chunk_size,
+        }
+
+    def _memory_plan(self) -> int:
+        """Return the rows per chunk when the file does not fit the memory budget,
+        0 when it is processed at once"""
+        if not self.memory_budget:
+            return 0
+        import pyogrio
+
+        info = pyogrio.read_info(self.s3_path)
+        self.rows = info["features"]
+        estimate = estimate_memory(info)
+        if estimate <= self.memory_budget:
+            return 0
+        chunk_size = int(self.rows * self.memory_budget / estimate)
+        if chunk_size < MIN_CHUNK_ROWS:
+            raise MemoryError(
+                f"{self.s3_path} needs {estimate} bytes, chunks of {chunk_size} rows "
+                f"would fit the budget of {self.memory_budget} bytes"
+            )
+        log.info(
+            f"{self.s3_path} needs {estimate} bytes, it is processed in chunks of "
+            f"{chunk_size} rows"
+        )
+        return chunk_size
+
+    def _load_data(self) -> gpd.GeoDataFrame:
+        """Return the data of the file projected to 3857, it is read once"""
+        if self.data is None:
+            self.data = to_epsg(compact_dtypes(self._read_data()))
+            self.rows = len(self.data)
+        return self.data
+
+    def _read_chunks(self):
+        """Yield the file in chunks of chunk_size rows, projected to 3857"""
+        for start in range(0, self.rows, self.chunk_size):
+            yield to_epsg(compact_dtypes(self._read_data(start, self.chunk_size)))
+
+    def _process_chunks(self):
+        """Yield the processed chunks of the file, the regions of the file are resolved
+        in the same read and set once every chunk is processed"""
+        regions = []
+        for chunk in self._read_chunks():
+            if self.regions_id is None:
+                regions.append(self.__get_regions(chunk))
+            yield self.process_data(chunk)
+        if self.regions_id is None:
+            self.regions_id = np.unique(np.concatenate(regions))
+
+    def _read_data(
+        self, skip_features: int = 0, max_features: int = None
+    ) -> gpd.GeoDataFrame:
+        """Read the data from the s3 bucket and return a geopandas dataframe
+        parameters:
+        skip_features: int - Rows skipped at the start of the file
+        max_features: int - Rows read, all of them by default"""
         log.info(f"Loading {self.s3_path}")
-        gdf = gpd.read_file(self.s3_path)
+        if max_features:
+            gdf = gpd.read_file(
+                self.s3_path, skip_features=skip_features, max_features=max_features
+            )
+        else:
+            gdf = gpd.read_file(self.s3_path)
         if gdf.crs is None or gdf.crs.to_epsg() != 4326:
             raise ValueError("Shapefile does not have CRS EPSG:4326")
         log.info(f"Finished loading {self.s3_path}")
@@ -79,9 +286,7 @@ class AddData:
         return f"s3://{self.path['Bucket']}/{self.path['Key']}"
 
     def __get_regions(self, result_data: gpd.GeoDataFrame) -> list:
-        """Return the region id"""
-
-        result_data.to_crs(3857, inplace=True)
+        """Return the region id, result_data is in 3857"""
         sql = text(f"SELECT * FROM {self.tables[3]['name']}")
         with self.engine.connect() as conn:
             regions = gpd.read_postgis(sql, conn, geom_col="shape")
@@ -99,10 +304,12 @@ class AddData:
         "Method to view the raw data"
         return self.data
 
-    def process_data(self) -> gpd.GeoDataFrame:
-        """Process the data and return a geopandas dataframe with the processed data as Geodataframe"""
+    def process_data(self, data: gpd.GeoDataFrame = None) -> gpd.GeoDataFrame:
+        """Process the data and return a geopandas dataframe with the processed data as Geodataframe
+        parameters:
+        data: GeoDataFrame - Chunk of the file to process, the whole file by default"""
+        # gdb_geomattr_data is always empty, the database fills it with NULL
         columns = [
-            "gdb_geomattr_data",
             "shape",
             "storm_id",
             "fd_id",
@@ -126,7 +333,9 @@ class AddData:
             "found_ht",
             "depth_above_ff",
         ]
-        self.data.rename(
+        # The raw data is kept unchanged, a failed job can be processed again
+        data = self._load_data().copy() if data is None else data
+        data.rename(
             columns={
                 "geometry": "shape",
                 "damage cat": "damage_cat",
@@ -134,53 +343,28 @@ class AddData:
             },
             inplace=True,
         )
-        source_data = self._read_source_data()
-        source_data["fd_id"] = source_data["fd_id"].astype(int)
-        source_data = source_data[["fd_id", "found_ht"]]
-        self.data["fd_id"] = self.data["fd_id"].astype(int)
-        self.data["content_da"] = self.data["content_da"].round(-3)
-        self.data["structure"] = self.data["structure"].round(-3)
-        self.data = gpd.GeoDataFrame(
-            self.data.merge(source_data, on="fd_id", how="left", suffixes=(None, "_y"))
-        )
-        self.data["depth_above_ff"] = self.data["depth"] - self.data["found_ht"]
-        self.data["storm_id"] = self.storm_id
-        self.data["gdb_geomattr_data"] = np.nan
-        self.data["total_damage"] = self.data["content_da"] + self.data["structure"]
-        self.data["path_aws"] = self.s3_path
-        self.data["occupancy_str"] = self.data["occupancy"].apply(
-            self.extract_occupancy
-        )
-        self.data["damage_cat_str"] = self.data["damage_cat"].apply(
-            self.extract_damage_category
+        if self.source_data is None:
+            source_data = self._read_source_data()
+            self.source_data = compact_dtypes(source_data[["fd_id", "found_ht"]])
+        data["content_da"] = data["content_da"].round(-3)
+        data["structure"] = data["structure"].round(-3)
+        data = gpd.GeoDataFrame(
+            data.merge(self.source_data, on="fd_id", how="left", suffixes=(None, "_y"))
         )
-        self.data = self.data.loc[self.data["total_damage"] > 0]
-        self.data.set_geometry("shape", inplace=True)
-        self.data.to_crs(3857, inplace=True)
-        return self.data[columns]
+        data["depth_above_ff"] = data["depth"] - data["found_ht"]
+        data["storm_id"] = self.storm_id
+        data["total_damage"] = data["content_da"] + data["structure"]
+        data["path_aws"] = self.s3_path
+        # The labels are computed once per category
+        data["occupancy_str"] = data["occupancy"].map(self.extract_occupancy)
+        data["damage_cat_str"] = data["damage_cat"].map(self.extract_damage_category)
+        data = data.loc[data["total_damage"] > 0]
+        data.set_geometry("shape", inplace=True)
+        return compact_dtypes(data[columns])
 
     def __get_storm_name(self) -> str:
         """Return the storm name from the s3 path"""
-        filename = self.path["Key"].split("/")[-1]
-        name = filename.replace(" ", "").split("_")
-        log.info(f"Storm name: {name}")
-        log.info(f"Storm name length: {len(name)}")
-        if len(name) >= 12:
-            storm_name = name[2]  # name[7]
-            # frequency = name[2]
-            event_type = 1
-        else:
-            if name[1] == "CMB":
-                storm_name = name[3]  ##f"{name[1]}, {name[2]}"
-                # frequency = name[3]
-                event_type = 3
-            elif name[1] in ["nTC", "TC"]:
-                return None
-            else:
-                storm_name = name[2]
-                # frequency = "N.A."
-                event_type = 2
-        return {"storm_name": storm_name, "event_type": event_type}
+        return parse_storm_name(self.path["Key"])
 
     def get_storm_name(self) -> str:
         """Return the storm name"""
@@ -253,75 +437,93 @@ class AddData:
             damage_category = "Unknown"
         return damage_category
 
-    def _check_and_insert_data(self, sql_select: str, sql_insert: str) -> int:
-        """Check if the data exists in the databaseor insert the data"""
-        cursor = self.connection.cursor()
-        cursor.execute(sql_select)
-        row_id = cursor.fetchone()
-        if row_id:
-            self.connection.commit()
-            cursor.close()
-            row_id = int(row_id[0])
-        else:
-            cursor.execute(sql_insert)
-            self.connection.commit()
-            cursor.execute(sql_select)
-            row_id_val = cursor.fetchone()[0]
-            cursor.close()
-            row_id = int(row_id_val)
-        return row_id
-
     def __insert_event(self) -> int:
-        """Insert the storm name into the database and return the storm_id"""
-        sql_insert_storm = f"INSERT INTO {self.tables[1]['name']} (storm,event_type) VALUES ('{self.storm_name}',{self.storm_event_type})"
-        sql_select_storm = f"SELECT storm_id FROM {self.tables[1]['name']} WHERE storm='{self.storm_name}' AND event_type={self.storm_event_type}"
-        storm_id = self._check_and_insert_data(sql_select_storm, sql_insert_storm)
+        """Return the storm_id of the storm, inserting the storm when it is new"""
+        registry = self.storms or StormRegistry(self.tables[1]["name"])
+        storm_id = registry.get(self.storm_name, self.storm_event_type)
+        if storm_id is None:
+            storm = {"storm_name": self.storm_name, "event_type": self.storm_event_type}
+            with self.engine.begin() as conn:
+                storm_id = registry.resolve([storm], conn)[
+                    (self.storm_name, self.storm_event_type)
+                ]
         return storm_id
 
     def get_storm_id(self) -> int:
         """Return the storm_id"""
         return self.storm_id
 
-    def _delete_isolate_data(self, sql_select: str, table: str, field: str) -> bool:
-        """Delete data that is not connected to the results table"""
-        cursor = self.connection.cursor()
-        cursor.execute(sql_select)
-        ids = cursor.fetchall()
-        if ids:
-            for id in ids:
-                sql_delete = f"DELETE FROM {table} WHERE {field}={id[0]}"
-                cursor.execute(sql_delete)
-            self.connection.commit()
-            cursor.close()
-        return True
-
-    def clean_storm_data(self) -> None:
-        """Delete storm names that are not related into the results table"""
-        sql_select = f"SELECT storm_id FROM {self.tables[1]['name']} WHERE storm_id not in (SELECT DISTINCT storm_id FROM {self.tables[0]['name']})"
-        self._delete_isolate_data(sql_select, self.tables[1]["name"], "storm_id")
-
-    def save_data(self, processed_data: gpd.GeoDataFrame) -> None:
-        """Save the processed data into the database"""
-        try:
-            processed_data.to_postgis(
-                "result", self.engine, if_exists="append", schema=self.schema
+    def clean_storm_data(self, conn) -> None:
+        """Delete storm names that are not related into the results table
+        parameters:
+        conn: sqlalchemy Connection - Transaction of the load"""
+        conn.execute(
+            text(
+                f"DELETE FROM {self.tables[1]['name']} s WHERE NOT EXISTS "
+                f"(SELECT 1 FROM {self.tables[0]['name']} r WHERE r.storm_id = s.storm_id)"
             )
-            self.clean_storm_data()
-            self.connection.commit()
-            self.connection.close()
+        )
+
+    def save_data(self, processed_data) -> bool:
+        """Save the processed data into the database
+        parameters:
+        processed_data: GeoDataFrame or iterable of GeoDataFrames (chunks of the file),
+                        all of them are saved in one transaction with the block summary
+                        and the storm cleanup
+        returns: bool - The data was saved"""
+        frames = (
+            [processed_data]
+            if isinstance(processed_data, gpd.GeoDataFrame)
+            else processed_data
+        )
+        try:
+            with self.engine.begin() as conn:
+                loader = MergeLoader(
+                    self.tables[0]["name"], aggregation=self.aggregation
+                )
+                if self.load_mode == "merge":
+                    self.load_counts = loader.load(conn, frames)
+                else:
+                    if self.aggregation is not None:
+                        # Rows of the file loaded by a previous run leave the summary,
+                        # add_file then counts all the rows of the file once
+                        self.aggregation.remove_file(conn, self.s3_path)
+                    if loader.is_keyed(conn):
+                        # The migrated table refuses duplicated keys, the rows already
+                        # loaded are kept
+                        loader.append(conn, frames)
+                    else:
+                        for frame in frames:
+                            frame.to_postgis(
+                                "result", conn, if_exists="append", schema=self.schema
+                            )
+                    if self.aggregation is not None:
+                        self.aggregation.add_file(conn, self.s3_path)
+                if self.storms is None:
+                    self.clean_storm_data(conn)
+            # The rows are committed, nothing after this point can fail the file
+            return True
         except (Exception, psycopg2.DatabaseError) as error:
             log.info(error)
-        finally:
-            if self.connection is not None:
-                self.connection.close()
+            return False
 
     def execute(self) -> bool:
-        """Execute the pipeline"""
+        """Execute the pipeline, planning the job first when it was not planned"""
         try:
-            log.info(f"Processing {self.s3_path}")
-            processed_data = self.process_data()
-            log.info(f"inserting {self.s3_path} into the database")
-            self.save_data(processed_data)
+            self.plan()
+            if self.chunk_size:
+                log.info(f"Processing {self.s3_path} in chunks")
+                processed = self._process_chunks()
+            else:
+                if self.processed_data is None:
+                    log.info(f"Processing {self.s3_path}")
+                    self.processed_data = self.process_data()
+                processed = self.processed_data
+            if not self.saved:
+                log.info(f"inserting {self.s3_path} into the database")
+                self.saved = self.save_data(processed)
+                if not self.saved:
+                    return False
             log.info(f"Finished processing {self.s3_path}")
             return True
         except Exception as e:
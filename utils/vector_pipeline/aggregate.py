@@ -0,0 +1,171 @@
+from sqlalchemy import text
+import logging
+
+from ..database_utils import has_unique_index
+
+log = logging.getLogger(__name__)
+
+# Columns identifying one row of the block summary
+GROUP_COLS = [
+    "storm_id",
+    "region_id",
+    "boundary_type",
+    "geoid20",
+    "name20",
+    "boundary_name",
+    "damage_cat_str",
+]
+# Group columns that are never NULL
+_NOT_NULL_COLS = ("storm_id", "region_id", "boundary_type", "geoid20")
+# Additive columns: {summary column: expression over the result table}
+SUM_COLS = {
+    "si_affected": "count(*)",
+    "total_damage": "sum(r.total_damage)",
+    "content_damage": "sum(r.content_da)",
+    "structure_damage": "sum(r.structure)",
+}
+
+
+class BlockAggregation:
+    def __init__(self, results_table: str, summary_table: str, boundaries_table: str):
+        """Define a class to keep the block level summary of the results up to date
+        Only the blocks touched by a file are updated: the summary of the file rows is
+        added when the file is loaded and subtracted before it is deleted.
+        The summary table needs a unique index on the GROUP_COLS columns, it is created
+        by the migration (src/migrate_database.py).
+        parameters:
+        results_table: str - Table with the structure results (result)
+        summary_table: str - Block level summary read by the reports (us_blocks_report_results)
+        boundaries_table: str - Census blocks, block groups and tracts with their region_id
+        """
+        self.results_table = results_table
+        self.summary_table = summary_table
+        self.boundaries_table = boundaries_table
+
+    def check_key_index(self, conn) -> None:
+        """raises: ValueError when the summary table has no unique index on the
+        GROUP_COLS used by the upserts (checked once per process)"""
+        if not has_unique_index(conn, self.summary_table, GROUP_COLS, cache=True):
+            raise ValueError(
+                f"{self.summary_table} has no unique index on ({', '.join(GROUP_COLS)}), "
+                "run src/migrate_database.py before loading results"
+            )
+
+    def _summary_select(self, where: str, sign: int = 1) -> str:
+        """Return the query summarizing the result rows matching the where clause
+        Each structure is counted in a single boundary of each type: a point on the edge
+        shared by several blocks goes to the lowest geoid20. Census geoids start with the
+        geoid of their parent, so the block and its tract get the same structures and the
+        block totals add up to the tract totals."""
+        boundary_cols = [
+            c for c in GROUP_COLS if c not in ("storm_id", "damage_cat_str")
+        ]
+        group_cols = ", ".join(f"b.{c}" for c in boundary_cols)
+        sums = ", ".join(f"{sign} * {expr}" for expr in SUM_COLS.values())
+        return (
+            f"SELECT r.storm_id, {group_cols}, r.damage_cat_str, {sums} "
+            f"FROM {self.results_table} r "
+            f"CROSS JOIN LATERAL (SELECT DISTINCT ON (b.boundary_type) {group_cols} "
+            f"FROM {self.boundaries_table} b WHERE ST_Intersects(b.shape, r.shape) "
+            f"ORDER BY b.boundary_type, b.geoid20) b "
+            f"WHERE {where} "
+            f"GROUP BY r.storm_id, {group_cols}, r.damage_cat_str"
+        )
+
+    def _apply(self, conn, where: str, params: dict, sign: int) -> None:
+        """Add (sign=1) or subtract (sign=-1) the summary of the matching rows"""
+        self.check_key_index(conn)
+        columns = GROUP_COLS + list(SUM_COLS)
+        updates = ", ".join(
+            f"{c} = {self.summary_table}.{c} + EXCLUDED.{c}" for c in SUM_COLS
+        )
+        # Only the keys of the delta can be emptied, they are returned by the upsert
+        emptied = (
+            conn.execute(
+                text(
+                    f"WITH applied AS (INSERT INTO {self.summary_table} "
+                    f"({', '.join(columns)}) {self._summary_select(where, sign)} "
+                    f"ON CONFLICT ({', '.join(GROUP_COLS)}) DO UPDATE SET {updates} "
+                    f"RETURNING {', '.join(GROUP_COLS)}, si_affected) "
+                    f"SELECT {', '.join(GROUP_COLS)} FROM applied WHERE si_affected <= 0"
+                ),
+                params,
+            )
+            .mappings()
+            .all()
+        )
+        if emptied:
+            # The boundary columns are compared with = so the unique index is used,
+            # the names and the category may be NULL
+            match = " AND ".join(
+                f"{c} = :{c}"
+                if c in _NOT_NULL_COLS
+                else f"{c} IS NOT DISTINCT FROM :{c}"
+                for c in GROUP_COLS
+            )
+            conn.execute(
+                text(f"DELETE FROM {self.summary_table} WHERE {match}"),
+                [dict(row) for row in emptied],
+            )
+
+    def add_file(self, conn, path_aws: str) -> None:
+        """Add the rows of a file to the summary, all the rows with its path_aws are
+        counted: when the file may already be in the results table call remove_file
+        before loading it"""
+        log.info(f"Adding {path_aws} to {self.summary_table}")
+        self.add_rows(conn, "r.path_aws = :path_aws", {"path_aws": path_aws})
+
+    def remove_file(self, conn, path_aws: str) -> None:
+        """Subtract the rows of a file from the summary, call it before deleting them"""
+        log.info(f"Removing {path_aws} from {self.summary_table}")
+        self.remove_rows(conn, "r.path_aws = :path_aws", {"path_aws": path_aws})
+
+    def add_rows(self, conn, where: str, params: dict = None) -> None:
+        """Add the result rows (alias r) matching the where clause to the summary"""
+        self._apply(conn, where, params or {}, 1)
+
+    def remove_rows(self, conn, where: str, params: dict = None) -> None:
+        """Subtract the result rows (alias r) matching the where clause from the summary,
+        call it before the rows are modified or deleted"""
+        self._apply(conn, where, params or {}, -1)
+
+    def rebuild(self, conn, storm_id: int = None) -> None:
+        """Recompute the summary from the whole results table (or a single storm)"""
+        where, params = (
+            ("r.storm_id = :storm_id", {"storm_id": storm_id})
+            if storm_id
+            else ("TRUE", {})
+        )
+        log.info(f"Rebuilding {self.summary_table} for {storm_id or 'all the storms'}")
+        conn.execute(
+            text(f"DELETE FROM {self.summary_table} r WHERE {where}"),
+            params,
+        )
+        columns = GROUP_COLS + list(SUM_COLS)
+        conn.execute(
+            text(
+                f"INSERT INTO {self.summary_table} ({', '.join(columns)}) "
+                f"{self._summary_select(where)}"
+            ),
+            params,
+        )
+
+    def verify(self, conn, storm_id: int = None) -> int:
+        """Return the number of summary rows that differ from a full recomputation"""
+        where, params = (
+            ("r.storm_id = :storm_id", {"storm_id": storm_id})
+            if storm_id
+            else ("TRUE", {})
+        )
+        columns = GROUP_COLS + list(SUM_COLS)
+        rounded = ", ".join(
+            c if c in GROUP_COLS else f"round({c}::numeric, 2)" for c in columns
+        )
+        expected = f"SELECT {rounded} FROM ({self._summary_select(where)}) e ({', '.join(columns)})"
+        current = f"SELECT {rounded} FROM {self.summary_table} r WHERE {where}"
+        sql = f"SELECT count(*) FROM (({expected} EXCEPT {current}) UNION ALL ({current} EXCEPT {expected})) d"
+        mismatches = conn.execute(text(sql), params).scalar()
+        log.info(
+            f"{mismatches} rows of {self.summary_table} differ from a full rebuild"
+        )
+        return mismatches
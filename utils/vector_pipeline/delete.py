@@ -1,28 +1,62 @@
 import yaml
 import geopandas as gpd
-from sqlalchemy import create_engine, MetaData, Table, text
+from sqlalchemy import create_engine, text
 import logging
-from .. import get_db_connection
+from .aggregate import BlockAggregation
+from .. import get_db_connection, get_table
 
 log = logging.getLogger(__name__)
 
+# Attributes rebuilt by the worker from its config_file
+_NOT_SHIPPED = (
+    "tables",
+    "connection",
+    "engine",
+    "_connection_args",
+    "schema",
+    "aggregation",
+)
+
 
 class DeleteData:
     def __init__(self, path, config_file="credentials.yaml"):
-        """Define a class to add data to the database
+        """Define a job removing the data of a shapefile from the database
+        Creating the job does not connect to the database, so jobs can be listed and sent
+        to workers (they can be pickled). plan() finds the storm and the regions of the
+        file, execute() deletes its rows.
         parameters:
         path: dict - Contains the bucket and key of the file to be processed
         config_file: str - Path to the yaml credentials file (database connection info)"""
         self.path = path
         self.config_file = config_file
-        self._load_config(self.config_file)
         self.s3_path = self._get_s3_path()
-        self.storm_id = self.__get_storm_id()
-        self.regions = self.__get_regions()
+        self.tables = None
+        self.connection = None
+        self.engine = None
+        self.storm_id = None
+        self.regions = None
+        self.deleted = False
+
+    def __getstate__(self) -> dict:
+        """The configuration (it holds the database password) and the connections are
+        not shipped with the job, the worker loads them again from its config_file"""
+        state = self.__dict__.copy()
+        state.update({name: None for name in _NOT_SHIPPED if name in state})
+        return state
+
+    def to_job(self) -> dict:
+        """Return the description of the job"""
+        return {"path": self.path, "config_file": self.config_file}
+
+    @classmethod
+    def from_job(cls, job: dict) -> "DeleteData":
+        """Create the job from its description"""
+        return cls(job["path"], job["config_file"])
 
     def _load_config(self, config_file: str) -> bool:
         """Load the database credentials from the yaml file
-        It sets the connection, engine, schema and tables attributes"""
+        It sets the engine, schema and tables attributes, the connection is opened by
+        _connect()"""
         try:
             with open(config_file, "r") as f:
                 config_data = yaml.safe_load(f)
@@ -35,9 +69,21 @@ class DeleteData:
                 {"type": table["type"], "name": table["name"]}
                 for table in config_data["database"]["tables"]
             ]
-            self.connection = get_db_connection(
-                db_name, db_user, db_password, db_host, db_port
+            report_tables = {
+                table["type"]: table["name"]
+                for table in config_data["database"].get("report", [])
+            }
+            # The block summary is only maintained when the boundaries table is configured
+            self.aggregation = (
+                BlockAggregation(
+                    self.tables[0]["name"],
+                    report_tables["results_data"],
+                    report_tables["boundaries"],
+                )
+                if "boundaries" in report_tables
+                else None
             )
+            self._connection_args = (db_name, db_user, db_password, db_host, db_port)
             self.engine = create_engine(
                 f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
             )
@@ -48,6 +94,28 @@ class DeleteData:
             log.info("Credentials file not found")
             return None
 
+    def _connect(self) -> None:
+        """Load the configuration and open the database connection when it is not open"""
+        if self.tables is None and not self._load_config(self.config_file):
+            raise FileNotFoundError(f"{self.config_file} not found")
+        if self.connection is None or self.connection.closed:
+            self.connection = get_db_connection(*self._connection_args)
+
+    def plan(self) -> dict:
+        """Find the storm and the regions of the file, the steps already done are not
+        repeated
+        returns: dict - Summary of the job"""
+        self._connect()
+        if self.storm_id is None:
+            self.storm_id = self.__get_storm_id()
+        if self.regions is None:
+            self.regions = self.__get_regions()
+        return {
+            **self.to_job(),
+            "regions": list(self.regions),
+            "storm_id": self.storm_id,
+        }
+
     def _get_s3_path(self) -> str:
         """Return the s3 path of the file to be processed"""
         return f"s3://{self.path['Bucket']}/{self.path['Key']}"
@@ -69,14 +137,13 @@ class DeleteData:
 
     def delete_data(self) -> None:
         """Save the processed data into the database"""
-        metadata = MetaData()
-        results_table = Table(
-            self.tables[0]["name"], metadata, autoload_with=self.engine
-        )
+        results_table = get_table(self.engine, self.tables[0]["name"])
         stmt = results_table.delete().where(results_table.c.path_aws == self.s3_path)
         log.info(self.s3_path)
         log.info(stmt)
         with self.engine.begin() as connection:
+            if self.aggregation is not None:
+                self.aggregation.remove_file(connection, self.s3_path)
             connection.execute(stmt)
             connection.commit()
 
@@ -114,10 +181,13 @@ class DeleteData:
         return self.regions
 
     def execute(self) -> bool:
-        """Execute the pipeline"""
+        """Execute the pipeline, planning the job first when it was not planned"""
         try:
-            log.info(f"Deleting {self.s3_path} from the database")
-            self.delete_data()
+            self.plan()
+            if not self.deleted:
+                log.info(f"Deleting {self.s3_path} from the database")
+                self.delete_data()
+                self.deleted = True
             self.clean_storm_data()
             if self.connection is not None:
                 self.connection.close()
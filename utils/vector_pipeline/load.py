@@ -0,0 +1,184 @@
+"""Merge load of the results: rows are keyed on (storm_id, fd_id) instead of appended"""
+
+import io
+import logging
+import numpy as np
+import pandas as pd
+import shapely
+from sqlalchemy import text
+from .. import has_unique_index
+
+log = logging.getLogger(__name__)
+
+# A structure has one result per storm
+KEY = ("storm_id", "fd_id")
+
+
+def copy_buffer(frame) -> io.StringIO:
+    """Return the rows of a GeoDataFrame as csv for COPY, geometries as hex EWKB"""
+    geometry_name = frame.geometry.name
+    data = pd.DataFrame(frame.drop(columns=geometry_name))
+    geometry = shapely.set_srid(np.asarray(frame.geometry.values), frame.crs.to_epsg())
+    data.insert(
+        list(frame.columns).index(geometry_name),
+        geometry_name,
+        shapely.to_wkb(geometry, hex=True, include_srid=True),
+    )
+    buffer = io.StringIO()
+    data.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    return buffer
+
+
+class MergeLoader:
+    def __init__(self, table: str, key=KEY, aggregation=None):
+        """Define a load that merges the rows of a file into the results table
+        The rows are copied into a temporary staging table, then inserted with
+        INSERT ... ON CONFLICT (key) DO UPDATE, only when their values changed. Loading the
+        same structures again does not create duplicates and rewrites only changed rows.
+        A key repeated in the file keeps its last row.
+        The table needs a unique index on the key, it is created by the migration
+        (src/migrate_database.py), see check_key_index.
+        parameters:
+        table: str - Results table
+        key: tuple - Columns identifying a row
+        aggregation: BlockAggregation - Block summary kept up to date (optional)"""
+        self.table = table
+        self.key = tuple(key)
+        self.aggregation = aggregation
+        name = table.split(".")[-1]
+        self.staging = f"{name}_staging"
+        self.merged = f"{name}_merged"
+
+    def is_keyed(self, conn) -> bool:
+        """Tell if the table has the unique index of the key (checked once per process)"""
+        return has_unique_index(conn, self.table, self.key, cache=True)
+
+    def check_key_index(self, conn) -> None:
+        """raises: ValueError when the table has no unique index on the key"""
+        if not self.is_keyed(conn):
+            raise ValueError(
+                f"{self.table} has no unique index on ({', '.join(self.key)}), "
+                "run src/migrate_database.py before merging rows"
+            )
+
+    def _match(self, alias: str, other: str) -> str:
+        return " AND ".join(f"{alias}.{c} = {other}.{c}" for c in self.key)
+
+    def _changed(self, columns: list, alias: str, other: str) -> str:
+        values = [c for c in columns if c not in self.key]
+        return (
+            f"({', '.join(f'{alias}.{c}' for c in values)}) IS DISTINCT FROM "
+            f"({', '.join(f'{other}.{c}' for c in values)})"
+        )
+
+    def stage(self, conn, frames) -> list:
+        """Copy the frames into the staging table (dropped at the end of the transaction)
+        A key repeated in the frames keeps its last row, the staging table then has one
+        row per key.
+        returns: list - Columns of the staged rows"""
+        columns = None
+        for frame in frames:
+            if columns is None:
+                columns = list(frame.columns)
+                conn.execute(
+                    text(
+                        f"CREATE TEMP TABLE {self.staging} ON COMMIT DROP AS "
+                        f"SELECT {', '.join(columns)} FROM {self.table} WITH NO DATA"
+                    )
+                )
+                # Rows are numbered in the order they are copied
+                conn.execute(
+                    text(f"ALTER TABLE {self.staging} ADD COLUMN staged_row bigserial")
+                )
+            cursor = conn.connection.cursor()
+            cursor.copy_expert(
+                f"COPY {self.staging} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+                copy_buffer(frame[columns]),
+            )
+        if columns is not None:
+            conn.execute(
+                text(
+                    f"DELETE FROM {self.staging} AS s USING {self.staging} AS d "
+                    f"WHERE {self._match('d', 's')} AND d.staged_row > s.staged_row"
+                )
+            )
+        return columns
+
+    def merge(self, conn, columns: list) -> dict:
+        """Merge the staging table into the results table
+        returns: dict - Number of staged, inserted, updated and unchanged rows"""
+        keys = ", ".join(self.key)
+        staged = conn.execute(text(f"SELECT count(*) FROM {self.staging}")).scalar()
+        if self.aggregation is not None:
+            # The rows about to change leave the summary with their current values
+            self.aggregation.remove_rows(
+                conn,
+                f"EXISTS (SELECT 1 FROM {self.staging} s WHERE {self._match('s', 'r')} "
+                f"AND {self._changed(columns, 'r', 's')})",
+            )
+        conn.execute(
+            text(
+                f"CREATE TEMP TABLE {self.merged} ON COMMIT DROP AS "
+                f"SELECT {keys}, true AS inserted FROM {self.table} WITH NO DATA"
+            )
+        )
+        updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in columns if c not in self.key)
+        conn.execute(
+            text(
+                f"WITH upserted AS (INSERT INTO {self.table} AS r ({', '.join(columns)}) "
+                f"SELECT {', '.join(columns)} FROM {self.staging} "
+                f"ON CONFLICT ({keys}) DO UPDATE SET {updates} "
+                f"WHERE {self._changed(columns, 'r', 'EXCLUDED')} "
+                f"RETURNING {', '.join(f'r.{c}' for c in self.key)}, r.xmax = 0) "
+                f"INSERT INTO {self.merged} SELECT * FROM upserted"
+            )
+        )
+        inserted, updated = conn.execute(
+            text(
+                "SELECT count(*) FILTER (WHERE inserted), "
+                f"count(*) FILTER (WHERE NOT inserted) FROM {self.merged}"
+            )
+        ).one()
+        if self.aggregation is not None:
+            self.aggregation.add_rows(
+                conn,
+                f"EXISTS (SELECT 1 FROM {self.merged} m WHERE {self._match('m', 'r')})",
+            )
+        return {
+            "staged": staged,
+            "inserted": inserted,
+            "updated": updated,
+            "unchanged": staged - inserted - updated,
+        }
+
+    def append(self, conn, frames) -> int:
+        """Insert the rows of the frames whose key is not in the table yet
+        It is the append load of a keyed table: the rows already loaded (e.g. by a
+        previous load of the file) are kept as they are.
+        returns: int - Number of inserted rows"""
+        columns = self.stage(conn, frames)
+        if columns is None:
+            return 0
+        return conn.execute(
+            text(
+                f"INSERT INTO {self.table} ({', '.join(columns)}) "
+                f"SELECT {', '.join(columns)} FROM {self.staging} ORDER BY staged_row "
+                f"ON CONFLICT ({', '.join(self.key)}) DO NOTHING"
+            )
+        ).rowcount
+
+    def load(self, conn, frames) -> dict:
+        """Stage and merge the frames in the transaction of conn
+        returns: dict - Number of staged, inserted, updated and unchanged rows
+        raises: ValueError when the table has no unique index on the key"""
+        self.check_key_index(conn)
+        columns = self.stage(conn, frames)
+        if columns is None:
+            return {"staged": 0, "inserted": 0, "updated": 0, "unchanged": 0}
+        counts = self.merge(conn, columns)
+        log.info(
+            f"{self.table}: {counts['inserted']} rows inserted, {counts['updated']} "
+            f"updated, {counts['unchanged']} unchanged"
+        )
+        return counts
@@ -0,0 +1,182 @@
+"""Checks of a delivered shapefile made from its headers, before it is downloaded
+Only the .prj, the first bytes of the .shp and of the .shx and the header of the .dbf are
+read (ranged GETs), a bad delivery is rejected without reading its records or touching the
+database."""
+
+import json
+import logging
+import struct
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+
+log = logging.getLogger(__name__)
+
+# Fields of the consequence model results read by AddData.process_data
+REQUIRED_FIELDS = (
+    "fd_id",
+    "depth",
+    "damage cat",
+    "occupancy",
+    "structure",
+    "content da",
+    "pop2amu65",
+    "pop2amo65",
+    "pop2pmu65",
+    "pop2pmo65",
+    "s_dam_per",
+    "c_dam_per",
+)
+EPSG = 4326
+# The results are points: Point, PointZ and PointM files (with or without null records)
+_POINT_TYPES = {1: "Point", 11: "PointZ", 21: "PointM"}
+# The .shp and the .shx share the same header, the .shx has one 8 bytes entry per record
+_SHP_HEADER_BYTES = 100
+_SHX_RECORD_BYTES = 8
+# Enough for the descriptors of 127 fields, a larger header is read with a second GET
+_DBF_HEADER_BYTES = 4096
+
+
+def parse_storm_name(key: str) -> dict:
+    """Return the storm name and event type encoded in the name of a results file
+    parameters:
+    key: str - S3 key of the file
+    returns: dict - storm_name and event_type, None for the Tropical and Nontropical
+                    storms (not supported)"""
+    filename = key.split("/")[-1]
+    name = filename.replace(" ", "").split("_")
+    log.info(f"Storm name: {name}")
+    log.info(f"Storm name length: {len(name)}")
+    if len(name) >= 12:
+        storm_name = name[2]  # name[7]
+        # frequency = name[2]
+        event_type = 1
+    else:
+        if len(name) < 3:
+            return None
+        if name[1] == "CMB":
+            if len(name) < 4:
+                return None
+            storm_name = name[3]  ##f"{name[1]}, {name[2]}"
+            # frequency = name[3]
+            event_type = 3
+        elif name[1] in ["nTC", "TC"]:
+            return None
+        else:
+            storm_name = name[2]
+            # frequency = "N.A."
+            event_type = 2
+    return {"storm_name": storm_name, "event_type": event_type}
+
+
+def _get(s3, bucket: str, key: str, start: int = None, end: int = None) -> bytes:
+    """Return the object, or the bytes start to end (included) of it"""
+    args = {"Bucket": bucket, "Key": key}
+    if start is not None:
+        args["Range"] = f"bytes={start}-{end}"
+    return s3.get_object(**args)["Body"].read()
+
+
+def read_shp_header(data: bytes) -> dict:
+    """Return the shape type, the bounding box and the size of a .shp or .shx file from
+    its 100 bytes header"""
+    if len(data) < _SHP_HEADER_BYTES or struct.unpack(">i", data[:4])[0] != 9994:
+        raise ValueError("Not a shapefile")
+    words = struct.unpack(">i", data[24:28])[0]
+    shape_type = struct.unpack("<i", data[32:36])[0]
+    bbox = struct.unpack("<4d", data[36:68])
+    return {"shape_type": shape_type, "bbox": bbox, "size": words * 2}
+
+
+def read_dbf_header(data: bytes) -> dict:
+    """Return the record count and the field names of a .dbf header
+    parameters:
+    data: bytes - Start of the file, at least header_length bytes (see dbf_header_length)"""
+    records = struct.unpack("<I", data[4:8])[0]
+    fields = []
+    for offset in range(32, dbf_header_length(data) - 1, 32):
+        if data[offset] == 0x0D:
+            break
+        fields.append(data[offset : offset + 11].split(b"\x00")[0].decode("latin-1"))
+    return {"records": records, "fields": fields}
+
+
+def dbf_header_length(data: bytes) -> int:
+    """Return the header length of a .dbf file from its first 32 bytes"""
+    if len(data) < 32:
+        raise ValueError("Not a dbf file")
+    return struct.unpack("<H", data[8:10])[0]
+
+
+def preflight(s3, path: dict) -> dict:
+    """Check a shapefile delivery from its headers
+    It validates the file name (storm and event type), the crs of the .prj, the point
+    geometry type and bounding box of the .shp, the fields of the .dbf and that the .shx
+    indexes as many records as the .dbf holds.
+    parameters:
+    s3: boto3 S3 client
+    path: dict - Bucket and Key of the .shp file
+    returns: dict - Bucket, Key, rows, errors (empty when the file can be loaded)"""
+    bucket, key = path["Bucket"], path["Key"]
+    stem = key[: -len(".shp")] if key.lower().endswith(".shp") else key
+    report = {"Bucket": bucket, "Key": key, "rows": None, "errors": []}
+    errors = report["errors"]
+    if parse_storm_name(key) is None:
+        errors.append("File name does not encode a supported storm")
+    try:
+        from pyproj import CRS
+
+        epsg = CRS.from_wkt(_get(s3, bucket, f"{stem}.prj").decode("latin-1")).to_epsg()
+        if epsg != EPSG:
+            errors.append(f"CRS is EPSG:{epsg}, expected EPSG:{EPSG}")
+        shp = read_shp_header(_get(s3, bucket, key, 0, _SHP_HEADER_BYTES - 1))
+        shx = read_shp_header(_get(s3, bucket, f"{stem}.shx", 0, _SHP_HEADER_BYTES - 1))
+        dbf = _get(s3, bucket, f"{stem}.dbf", 0, _DBF_HEADER_BYTES - 1)
+        header_length = dbf_header_length(dbf)
+        if header_length > len(dbf):
+            dbf += _get(s3, bucket, f"{stem}.dbf", len(dbf), header_length - 1)
+        dbf = read_dbf_header(dbf)
+    except ClientError as error:
+        errors.append(f"Missing or unreadable file: {error}")
+        return report
+    except Exception as error:
+        errors.append(f"Invalid header: {error}")
+        return report
+    report["rows"] = dbf["records"]
+    if shp["shape_type"] not in _POINT_TYPES:
+        errors.append(f"Shape type is {shp['shape_type']}, expected points")
+    shx_records = (shx["size"] - _SHP_HEADER_BYTES) // _SHX_RECORD_BYTES
+    if shx_records != dbf["records"]:
+        errors.append(
+            f"The .shx and the .dbf do not have the same record count "
+            f"({shx_records} and {dbf['records']})"
+        )
+    if dbf["records"] == 0:
+        errors.append("The file has no records")
+    else:
+        xmin, ymin, xmax, ymax = shp["bbox"]
+        if xmin < -180 or xmax > 180 or ymin < -90 or ymax > 90:
+            errors.append(f"Bounding box {shp['bbox']} is not in degrees")
+    missing = [f for f in REQUIRED_FIELDS if f not in dbf["fields"]]
+    if missing:
+        errors.append(f"Missing fields: {', '.join(missing)}")
+    if errors:
+        log.warning(f"s3://{bucket}/{key} rejected: {'; '.join(errors)}")
+    return report
+
+
+def quarantine(rejected: list, quarantine_file: str) -> None:
+    """Add the rejected deliveries (preflight reports) to the quarantine file
+    The file lists them with the date of the check so they can be fixed and delivered
+    again.
+    parameters:
+    rejected: list - Reports returned by preflight
+    quarantine_file: str - json file e.g. "lwi_quarantine.json" """
+    try:
+        with open(quarantine_file, "r") as f:
+            entries = json.load(f)
+    except FileNotFoundError:
+        entries = []
+    checked = datetime.now(timezone.utc).isoformat()
+    entries.extend({**report, "datetime": checked} for report in rejected)
+    with open(quarantine_file, "w") as f:
+        json.dump(entries, f, indent=2)
@@ -0,0 +1,144 @@
+"""Storm ids of a run resolved in memory, the missing storms are created in one batch"""
+
+import logging
+from contextlib import nullcontext
+import yaml
+from sqlalchemy import create_engine, text
+from .. import ensure_unique_index, has_unique_index
+
+log = logging.getLogger(__name__)
+
+# A storm is identified by its name and its event type
+KEY = ("storm", "event_type")
+
+
+class StormRegistry:
+    def __init__(self, table: str, results_table: str = None, engine=None):
+        """Define the registry of the storm table, {(storm, event_type): storm_id}
+        load() reads the table once, resolve() creates the missing storms of the run with
+        one INSERT ... ON CONFLICT (storm, event_type) ... RETURNING, so files loaded in
+        parallel get the same id for a storm. The insert needs the unique index of the
+        key, load() creates it when the table has none. A table with duplicated storms
+        can not get the index, the storms are then inserted when they do not exist (as
+        before, without protection against concurrent loads).
+        The registry can be pickled, the engine is not shipped with it.
+        parameters:
+        table: str - Storm table
+        results_table: str - Results table, used by clean()
+        engine: sqlalchemy Engine - Used when the methods are not given a connection"""
+        self.table = table
+        self.results_table = results_table
+        self.engine = engine
+        self.storms = {}
+        # The table has the unique index of KEY, None until it is checked
+        self.keyed = None
+
+    @classmethod
+    def from_config(cls, config_file: str = "credentials.yaml") -> "StormRegistry":
+        """Create the registry of the storm table of the yaml credentials file
+        raises: FileNotFoundError when the credentials file does not exist"""
+        with open(config_file, "r") as f:
+            database = yaml.safe_load(f)["database"]
+        engine = create_engine(
+            f"postgresql://{database['user']}:{database['password']}@"
+            f"{database['host']}:{database['port']}/{database['database']}"
+        )
+        return cls(database["tables"][1]["name"], database["tables"][0]["name"], engine)
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["engine"] = None
+        return state
+
+    def _begin(self, conn):
+        """Run in the transaction of conn, or in a new one of the engine"""
+        if conn is not None:
+            return nullcontext(conn)
+        if self.engine is None:
+            raise ValueError("The registry has no engine, a connection is needed")
+        return self.engine.begin()
+
+    def load(self, conn=None) -> int:
+        """Read the storm table, creating the unique index of the key when it is missing
+        returns: int - Number of storms"""
+        with self._begin(conn) as conn:
+            self.keyed = ensure_unique_index(conn, self.table, KEY)
+            rows = conn.execute(
+                text(
+                    f"SELECT storm, event_type, storm_id FROM {self.table} "
+                    "ORDER BY storm_id DESC"
+                )
+            ).all()
+        # The first id of a duplicated storm is used
+        self.storms = {(storm, event_type): int(id) for storm, event_type, id in rows}
+        return len(self.storms)
+
+    def resolve(self, storms, conn=None) -> dict:
+        """Return the ids of the storms, creating the ones not in the table
+        parameters:
+        storms: iterable of dict - storm_name and event_type (see parse_storm_name)
+        returns: dict - {(storm, event_type): storm_id} of the storms"""
+        keys = list(
+            dict.fromkeys((s["storm_name"], s["event_type"]) for s in storms if s)
+        )
+        missing = [key for key in keys if key not in self.storms]
+        if missing:
+            values = ", ".join(
+                f"(:storm_{i}, :event_type_{i})" for i in range(len(missing))
+            )
+            params = {}
+            for i, (storm, event_type) in enumerate(missing):
+                params.update({f"storm_{i}": storm, f"event_type_{i}": event_type})
+            with self._begin(conn) as conn:
+                if self.keyed is None:
+                    self.keyed = has_unique_index(conn, self.table, KEY)
+                if self.keyed:
+                    # DO UPDATE (not DO NOTHING) so the storms created meanwhile are
+                    # returned
+                    sql = (
+                        f"INSERT INTO {self.table} (storm, event_type) VALUES {values} "
+                        "ON CONFLICT (storm, event_type) DO UPDATE SET storm = EXCLUDED.storm "
+                        "RETURNING storm, event_type, storm_id"
+                    )
+                else:
+                    conn.execute(
+                        text(
+                            f"INSERT INTO {self.table} (storm, event_type) "
+                            f"SELECT v.storm, v.event_type FROM (VALUES {values}) "
+                            "v (storm, event_type) WHERE NOT EXISTS (SELECT 1 FROM "
+                            f"{self.table} s WHERE s.storm = v.storm "
+                            "AND s.event_type = v.event_type)"
+                        ),
+                        params,
+                    )
+                    sql = (
+                        "SELECT s.storm, s.event_type, min(s.storm_id) "
+                        f"FROM {self.table} s JOIN (VALUES {values}) v (storm, event_type) "
+                        "ON s.storm = v.storm AND s.event_type = v.event_type "
+                        "GROUP BY s.storm, s.event_type"
+                    )
+                rows = conn.execute(text(sql), params).all()
+            self.storms.update(
+                {(storm, event_type): int(id) for storm, event_type, id in rows}
+            )
+            log.info(f"Storms created or found: {[storm for storm, _ in missing]}")
+        return {key: self.storms[key] for key in keys}
+
+    def get(self, storm_name: str, event_type: int) -> int:
+        """Return the id of a storm resolved by the registry, None when it is unknown"""
+        return self.storms.get((storm_name, event_type))
+
+    def clean(self, conn=None) -> None:
+        """Delete the storms without results (the storms created for files that failed)
+        It is run once at the end of the run, deleting them while files are loaded would
+        remove the storms resolved for the next files."""
+        with self._begin(conn) as conn:
+            rows = conn.execute(
+                text(
+                    f"DELETE FROM {self.table} AS s WHERE NOT EXISTS (SELECT 1 FROM "
+                    f"{self.results_table} r WHERE r.storm_id = s.storm_id) "
+                    "RETURNING storm, event_type"
+                )
+            ).all()
+        for storm, event_type in rows:
+            self.storms.pop((storm, event_type), None)
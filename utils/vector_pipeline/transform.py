@@ -0,0 +1,45 @@
+"""Projection of the point results with a transformer cached for each thread"""
+
+import threading
+import geopandas as gpd
+import shapely
+from pyproj import Transformer
+
+# pyproj transformers can not be shared between threads: each thread keeps its own
+# {(src_epsg, dst_epsg): Transformer}, released with the thread
+_LOCAL = threading.local()
+
+
+def get_transformer(src_epsg: int, dst_epsg: int) -> Transformer:
+    """Return the transformer between two crs, it is built once per thread"""
+    cache = getattr(_LOCAL, "transformers", None)
+    if cache is None:
+        cache = _LOCAL.transformers = {}
+    key = (src_epsg, dst_epsg)
+    if key not in cache:
+        cache[key] = Transformer.from_crs(src_epsg, dst_epsg, always_xy=True)
+    return cache[key]
+
+
+def to_epsg(gdf: gpd.GeoDataFrame, epsg: int = 3857) -> gpd.GeoDataFrame:
+    """Return the frame projected to epsg
+    Point geometries are projected as two coordinate arrays in one call and rebuilt with
+    shapely.points, other geometries use GeoDataFrame.to_crs.
+    parameters:
+    gdf: GeoDataFrame - Data with a crs
+    epsg: int - Target crs
+    returns: GeoDataFrame - New frame, gdf is not modified"""
+    src_epsg = gdf.crs.to_epsg()
+    if src_epsg == epsg:
+        return gdf
+    geometry = gdf.geometry.values
+    points = shapely.get_type_id(geometry) == shapely.GeometryType.POINT
+    if src_epsg is None or not points.all() or shapely.is_empty(geometry).any():
+        return gdf.to_crs(epsg)
+    coords = shapely.get_coordinates(geometry)
+    x, y = get_transformer(src_epsg, epsg).transform(coords[:, 0], coords[:, 1])
+    projected = gdf.copy()
+    projected[gdf.geometry.name] = gpd.GeoSeries(
+        shapely.points(x, y), index=gdf.index, crs=epsg
+    )
+    return projected.set_crs(epsg, allow_override=True)